@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "esgrow.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# the live update streams are served in front of Django, see esgrow_backend.asgi
+from esgrow_backend.asgi import LiveUpdatesApplication  # noqa: E402
+
+application = LiveUpdatesApplication(django_application)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,6 +42,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "esgrow_backend.metrics.InstrumentationMiddleware",
+    "esgrow_backend.throttling.LoadSheddingMiddleware",
+    "esgrow_backend.routers.ReplicaRoutingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -70,16 +74,56 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "esgrow.wsgi.application"
 
+# Serve the listing, confirm, dispute and search endpoints from the async
+# views in esgrow_backend.async_views. Only useful under an ASGI server, e.g.
+#   ESGROW_ASYNC_VIEWS=1 uvicorn esgrow.asgi:application --workers 4
+ASYNC_VIEWS = os.environ.get("ESGROW_ASYNC_VIEWS", "0") == "1"
+
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": os.environ.get("ESGROW_DATABASE", BASE_DIR / "db.sqlite3"),
+        # keep connections open between requests, checked before reuse. Under ASGI
+        # every request runs its queries on a fresh thread, so don't keep them there
+        "CONN_MAX_AGE": int(os.environ.get("ESGROW_CONN_MAX_AGE", 0 if ASYNC_VIEWS else 60)),
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {
+            # seconds a query waits for the write lock before failing
+            "timeout": 20,
+        },
     }
 }
 
+# Read replicas, see esgrow_backend.routers. ESGROW_DATABASE_REPLICAS is a comma
+# separated list of SQLite files, kept in sync with the primary by
+#   python manage.py sync_replicas --follow
+DATABASE_REPLICAS = []
+for index, name in enumerate(filter(None, os.environ.get("ESGROW_DATABASE_REPLICAS", "").split(","))):
+    DATABASES[f"replica_{index}"] = dict(DATABASES["default"], NAME=name, TEST={"MIRROR": "default"})
+    DATABASE_REPLICAS.append(f"replica_{index}")
+
+DATABASE_ROUTERS = ["esgrow_backend.routers.ReplicaRouter"]
+
+# url names whose reads may go to a replica
+REPLICA_READ_VIEWS = {"view_transactions", "search_users", "export", "user_summary", "dispute_queue"}
+
+# seconds a client reads from the primary after it wrote, so it reads its writes
+REPLICA_PIN_SECONDS = 5
+
+# Run on every SQLite connection, see esgrow_backend.sqlite. WAL lets readers and
+# the writer proceed together, with synchronous=NORMAL a commit only syncs at
+# checkpoints, which can lose the last commits on power loss but not corrupt
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,
+    "temp_store": "MEMORY",
+    "mmap_size": 256 * 1024 * 1024,
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -98,6 +142,30 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Password hashing, see esgrow_backend.hashers. New passwords are hashed with the
+# first hasher, the rest only verify older hashes, which are rehashed with the
+# first one on the user's next login. ESGROW_PASSWORD_HASHER picks scrypt
+# (default), argon2 (needs argon2-cffi) or pbkdf2 (Django's default)
+PASSWORD_HASHER_POLICIES = {
+    "scrypt": "esgrow_backend.hashers.ScryptPasswordHasher",
+    "argon2": "esgrow_backend.hashers.Argon2PasswordHasher",
+    "pbkdf2": "django.contrib.auth.hashers.PBKDF2PasswordHasher",
+}
+PASSWORD_HASHER = os.environ.get("ESGROW_PASSWORD_HASHER", "scrypt")
+PASSWORD_HASHERS = [PASSWORD_HASHER_POLICIES[PASSWORD_HASHER]] + [
+    hasher for policy, hasher in PASSWORD_HASHER_POLICIES.items() if policy != PASSWORD_HASHER
+] + ["django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher"]
+
+# scrypt: 16 MiB per hash, about a quarter of the CPU time of Django's PBKDF2
+SCRYPT_WORK_FACTOR = int(os.environ.get("ESGROW_SCRYPT_WORK_FACTOR", 2 ** 14))
+SCRYPT_BLOCK_SIZE = 8
+SCRYPT_PARALLELISM = 1
+
+# argon2id: the OWASP minimum of 19 MiB, 2 passes, 1 lane
+ARGON2_TIME_COST = int(os.environ.get("ESGROW_ARGON2_TIME_COST", 2))
+ARGON2_MEMORY_COST = int(os.environ.get("ESGROW_ARGON2_MEMORY_COST", 19 * 1024))
+ARGON2_PARALLELISM = 1
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
 
@@ -114,6 +182,15 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 
+# Uploaded files, compliance documents are stored under MEDIA_ROOT/compliance
+# and partial uploads under MEDIA_ROOT/uploads
+MEDIA_ROOT = BASE_DIR / "media"
+MEDIA_URL = "media/"
+COMPLIANCE_MAX_UPLOAD_SIZE = 1024 * 1024 * 1024
+# A request writing a chunk holds the upload for UPLOAD_LEASE seconds, renewed
+# as the body arrives, so a retry of the same chunk can't write over it
+UPLOAD_LEASE = 60
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -130,10 +207,85 @@ REST_FRAMEWORK = {
 
     ],
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        'rest_framework.authentication.TokenAuthentication',
+        'esgrow_backend.authentication.CachedTokenAuthentication',
+    ],
+    # views return plain data, the renderer wraps it in the response envelope
+    "DEFAULT_RENDERER_CLASSES": [
+        "esgrow_backend.renderers.EnvelopeORJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
     ],
 
     "EXCEPTION_HANDLER": "esgrow_backend.utils.custom_exception_handler"
 }
 
 AUTH_USER_MODEL = "esgrow_backend.User"
+
+# In process cache of authentication tokens, see esgrow_backend.authentication
+TOKEN_CACHE_MAX_SIZE = 10000
+TOKEN_CACHE_TTL = 60
+
+# Token bucket throttling, see esgrow_backend.throttling. Every scope is limited per
+# token (Authorization header), per client IP and globally, a missing axis isn't
+# limited. Rates are "<requests>/<second|minute|hour|day>"
+THROTTLE_RATES = {
+    "login": {"ip": "20/minute", "global": "50/second"},
+    "register": {"ip": "20/hour", "global": "10/second"},
+    "search": {"token": "120/minute", "ip": "300/minute", "global": "1000/second"},
+}
+
+# The buckets are kept per worker process, or in this SQLite file shared by the
+# workers of the host
+THROTTLE_DATABASE = os.environ.get("ESGROW_THROTTLE_DATABASE")
+
+# Load shedding: requests to SHED_VIEWS get a 503 while the worker has more than
+# SHED_MAX_IN_FLIGHT requests in flight or its queries recently averaged more than
+# SHED_DB_LATENCY_MS, None turns a check off
+SHED_VIEWS = {"login", "users", "search_users", "export"}
+SHED_MAX_IN_FLIGHT = int(os.environ.get("ESGROW_SHED_MAX_IN_FLIGHT", 64))
+SHED_DB_LATENCY_MS = 100
+SHED_RETRY_AFTER = 1
+
+# Queue fully confirmed escrows for the settle_transactions command instead of
+# settling them in the confirming request, see esgrow_backend.settlement
+SETTLEMENT_DEFERRED = os.environ.get("ESGROW_SETTLEMENT_DEFERRED", "0") == "1"
+
+# Webhooks, see esgrow_backend.webhooks. The dispatch_webhooks command sends up to
+# WEBHOOK_EVENTS_PER_REQUEST events per request from WEBHOOK_WORKERS threads, and
+# retries a failed request after WEBHOOK_RETRY_BASE seconds doubling up to
+# WEBHOOK_RETRY_MAX, giving up after WEBHOOK_MAX_ATTEMPTS attempts. Deliveries in
+# flight are leased for WEBHOOK_LEASE seconds
+WEBHOOK_BATCH_SIZE = 1000
+WEBHOOK_EVENTS_PER_REQUEST = 50
+WEBHOOK_WORKERS = 16
+WEBHOOK_TIMEOUT = 10
+WEBHOOK_RETRY_BASE = 5
+WEBHOOK_RETRY_MAX = 60 * 60
+WEBHOOK_MAX_ATTEMPTS = 12
+WEBHOOK_LEASE = 60
+
+# Live updates, see esgrow_backend.live. Streams are read from the outbox when this
+# worker commits events and every SSE_POLL_INTERVAL seconds, a client falling
+# SSE_QUEUE_SIZE events behind is disconnected and catches up from the table on
+# reconnect, up to SSE_CATCH_UP_LIMIT events per connection or long-poll
+SSE_POLL_INTERVAL = 1.0
+SSE_HEARTBEAT = 15
+SSE_RETRY_MS = 3000
+SSE_QUEUE_SIZE = 100
+SSE_CATCH_UP_LIMIT = 500
+LONG_POLL_MAX_TIMEOUT = 30
+
+# Queries taking at least this long are logged to esgrow_backend.slow_queries
+# and counted on /metrics, None turns the log off
+SLOW_QUERY_THRESHOLD_MS = 200
+
+# Who may read /metrics: clients at METRICS_ALLOWED_IPS (REMOTE_ADDR, the proxy's
+# address behind one) or sending "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_ALLOWED_IPS = os.environ.get("ESGROW_METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+METRICS_TOKEN = os.environ.get("ESGROW_METRICS_TOKEN")
+
+# Idempotency-Key handling, see esgrow_backend.idempotency. Stored responses are
+# replayed for a day, a retry waits up to IDEMPOTENCY_WAIT_TIMEOUT seconds for the
+# request holding its key and takes over keys held longer than the lock timeout
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+IDEMPOTENCY_WAIT_TIMEOUT = 10
+IDEMPOTENCY_LOCK_TIMEOUT = 30
@@ -14,12 +14,16 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 
+from esgrow_backend.views import prometheus_metrics
+
 urlpatterns = [
     path("admin/", admin.site.urls),
-    path("api/", include("esgrow_backend.urls")),
+    path("metrics", prometheus_metrics, name="metrics"),
+    path("api/", include("esgrow_backend.async_urls" if settings.ASYNC_VIEWS else "esgrow_backend.urls")),
 
     path('api-auth/', include('rest_framework.urls'))
 
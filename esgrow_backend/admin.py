@@ -1,9 +1,13 @@
 from django.contrib import admin
 
-from esgrow_backend.models import EscrowTransactions, User, MonetaryTransactions, ComplianceDocuments
+from esgrow_backend.models import EscrowTransactions, User, MonetaryTransactions, ComplianceDocuments, LedgerEntry, \
+    BalanceSnapshot, WebhookEndpoint
 
 # Register your models here.
 admin.site.register(EscrowTransactions)
 admin.site.register(User)
 admin.site.register(MonetaryTransactions)
 admin.site.register(ComplianceDocuments)
+admin.site.register(LedgerEntry)
+admin.site.register(BalanceSnapshot)
+admin.site.register(WebhookEndpoint)
@@ -1,28 +1,50 @@
 import datetime
+from decimal import Decimal
 
+from django.conf import settings
+from django.db import transaction
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
-from esgrow_backend.models import User, EscrowTransactions, ComplianceDocuments, Disputes
+from esgrow_backend import metrics, outbox, summaries
+from esgrow_backend.models import User, EscrowTransactions, ComplianceDocuments, Disputes, ComplianceUpload, \
+    UserSummary, TransactionStage, DisputeOutcome, EventKind
 
 
-class UserSerializer(serializers.ModelSerializer):
+class TimedSerializerMixin:
+    """
+    Counts the time spent producing `data` in the request metrics. Lists of
+    a serializer are timed with `list_serializer_class = TimedListSerializer`
+    in its Meta
+    """
+
+    @property
+    def data(self):
+        with metrics.timed_serialization():
+            return super().data
+
+
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
+        list_serializer_class = TimedListSerializer
         fields = ("id", "username", "email", "password", "first_name", "last_name")
         write_only_fields = ("password",)
         read_only_fields = ("id",)
 
     def create(self, validated_data):
-        user = User.objects.create(
+        # hashes the password before the insert, so the user is written (and signalled) once
+        return User.objects.create_user(
             username=validated_data["username"],
             email=validated_data["email"],
+            password=validated_data["password"],
             first_name=validated_data.get("first_name", ""),
             last_name=validated_data.get("last_name", "")
         )
-        user.set_password(validated_data["password"])
-        user.save()
-        return user
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
@@ -30,7 +52,7 @@ class UserSerializer(serializers.ModelSerializer):
         return response
 
 
-class LoggedInUserSerializer(serializers.ModelSerializer):
+class LoggedInUserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ("id", "username", "email", "password", "first_name", "last_name", "balance")
@@ -38,15 +60,14 @@ class LoggedInUserSerializer(serializers.ModelSerializer):
         read_only_fields = ("id", "balance")
 
     def create(self, validated_data):
-        user = User.objects.create(
+        # hashes the password before the insert, so the user is written (and signalled) once
+        return User.objects.create_user(
             username=validated_data["username"],
             email=validated_data["email"],
+            password=validated_data["password"],
             first_name=validated_data.get("first_name", ""),
             last_name=validated_data.get("last_name", "")
         )
-        user.set_password(validated_data["password"])
-        user.save()
-        return user
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
@@ -54,21 +75,24 @@ class LoggedInUserSerializer(serializers.ModelSerializer):
         return response
 
 
-class EscrowTransactionSerializer(serializers.ModelSerializer):
+class EscrowTransactionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = EscrowTransactions
         fields = ("transaction_id", "stage", "amount", "from_user", "to_user", "created_date", "modified_date")
         read_only_fields = ("transaction_id", "stage", "created_date", "modified_date")
 
     def create(self, validated_data):
-        transaction = EscrowTransactions.objects.create(
-            amount=validated_data["amount"],
-            stage="Initiated",
-            from_user=validated_data["from_user"],
-            to_user=validated_data["to_user"]
-        )
-        transaction.save()
-        return transaction
+        with transaction.atomic():
+            escrow = EscrowTransactions.objects.create(
+                amount=validated_data["amount"],
+                stage=TransactionStage.Initiated,
+                from_user=validated_data["from_user"],
+                to_user=validated_data["to_user"]
+            )
+            summaries.record(escrows=[(escrow.from_user_id, escrow.to_user_id, escrow.amount, None, escrow.stage)])
+            outbox.publish(EventKind.Created, [(escrow.transaction_id, escrow.from_user_id, escrow.to_user_id,
+                                                escrow.amount)])
+        return escrow
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
@@ -76,33 +100,85 @@ class EscrowTransactionSerializer(serializers.ModelSerializer):
         return response
 
 
-class EscrowViewTransactionSerializer(serializers.ModelSerializer):
+class EscrowTransactionBulkItemSerializer(serializers.Serializer):
+    """
+    A row of a bulk create request, users are plain ids so validating a
+    batch doesn't look them up one at a time
+    """
+    from_user = serializers.UUIDField()
+    to_user = serializers.UUIDField()
+    amount = serializers.DecimalField(max_digits=100, decimal_places=2, min_value=Decimal("0.01"))
+
+
+class EscrowViewTransactionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     from_user = UserSerializer(many=False, read_only=True)
     to_user = UserSerializer(many=False, read_only=True)
 
     class Meta:
         model = EscrowTransactions
+        list_serializer_class = TimedListSerializer
         fields = ("transaction_id", "stage", "amount", "from_user", "to_user", "created_date", "modified_date",
                   "from_user_confirmed", "from_user_confirmed_date", "to_user_confirmed", "to_user_confirmed_date")
         read_only_fields = ("transaction_id", "stage", "created_date", "modified_date")
 
 
-class DisputeSerializer(serializers.ModelSerializer):
+class DisputeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     user_initiated = UserSerializer(many=False, read_only=True)
     transaction = EscrowViewTransactionSerializer(many=False, read_only=True)
 
     class Meta:
         model = Disputes
+        list_serializer_class = TimedListSerializer
         fields = ("dispute_id", "reason", "transaction", "user_initiated", "created_date", "modified_date")
 
-# class ComplianceTransactionSerializer(serializers.ModelSerializer):
-#     party_a = UserSerializer(many=False, read_only=True)
-#     party_b = UserSerializer(many=False, read_only=True)
-#
-#     class Meta:
-#         model = ComplianceDocuments
-#         fields = ("compliance_id", "party_a", "party_b", "created_date", "file")
-#         read_only_fields = ("compliance_id",)
-#
-#     def create(self, validated_data):
-#         transaction =
+
+class DisputeQueueSerializer(DisputeSerializer):
+    class Meta(DisputeSerializer.Meta):
+        fields = DisputeSerializer.Meta.fields + ("stage", "assigned_to", "outcome", "resolution", "resolved_by",
+                                                  "resolved_date")
+
+
+class DisputeBatchSerializer(serializers.Serializer):
+    dispute_ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False, max_length=1000)
+
+
+class DisputeAssignSerializer(DisputeBatchSerializer):
+    # None unassigns the disputes
+    user_id = serializers.PrimaryKeyRelatedField(queryset=User.objects.filter(is_staff=True), allow_null=True)
+
+
+class DisputeResolveSerializer(DisputeBatchSerializer):
+    outcome = serializers.ChoiceField(choices=DisputeOutcome.choices, required=False, default="")
+    resolution = serializers.CharField(max_length=300, required=False, allow_blank=True, default="")
+
+
+class UserSummarySerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = UserSummary
+        fields = summaries.FIELDS
+        read_only_fields = fields
+
+
+class ComplianceDocumentSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    party_a = UserSerializer(many=False, read_only=True)
+    party_b = UserSerializer(many=False, read_only=True)
+
+    class Meta:
+        model = ComplianceDocuments
+        fields = ("compliance_id", "party_a", "party_b", "approved_by_party_a", "approved_by_party_b",
+                  "sha256", "size", "created_date")
+        read_only_fields = fields
+
+
+class ComplianceUploadSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    document = ComplianceDocumentSerializer(many=False, read_only=True)
+
+    class Meta:
+        model = ComplianceUpload
+        fields = ("upload_id", "party_b", "filename", "size", "received", "document", "created_date")
+        read_only_fields = ("upload_id", "received", "document", "created_date")
+
+    def validate_size(self, value):
+        if value < 1 or value > settings.COMPLIANCE_MAX_UPLOAD_SIZE:
+            raise ValidationError(f"Uploads must be between 1 and {settings.COMPLIANCE_MAX_UPLOAD_SIZE} bytes")
+        return value
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class EsgrowBackendConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "esgrow_backend"
+
+    def ready(self):
+        from esgrow_backend import metrics, sqlite
+
+        connection_created.connect(metrics.install_query_wrapper, dispatch_uid="esgrow_instrument_queries")
+        connection_created.connect(sqlite.apply_pragmas, dispatch_uid="esgrow_sqlite_pragmas")
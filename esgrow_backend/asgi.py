@@ -0,0 +1,166 @@
+"""
+The live update endpoints, served by the ASGI app in front of Django:
+- `GET /api/v1/events`: Server-Sent Events of the changes to the user's
+  escrows and disputes, after the `Last-Event-ID` header (or `after`
+  parameter) when given
+- `GET /api/v1/events/poll`: the long-poll variant, the user's events after
+  `after`, or the first to happen within `timeout` seconds, with the id to
+  pass as `after` next
+
+They bypass Django's request handling on purpose: it runs every request in
+its own thread sensitive context, which keeps a thread per open request, so
+an idle stream would hold a thread. Here it holds a task and a queue, and
+the few queries (token lookup, catch up) run on the shared sync thread.
+Being outside the middleware, the streams aren't timed by the metrics or
+counted as in flight by the load shedder. See `esgrow_backend.live`
+"""
+import asyncio
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from rest_framework import status
+
+from esgrow_backend import live, renderers, utils
+from esgrow_backend.async_views import authenticate_header
+
+STREAM_PATH = "/api/v1/events"
+POLL_PATH = "/api/v1/events/poll"
+
+
+class BadRequest(Exception):
+    def __init__(self, errors: dict):
+        self.errors = errors
+
+
+def parse_event_id(value: str | None, field: str) -> int | None:
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest({field: ["Expected an event id"]})
+
+
+async def respond(send, data, status_code: int, errors=None):
+    body = renderers.dumps(utils.envelope(data, status_code, errors))
+    await send({"type": "http.response.start", "status": status_code,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def disconnected(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def stream_events(subscription: live.Subscription, after: int | None):
+    """
+    The events of a subscription as Server-Sent Events, with a comment every
+    SSE_HEARTBEAT seconds so proxies keep the idle connection open. Ends when
+    the client fell behind, which reconnects with Last-Event-ID and catches up
+    """
+    heartbeat = getattr(settings, "SSE_HEARTBEAT", 15)
+    yield f"retry: {getattr(settings, 'SSE_RETRY_MS', 3000)}\n\n"
+    if after is not None:
+        subscription.last_event_id = after
+        limit = getattr(settings, "SSE_CATCH_UP_LIMIT", 500)
+        events = await live.catch_up(subscription.user_id, after, limit)
+        for event in events:
+            if not subscription.sent(event):
+                yield live.format_event(event)
+        if len(events) == limit:
+            return
+    while not (subscription.overflowed and subscription.queue.empty()):
+        try:
+            event = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+        except TimeoutError:
+            yield ": keepalive\n\n"
+            continue
+        if not subscription.sent(event):
+            yield live.format_event(event)
+
+
+async def event_stream(receive, send, user, query: dict, headers: dict):
+    after = parse_event_id(headers.get(b"last-event-id", b"").decode() or query.get("after"), "after")
+    subscription = await live.notifier.subscribe(user.id)
+    try:
+        await send({"type": "http.response.start", "status": status.HTTP_200_OK, "headers": [
+            (b"content-type", b"text/event-stream"),
+            (b"cache-control", b"no-cache"),
+            # nginx would buffer the stream otherwise
+            (b"x-accel-buffering", b"no"),
+        ]})
+
+        async def write():
+            async for chunk in stream_events(subscription, after):
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+
+        writing = asyncio.ensure_future(write())
+        waiting = asyncio.ensure_future(disconnected(receive))
+        try:
+            await asyncio.wait((writing, waiting), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (writing, waiting):
+                task.cancel()
+        if writing.done() and not writing.cancelled():
+            writing.result()
+    finally:
+        live.notifier.unsubscribe(subscription)
+
+
+async def poll_events(receive, send, user, query: dict, headers: dict):
+    after = parse_event_id(query.get("after"), "after")
+    try:
+        timeout = min(float(query.get("timeout", 25)), getattr(settings, "LONG_POLL_MAX_TIMEOUT", 30))
+    except ValueError:
+        raise BadRequest({"timeout": ["Expected a number of seconds"]})
+
+    subscription = await live.notifier.subscribe(user.id)
+    try:
+        events = []
+        if after is not None:
+            subscription.last_event_id = after
+            events = await live.catch_up(subscription.user_id, after, getattr(settings, "SSE_CATCH_UP_LIMIT", 500))
+        if not events:
+            try:
+                events.append(await asyncio.wait_for(subscription.queue.get(), max(timeout, 0)))
+            except TimeoutError:
+                pass
+            while not subscription.queue.empty():
+                events.append(subscription.queue.get_nowait())
+        events = [event for event in events if not subscription.sent(event)]
+    finally:
+        live.notifier.unsubscribe(subscription)
+    await respond(send, {"events": events, "last_event_id": subscription.last_event_id}, status.HTTP_200_OK)
+
+
+VIEWS = {STREAM_PATH: event_stream, POLL_PATH: poll_events}
+
+
+class LiveUpdatesApplication:
+    """
+    Serves the live update paths and passes every other request to
+    `application`
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        view = VIEWS.get(scope["path"].rstrip("/")) if scope["type"] == "http" else None
+        if view is None:
+            return await self.application(scope, receive, send)
+        if scope["method"] != "GET":
+            return await respond(send, {}, status.HTTP_405_METHOD_NOT_ALLOWED,
+                                 {"detail": [f"Method \"{scope['method']}\" not allowed."]})
+
+        headers = dict(scope["headers"])
+        user = await authenticate_header(headers.get(b"authorization", b"").decode("latin-1"))
+        if user is None:
+            return await respond(send, {}, status.HTTP_401_UNAUTHORIZED, {"detail": ["Invalid token."]})
+        query = {key: values[-1] for key, values in parse_qs(scope["query_string"].decode("latin-1")).items()}
+        try:
+            await view(receive, send, user, query, headers)
+        except BadRequest as e:
+            await respond(send, {}, status.HTTP_400_BAD_REQUEST, e.errors)
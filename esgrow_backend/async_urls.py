@@ -0,0 +1,17 @@
+from django.urls import path
+
+from esgrow_backend import async_views
+from esgrow_backend.urls import urlpatterns as sync_urlpatterns
+
+# url name -> async view replacing the sync one
+ASYNC_VIEWS = {
+    "view_transactions": async_views.view_transactions,
+    "confirm_transaction": async_views.confirm_transaction,
+    "dispute_transaction": async_views.dispute_transaction,
+    "search_users": async_views.search_users,
+}
+
+urlpatterns = [
+    path(str(pattern.pattern), ASYNC_VIEWS.get(pattern.name, pattern.callback), name=pattern.name)
+    for pattern in sync_urlpatterns
+]
@@ -0,0 +1,185 @@
+"""
+Async variants of the read heavy and confirm/dispute endpoints.
+
+They use the async ORM directly so under ASGI a request doesn't hop to the
+sync thread for every query, only the atomic settlement still runs in a
+thread. Django REST framework views are sync only, so these are plain
+Django views producing the same responses as their counterparts in
+`esgrow_backend.views`. Enabled with the ASYNC_VIEWS setting, see
+`esgrow_backend.async_urls`
+"""
+import functools
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import Throttled, ValidationError
+
+from esgrow_backend import renderers, routers, search, settlement, throttling, transitions, utils
+from esgrow_backend.app_serializers import EscrowViewTransactionSerializer, UserSerializer, DisputeSerializer
+from esgrow_backend.authentication import token_cache
+from esgrow_backend.idempotency import aidempotent
+from esgrow_backend.models import EscrowTransactions, TransactionStage
+from esgrow_backend.pagination import akeyset_paginate, parse_page_size
+from esgrow_backend.querysets import optimise_queryset
+from esgrow_backend.views import EscrowTransactionsView, closed_error, confirmation_fields, open_dispute, \
+    record_confirmation
+
+
+def envelope(data, status_code: int, errors=None, description: str = None) -> HttpResponse:
+    return HttpResponse(renderers.dumps(utils.envelope(data, status_code, errors, description)),
+                        status=status_code, content_type="application/json")
+
+
+def bad_request(e: ValidationError) -> HttpResponse:
+    return envelope({}, status.HTTP_400_BAD_REQUEST, utils.error_details(e.detail))
+
+
+async def closed_envelope(transaction_id: uuid.UUID) -> HttpResponse:
+    error = closed_error(await EscrowTransactions.objects.filter(transaction_id=transaction_id)
+                         .values_list("stage", flat=True).afirst())
+    return envelope({}, error.status_code, error.errors)
+
+
+async def authenticate(request):
+    """
+    Resolve the user of the `Authorization: Token <key>` header, sharing the
+    cache of `CachedTokenAuthentication`
+    """
+    return await authenticate_header(request.headers.get("Authorization", ""))
+
+
+async def authenticate_header(authorization: str):
+    header = authorization.split()
+    if len(header) != 2 or header[0].lower() != "token":
+        return None
+    key = header[1]
+
+    cached = token_cache.get(key)
+    if cached is not None:
+        user, _ = cached
+    else:
+        token = await Token.objects.using(routers.PRIMARY).select_related("user").filter(key=key).afirst()
+        if token is None:
+            return None
+        user = token.user
+        token_cache.set(key, user, token)
+    return user if user.is_active else None
+
+
+def token_required(view):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await authenticate(request)
+        if user is None:
+            return envelope({}, status.HTTP_401_UNAUTHORIZED, {"detail": ["Invalid token."]})
+        request.user = user
+        return await view(request, *args, **kwargs)
+
+    return wrapper
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@token_required
+async def view_transactions(request):
+    try:
+        transactions = EscrowTransactionsView.filter_transactions(request.user, request.GET)
+        limit = parse_page_size(request.GET.get("limit"))
+        page, next_cursor = await akeyset_paginate(transactions, request.GET.get("cursor"), limit,
+                                                   key_field="transaction_id")
+    except ValidationError as e:
+        return bad_request(e)
+
+    serializer = EscrowViewTransactionSerializer(page, many=True)
+    return envelope({"transactions": serializer.data, "next_cursor": next_cursor}, status.HTTP_200_OK)
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+@token_required
+@aidempotent
+async def confirm_transaction(request, transaction_id: uuid.UUID):
+    transaction = await optimise_queryset(EscrowTransactions.objects, EscrowViewTransactionSerializer) \
+        .filter(transaction_id=transaction_id).afirst()
+    if transaction is None:
+        return envelope({}, status.HTTP_404_NOT_FOUND,
+                        {"transaction_id": ["Transaction wasn't found"]})
+
+    fields = confirmation_fields(transaction, request.user)
+    if fields is None:
+        return envelope({}, status.HTTP_400_BAD_REQUEST,
+                        {"user_id": ["Logged In user is not part of the transaction"]})
+    # the confirmation and its event are written in an atomic block, which the async ORM doesn't support
+    confirmed = await sync_to_async(record_confirmation)(transaction, request.user, fields)
+    if confirmed is None:
+        return await closed_envelope(transaction.transaction_id)
+    if confirmed:
+        for field, value in fields.items():
+            setattr(transaction, field, value)
+
+    # settlement needs an atomic block, which the async ORM doesn't support
+    settled, _ = await sync_to_async(settlement.settle_or_queue)([transaction.transaction_id])
+    if settled:
+        await transaction.arefresh_from_db(
+            fields=["stage", "updated_on_users", "time_updated_on_users", "modified_date"])
+
+    serializer = EscrowViewTransactionSerializer(transaction, many=False)
+    return envelope(serializer.data, status.HTTP_200_OK)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@token_required
+@aidempotent
+async def dispute_transaction(request, transaction_id: uuid.UUID):
+    transaction = await optimise_queryset(EscrowTransactions.objects, EscrowViewTransactionSerializer) \
+        .filter(transaction_id=transaction_id).afirst()
+    if transaction is None:
+        return envelope({}, status.HTTP_404_NOT_FOUND,
+                        {"transaction_id": ["Transaction wasn't found"]})
+    if transaction.stage == TransactionStage.Completed:
+        return envelope({}, status.HTTP_404_NOT_FOUND,
+                        {"transaction_id": ["Cannot refute transaction that was previously completed"]},
+                        description="NOT ACCEPTABLE")
+
+    user = request.user
+    if user not in (transaction.from_user, transaction.to_user):
+        return envelope({}, status.HTTP_400_BAD_REQUEST,
+                        {"user_id": ["Logged In user is not part of the transaction"]})
+
+    try:
+        json_data = json.loads(request.body or b"{}")
+    except ValueError as e:
+        return envelope({}, status.HTTP_400_BAD_REQUEST, {"exception": [f"{e}"]})
+
+    # the dispute and the summaries change in an atomic block, which the async ORM doesn't support
+    try:
+        dispute = await sync_to_async(open_dispute)(transaction, user, json_data.get("reason", ""))
+    except transitions.IllegalTransition:
+        return await closed_envelope(transaction.transaction_id)
+
+    serializer = DisputeSerializer(dispute, many=False)
+    return envelope(serializer.data, status.HTTP_200_OK)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+async def search_users(request):
+    wait = await throttling.acheck(request, "search")
+    if wait is not None:
+        return throttling.unavailable(Throttled(wait), wait)
+    name = request.GET.get("name", default="")
+    try:
+        limit = parse_page_size(request.GET.get("limit"), default=search.DEFAULT_LIMIT, maximum=search.MAX_LIMIT)
+        users, next_cursor = await search.asearch(name, limit=limit, cursor=request.GET.get("cursor"))
+    except ValidationError as e:
+        return bad_request(e)
+
+    serializer = UserSerializer(users, many=True)
+    return envelope({"users": serializer.data, "next_cursor": next_cursor}, status.HTTP_200_OK)
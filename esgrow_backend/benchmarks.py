@@ -0,0 +1,374 @@
+"""
+A reproducible load benchmark of the API.
+
+`seed` fills the database with synthetic users, escrows, disputes and
+monetary transactions, activity is skewed towards a few busy users the way
+real traffic is. `run` sends the requests of a benchmark through the Django
+test client (WSGI) or the async test client (ASGI) in process, and reports
+throughput, latency percentiles and queries per request, the latter from
+the instrumentation middleware. `password_hash_rates` measures how many
+logins a core can verify with each configured password hasher and
+`renderer_rates` how fast each JSON renderer encodes a large transaction
+list. `compare` checks a run against a stored baseline. Nothing outside the
+process is needed, the `benchmark` management command runs it all against a
+throwaway database
+"""
+import asyncio
+import random
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from rest_framework.authtoken.models import Token
+from rest_framework.response import Response
+
+from esgrow_backend import metrics, search, summaries
+from esgrow_backend.app_serializers import EscrowViewTransactionSerializer
+from esgrow_backend.models import User, EscrowTransactions, TransactionStage, Disputes, DisputeStage, \
+    MonetaryTransactions, UserSearchToken
+from esgrow_backend.querysets import optimise_queryset
+from esgrow_backend.renderers import EnvelopeJSONRenderer, EnvelopeORJSONRenderer, orjson
+
+PASSWORD = "benchmark-password"
+
+# url conf each mode is served from
+MODES = {
+    "wsgi": "esgrow_backend.urls",
+    "asgi": "esgrow_backend.async_urls",
+}
+
+FIRST_NAMES = ("Amina", "Brian", "Chebet", "David", "Esther", "Faith", "George", "Hassan", "Irene", "James",
+               "Kamau", "Lilian", "Moses", "Njeri", "Otieno", "Purity", "Rose", "Samuel", "Wanjiru", "Zawadi")
+LAST_NAMES = ("Achieng", "Barasa", "Cheruiyot", "Kiprono", "Mutua", "Njoroge", "Odhiambo", "Wafula", "Kariuki",
+              "Omondi")
+
+BATCH_SIZE = 1000
+
+
+class BenchmarkError(Exception):
+    """
+    Raised when a request of a benchmark doesn't succeed
+    """
+
+
+@dataclass
+class Dataset:
+    # most active first
+    users: list[User]
+    tokens: dict
+    rng: random.Random
+    weights: list[float] = field(default_factory=list)
+
+    def __post_init__(self):
+        # Zipf like, the i-th user is picked about 1 / i as often as the first
+        self.weights = [1 / (rank + 1) for rank in range(len(self.users))]
+
+    def user(self) -> User:
+        return self.rng.choices(self.users, self.weights)[0]
+
+    def pair(self) -> tuple[User, User]:
+        from_user = self.user()
+        to_user = self.user()
+        while to_user == from_user:
+            to_user = self.user()
+        return from_user, to_user
+
+    def amount(self) -> Decimal:
+        # mostly small payments, a few large ones
+        return Decimal(min(round(self.rng.lognormvariate(3, 1.2), 2), 99_999)).quantize(Decimal("0.01"))
+
+
+def seed(users: int, escrows: int, disputes: int, monetary: int, random_seed: int = 0) -> Dataset:
+    """
+    Create the synthetic data set, every user can log in with PASSWORD
+    """
+    rng = random.Random(random_seed)
+    password = make_password(PASSWORD)
+    created = [
+        User(id=uuid.UUID(int=rng.getrandbits(128), version=4), username=f"{first.lower()}{i}",
+             first_name=first, last_name=rng.choice(LAST_NAMES), email=f"user{i}@example.com",
+             password=password, balance=Decimal(100_000))
+        for i, first in enumerate(rng.choice(FIRST_NAMES) for _ in range(users))
+    ]
+    User.objects.bulk_create(created, batch_size=BATCH_SIZE)
+    # bulk_create skips the post_save receivers that create these
+    Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in created],
+                              batch_size=BATCH_SIZE)
+    UserSearchToken.objects.bulk_create([token for user in created for token in search.search_tokens(user)],
+                                        batch_size=BATCH_SIZE)
+
+    dataset = Dataset(created, dict(Token.objects.values_list("user_id", "key")), rng)
+    stages = (TransactionStage.Initiated, TransactionStage.Completed, TransactionStage.Cancelled)
+    rows = []
+    for _ in range(escrows):
+        from_user, to_user = dataset.pair()
+        stage = rng.choices(stages, (6, 3, 1))[0]
+        rows.append(EscrowTransactions(from_user=from_user, to_user=to_user, amount=dataset.amount(), stage=stage,
+                                       from_user_confirmed=stage == TransactionStage.Completed,
+                                       to_user_confirmed=stage == TransactionStage.Completed,
+                                       updated_on_users=stage == TransactionStage.Completed))
+    EscrowTransactions.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+
+    cancelled = [row for row in rows if row.stage == TransactionStage.Cancelled]
+    Disputes.objects.bulk_create([
+        Disputes(transaction=row, user_initiated=rng.choice((row.from_user, row.to_user)), reason="Not delivered",
+                 stage=rng.choice(DisputeStage.values))
+        for row in rng.sample(cancelled, min(disputes, len(cancelled)))
+    ], batch_size=BATCH_SIZE)
+
+    MonetaryTransactions.objects.bulk_create([
+        MonetaryTransactions(user=dataset.user(), external_entity=rng.choice(("mpesa", "bank", "card")),
+                             external_reference=f"ref{i}", amount=dataset.amount() * rng.choice((1, -1)),
+                             stage=TransactionStage.Completed, updated_on_users=True)
+        for i in range(monetary)
+    ], batch_size=BATCH_SIZE)
+    summaries.rebuild()
+    return dataset
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    data: dict | None = None
+    user: User | None = None
+
+
+def open_escrows(dataset: Dataset, count: int, **fields) -> list[EscrowTransactions]:
+    rows = [EscrowTransactions(from_user=from_user, to_user=to_user, amount=dataset.amount(),
+                               stage=TransactionStage.Initiated, **fields)
+            for from_user, to_user in (dataset.pair() for _ in range(count))]
+    EscrowTransactions.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    summaries.record(escrows=[(row.from_user_id, row.to_user_id, row.amount, None, row.stage) for row in rows])
+    return rows
+
+
+def registration(dataset: Dataset, count: int) -> list[Request]:
+    return [Request("post", reverse("users"), {"username": f"new{uuid.uuid4().hex}", "email": "new@example.com",
+                                               "password": PASSWORD, "first_name": dataset.rng.choice(FIRST_NAMES)})
+            for _ in range(count)]
+
+
+def login(dataset: Dataset, count: int) -> list[Request]:
+    return [Request("post", reverse("login"), {"username": dataset.user().username, "password": PASSWORD})
+            for _ in range(count)]
+
+
+def listing(dataset: Dataset, count: int) -> list[Request]:
+    return [Request("get", reverse("view_transactions"), {"limit": 50}, dataset.user()) for _ in range(count)]
+
+
+def create(dataset: Dataset, count: int) -> list[Request]:
+    requests = []
+    for _ in range(count):
+        from_user, to_user = dataset.pair()
+        requests.append(Request("post", reverse("create_transactions"),
+                                {"from_user": str(from_user.id), "to_user": str(to_user.id),
+                                 "amount": str(dataset.amount())}, from_user))
+    return requests
+
+
+def confirm(dataset: Dataset, count: int) -> list[Request]:
+    # the receiving side already confirmed, so every request also settles
+    return [Request("post", reverse("confirm_transaction", args=[escrow.transaction_id]), {}, escrow.from_user)
+            for escrow in open_escrows(dataset, count, to_user_confirmed=True)]
+
+
+def dispute(dataset: Dataset, count: int) -> list[Request]:
+    return [Request("post", reverse("dispute_transaction", args=[escrow.transaction_id]),
+                    {"reason": "Goods never arrived"}, escrow.to_user)
+            for escrow in open_escrows(dataset, count)]
+
+
+def summary(dataset: Dataset, count: int) -> list[Request]:
+    return [Request("get", reverse("user_summary"), user=dataset.user()) for _ in range(count)]
+
+
+def user_search(dataset: Dataset, count: int) -> list[Request]:
+    requests = []
+    for _ in range(count):
+        name = dataset.user().first_name.lower()
+        requests.append(Request("get", reverse("search_users"), {"name": name[:dataset.rng.randint(3, len(name))]}))
+    return requests
+
+
+# benchmark name -> (url name the metrics are recorded under, request factory)
+BENCHMARKS = {
+    "registration": ("users", registration),
+    "login": ("login", login),
+    "listing": ("view_transactions", listing),
+    "create": ("create_transactions", create),
+    "confirm": ("confirm_transaction", confirm),
+    "dispute": ("dispute_transaction", dispute),
+    "search": ("search_users", user_search),
+    "summary": ("user_summary", summary),
+}
+
+
+def summarize(latencies: list[float], elapsed: float, cpu_time: float, url_name: str) -> dict:
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    query_total, query_count = metrics.request_queries.totals(url_name)
+    return {
+        "requests": len(latencies),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        # throughput of one fully used core, e.g. logins/sec per core
+        "requests_per_cpu_second": round(len(latencies) / cpu_time, 1) if cpu_time else None,
+        "p50_ms": round(percentiles[49] * 1000, 2),
+        "p95_ms": round(percentiles[94] * 1000, 2),
+        "p99_ms": round(percentiles[98] * 1000, 2),
+        "queries_per_request": round(query_total / query_count, 2) if query_count else None,
+    }
+
+
+def request_arguments(dataset: Dataset, request: Request) -> tuple[tuple, dict]:
+    kwargs = {}
+    if request.user is not None:
+        kwargs["headers"] = {"Authorization": f"Token {dataset.tokens[request.user.id]}"}
+    if request.method == "post":
+        kwargs["content_type"] = "application/json"
+    return (request.path, request.data), kwargs
+
+
+def check(request: Request, response):
+    if response.status_code >= 400:
+        raise BenchmarkError(f"{request.method.upper()} {request.path} returned {response.status_code}: "
+                             f"{response.content[:500]!r}")
+
+
+def run(name: str, mode: str, dataset: Dataset, count: int, concurrency: int = 1) -> dict:
+    """
+    Send `count` requests of benchmark `name` in `mode` (wsgi or asgi),
+    `concurrency` at a time
+    """
+    url_name, factory = BENCHMARKS[name]
+    with override_settings(ROOT_URLCONF=MODES[mode]):
+        requests = factory(dataset, count)
+        metrics.clear()
+        cpu_start = time.process_time()
+        if mode == "asgi":
+            latencies, elapsed = asyncio.run(run_async(dataset, requests, concurrency))
+        else:
+            latencies, elapsed = run_sync(dataset, requests, concurrency)
+        cpu_time = time.process_time() - cpu_start
+    return summarize(latencies, elapsed, cpu_time, url_name)
+
+
+def run_sync(dataset: Dataset, requests: list[Request], concurrency: int) -> tuple[list[float], float]:
+    client = Client()
+
+    def timed(request: Request) -> float:
+        args, kwargs = request_arguments(dataset, request)
+        start = time.perf_counter()
+        response = getattr(client, request.method)(*args, **kwargs)
+        latency = time.perf_counter() - start
+        check(request, response)
+        return latency
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        # on the calling thread, so it shares its database connection
+        latencies = [timed(request) for request in requests]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(timed, requests))
+    return latencies, time.perf_counter() - start
+
+
+async def run_async(dataset: Dataset, requests: list[Request], concurrency: int) -> tuple[list[float], float]:
+    client = AsyncClient()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(request: Request) -> float:
+        args, kwargs = request_arguments(dataset, request)
+        async with semaphore:
+            start = time.perf_counter()
+            response = await getattr(client, request.method)(*args, **kwargs)
+            latency = time.perf_counter() - start
+        check(request, response)
+        return latency
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(timed(request) for request in requests))
+    return list(latencies), time.perf_counter() - start
+
+
+def password_hash_rates(rounds: int = 10) -> dict:
+    """
+    Password checks per second per core of each configured hasher, at the
+    cost it is configured with. Hashers whose library isn't installed are
+    left out
+    """
+    rates = {}
+    for path in settings.PASSWORD_HASHERS:
+        hasher = import_string(path)()
+        try:
+            encoded = hasher.encode(PASSWORD, hasher.salt())
+        except ValueError:
+            continue
+        start = time.process_time()
+        for _ in range(rounds):
+            hasher.verify(PASSWORD, encoded)
+        cpu_time = time.process_time() - start
+        rates[hasher.algorithm] = {"ms_per_check": round(cpu_time / rounds * 1000, 2),
+                                   "logins_per_cpu_second": round(rounds / cpu_time, 1)}
+    return rates
+
+
+def renderer_rates(rows: int = 5000, rounds: int = 5) -> dict:
+    """
+    Transactions per second per core the stock and the orjson renderer
+    encode, on a listing of `rows` seeded transactions
+    """
+    transactions = optimise_queryset(EscrowTransactions.objects, EscrowViewTransactionSerializer)[:rows]
+    response = Response({"transactions": EscrowViewTransactionSerializer(transactions, many=True).data,
+                         "next_cursor": None})
+    context = {"response": response}
+    rows = len(response.data["transactions"])
+
+    renderers = {"json": EnvelopeJSONRenderer()}
+    if orjson is not None:
+        renderers["orjson"] = EnvelopeORJSONRenderer()
+    rates = {}
+    for name, renderer in renderers.items():
+        start = time.process_time()
+        for _ in range(rounds):
+            body = renderer.render(response.data, renderer_context=context)
+        cpu_time = time.process_time() - start
+        rates[name] = {"rows": rows, "bytes": len(body), "ms_per_render": round(cpu_time / rounds * 1000, 2),
+                       "rows_per_cpu_second": round(rows * rounds / cpu_time)}
+    return rates
+
+
+def compare(baseline: dict, results: dict, tolerance: float) -> list[str]:
+    """
+    The regressions of `results` against `baseline`, both as produced by the
+    benchmark command.
+
+    Query counts don't depend on the machine, any increase is a regression.
+    Latency and throughput are only compared within `tolerance` (a fraction)
+    """
+    regressions = []
+    for name, modes in results["results"].items():
+        for mode, current in modes.items():
+            previous = baseline.get("results", {}).get(name, {}).get(mode)
+            if previous is None:
+                continue
+            label = f"{name} ({mode})"
+            if (current["queries_per_request"] or 0) > (previous["queries_per_request"] or 0):
+                regressions.append(f"{label}: {current['queries_per_request']} queries per request, "
+                                   f"baseline {previous['queries_per_request']}")
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                if current[key] > previous[key] * (1 + tolerance):
+                    regressions.append(f"{label}: {key} {current[key]}, baseline {previous[key]}")
+            if current["requests_per_second"] < previous["requests_per_second"] * (1 - tolerance):
+                regressions.append(f"{label}: {current['requests_per_second']} requests/s, "
+                                   f"baseline {previous['requests_per_second']}")
+    return regressions
@@ -0,0 +1,99 @@
+"""
+The dispute queue support staff work through.
+
+`queue` pages through the disputes of a stage oldest first, on the
+(stage, created_date) index so a page costs the same however long the
+backlog is. `assign` and `resolve` act on a batch of disputes with one
+UPDATE each, and `resolve` can refund or settle the disputed escrows in the
+same transaction
+"""
+import uuid
+
+from django.db import transaction
+from django.utils import timezone
+
+from esgrow_backend import outbox, settlement, summaries, transitions
+from esgrow_backend.models import Disputes, DisputeStage, DisputeOutcome, TransactionStage, EventKind
+from esgrow_backend.pagination import keyset_paginate
+
+OPEN_STAGES = (DisputeStage.Pending, DisputeStage.Disputed)
+
+
+def queue(queryset, stage: str = DisputeStage.Pending, assigned_to: uuid.UUID = None, unassigned: bool = False,
+          cursor: str = None, limit: int = 50):
+    """
+    A page of the disputes of `queryset` in `stage`, oldest first, and the
+    cursor of the next page
+    """
+    queryset = queryset.filter(stage=stage)
+    if assigned_to is not None:
+        queryset = queryset.filter(assigned_to_id=assigned_to)
+    elif unassigned:
+        queryset = queryset.filter(assigned_to__isnull=True)
+    return keyset_paginate(queryset, cursor, limit, key_field="dispute_id", oldest_first=True)
+
+
+def assign(dispute_ids: list[uuid.UUID], user_id: uuid.UUID | None) -> list[uuid.UUID]:
+    """
+    Assign the unresolved disputes of `dispute_ids` to `user_id` (None
+    unassigns them), returns the ids of the disputes assigned
+    """
+    with transaction.atomic():
+        assigned = list(Disputes.objects.select_for_update()
+                        .filter(dispute_id__in=dispute_ids, stage__in=OPEN_STAGES)
+                        .values_list("dispute_id", flat=True))
+        if assigned:
+            Disputes.objects.filter(dispute_id__in=assigned).update(assigned_to_id=user_id,
+                                                                   modified_date=timezone.now())
+    return assigned
+
+
+def resolve(dispute_ids: list[uuid.UUID], user_id: uuid.UUID, outcome: str = "",
+            resolution: str = "") -> tuple[list[uuid.UUID], set[uuid.UUID]]:
+    """
+    Resolve the unresolved disputes of `dispute_ids` on behalf of `user_id`.
+
+    With a `DisputeOutcome.Settled` outcome their cancelled escrows are
+    completed and paid to the receiving users, with `Refunded` they stay
+    cancelled as their amounts never left the paying users. Raises
+    `transitions.IllegalTransition`, leaving every dispute unresolved, if an
+    escrow can't get the outcome.
+
+    Returns the ids of the disputes resolved and of the escrows settled
+    """
+    with transaction.atomic():
+        rows = list(Disputes.objects.select_for_update()
+                    .filter(dispute_id__in=dispute_ids, stage__in=OPEN_STAGES).order_by("dispute_id")
+                    .values_list("dispute_id", "transaction_id", "transaction__from_user_id",
+                                 "transaction__to_user_id", "transaction__amount", "transaction__stage"))
+        if not rows:
+            return [], set()
+
+        resolved = [dispute_id for dispute_id, *_ in rows]
+        now = timezone.now()
+        Disputes.objects.filter(dispute_id__in=resolved).update(
+            stage=DisputeStage.Resolved,
+            outcome=outcome,
+            resolution=resolution,
+            resolved_by_id=user_id,
+            resolved_date=now,
+            modified_date=now,
+        )
+
+        # an escrow may have more than one dispute
+        escrows = {transaction_id: (transaction_id, from_user_id, to_user_id, amount, stage)
+                   for _, transaction_id, from_user_id, to_user_id, amount, stage in rows}
+        closed = [(from_user_id, to_user_id, True, False) for _, _, from_user_id, to_user_id, _, _ in rows]
+        outbox.insert([outbox.event(EventKind.DisputeResolved, transaction_id, from_user_id, to_user_id, amount,
+                                    dispute_id=dispute_id, outcome=outcome)
+                       for dispute_id, transaction_id, from_user_id, to_user_id, amount, _ in rows])
+        if outcome == DisputeOutcome.Settled:
+            settlement.settle(escrows.values(), user_id=user_id, disputes=closed)
+            return resolved, set(escrows)
+
+        completed = [transaction_id for transaction_id, *_, stage in escrows.values()
+                     if stage == TransactionStage.Completed]
+        if outcome == DisputeOutcome.Refunded and completed:
+            raise transitions.IllegalTransition(completed, TransactionStage.Cancelled, TransactionStage.Completed)
+        summaries.record(disputes=closed)
+    return resolved, set()
@@ -0,0 +1,113 @@
+import csv
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router
+from django.db.models import Q, QuerySet
+
+from esgrow_backend.models import User, EscrowTransactions, MonetaryTransactions, Disputes
+
+# rows are read from the database this many at a time
+CHUNK_SIZE = 2000
+
+
+class Export:
+    def __init__(self, columns: tuple[str, ...], queryset):
+        # (header, field lookup) pairs
+        self.columns = columns
+        self.queryset = queryset
+
+    @property
+    def headers(self) -> list[str]:
+        return [header for header, _ in self.columns]
+
+    def rows(self, user: User, everyone: bool = False, filters: Q = Q()):
+        queryset = self.queryset(user, everyone).filter(filters).order_by("created_date", "pk")
+        # the rows are streamed after the view returned, pick the database while the request's routing applies
+        queryset = queryset.using(router.db_for_read(queryset.model))
+        return queryset.values_list(*[lookup for _, lookup in self.columns]).iterator(chunk_size=CHUNK_SIZE)
+
+
+def user_escrows(user: User, everyone: bool) -> QuerySet:
+    if everyone:
+        return EscrowTransactions.objects.all()
+    return EscrowTransactions.objects.filter(Q(from_user=user) | Q(to_user=user))
+
+
+def user_monetary_transactions(user: User, everyone: bool) -> QuerySet:
+    if everyone:
+        return MonetaryTransactions.objects.all()
+    return MonetaryTransactions.objects.filter(user=user)
+
+
+def user_disputes(user: User, everyone: bool) -> QuerySet:
+    if everyone:
+        return Disputes.objects.all()
+    return Disputes.objects.filter(
+        Q(user_initiated=user) | Q(transaction__from_user=user) | Q(transaction__to_user=user))
+
+
+EXPORTS = {
+    "transactions": Export((
+        ("transaction_id", "transaction_id"),
+        ("created_date", "created_date"),
+        ("modified_date", "modified_date"),
+        ("from_user_id", "from_user_id"),
+        ("from_username", "from_user__username"),
+        ("to_user_id", "to_user_id"),
+        ("to_username", "to_user__username"),
+        ("amount", "amount"),
+        ("stage", "stage"),
+        ("from_user_confirmed", "from_user_confirmed"),
+        ("to_user_confirmed", "to_user_confirmed"),
+        ("time_updated_on_users", "time_updated_on_users"),
+    ), user_escrows),
+    "monetary": Export((
+        ("transaction_id", "transaction_id"),
+        ("created_date", "created_date"),
+        ("user_id", "user_id"),
+        ("external_entity", "external_entity"),
+        ("external_reference", "external_reference"),
+        ("amount", "amount"),
+        ("stage", "stage"),
+        ("time_updated_on_users", "time_updated_on_users"),
+    ), user_monetary_transactions),
+    "disputes": Export((
+        ("dispute_id", "dispute_id"),
+        ("created_date", "created_date"),
+        ("modified_date", "modified_date"),
+        ("transaction_id", "transaction_id"),
+        ("user_initiated_id", "user_initiated_id"),
+        ("reason", "reason"),
+        ("stage", "stage"),
+    ), user_disputes),
+}
+
+
+class Echo:
+    """
+    A file-like object whose write returns what is written, so csv.writer
+    can format one row at a time
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(headers: list[str], rows):
+    writer = csv.writer(Echo())
+    # the header goes out before the query runs
+    yield writer.writerow(headers)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(headers: list[str], rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(dict(zip(headers, row))) + "\n"
+
+
+FORMATS = {
+    "csv": ("text/csv", csv_lines),
+    "ndjson": ("application/x-ndjson", ndjson_lines),
+}
@@ -0,0 +1,48 @@
+"""
+Password hashers whose cost comes from settings, so it can be tuned per
+deployment without a code change.
+
+They keep the algorithm names of the Django hashers they extend, hashes
+made by either verify with both. When the configured cost differs from the
+one a hash was made with, `must_update` is true and Django rehashes the
+password the next time the user logs in
+"""
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class ScryptPasswordHasher(hashers.ScryptPasswordHasher):
+    @property
+    def work_factor(self) -> int:
+        return getattr(settings, "SCRYPT_WORK_FACTOR", 2 ** 14)
+
+    @property
+    def block_size(self) -> int:
+        return getattr(settings, "SCRYPT_BLOCK_SIZE", 8)
+
+    @property
+    def parallelism(self) -> int:
+        return getattr(settings, "SCRYPT_PARALLELISM", 1)
+
+    @property
+    def maxmem(self) -> int:
+        # scrypt needs 128 * n * r bytes per lane, leave room over OpenSSL's 32 MiB default
+        return 2 * 128 * self.work_factor * self.block_size * self.parallelism
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    """
+    Argon2id, needs the optional argon2-cffi package
+    """
+
+    @property
+    def time_cost(self) -> int:
+        return getattr(settings, "ARGON2_TIME_COST", 2)
+
+    @property
+    def memory_cost(self) -> int:
+        return getattr(settings, "ARGON2_MEMORY_COST", 19 * 1024)
+
+    @property
+    def parallelism(self) -> int:
+        return getattr(settings, "ARGON2_PARALLELISM", 1)
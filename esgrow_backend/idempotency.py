@@ -0,0 +1,250 @@
+"""
+`Idempotency-Key` support for the endpoints mobile clients retry.
+
+The first request with a key claims it by inserting an `IdempotencyKey`
+row, runs and stores its response in the row. A retry with the same key
+gets the stored response back without the view running, a retry arriving
+while the first request still runs waits for it. Keys are per user and
+expire after IDEMPOTENCY_KEY_TTL seconds, see the expire_idempotency_keys
+command
+"""
+import asyncio
+import datetime
+import functools
+import hashlib
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from esgrow_backend import renderers, utils
+from esgrow_backend.models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+# how long a retry polls for the first request to finish
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 0.5
+
+
+def ttl() -> datetime.timedelta:
+    return datetime.timedelta(seconds=getattr(settings, "IDEMPOTENCY_KEY_TTL", 24 * 60 * 60))
+
+
+def lock_timeout() -> datetime.timedelta:
+    """
+    A key claimed longer ago than this without a response belongs to a
+    request that died, a retry takes it over
+    """
+    return datetime.timedelta(seconds=getattr(settings, "IDEMPOTENCY_LOCK_TIMEOUT", 30))
+
+
+def wait_timeout() -> float:
+    return getattr(settings, "IDEMPOTENCY_WAIT_TIMEOUT", 10)
+
+
+def fingerprint(method: str, path: str, body: bytes) -> str:
+    digest = hashlib.sha256(f"{method} {path}\n".encode())
+    digest.update(body)
+    return digest.hexdigest()
+
+
+class Outcome:
+    """
+    What to do with a request carrying a key: run it (`record` is the
+    claimed row) or answer it with `status_code` and `data`
+    """
+
+    def __init__(self, record: IdempotencyKey = None, status_code: int = None, data=None, replayed=False):
+        self.record = record
+        self.status_code = status_code
+        self.data = data
+        self.replayed = replayed
+
+
+def error(status_code: int, message: str) -> Outcome:
+    return Outcome(status_code=status_code,
+                   data=utils.envelope(status_code=status_code, errors={"idempotency_key": [message]}))
+
+
+def attempt(user, key: str, request_fingerprint: str) -> Outcome | None:
+    """
+    Try to claim `key` for a request. Returns None while another request
+    holds the key and hasn't finished yet
+    """
+    if len(key) > MAX_KEY_LENGTH:
+        return error(status.HTTP_400_BAD_REQUEST, f"Must be at most {MAX_KEY_LENGTH} characters")
+
+    while True:
+        try:
+            with transaction.atomic():
+                return Outcome(record=IdempotencyKey.objects.create(user=user, key=key,
+                                                                    fingerprint=request_fingerprint))
+        except IntegrityError:
+            pass
+
+        existing = IdempotencyKey.objects.filter(user=user, key=key).first()
+        if existing is None:
+            # expired and deleted in the meantime
+            continue
+        now = timezone.now()
+        if existing.created_date < now - ttl():
+            IdempotencyKey.objects.filter(pk=existing.pk, created_date=existing.created_date).delete()
+            continue
+        if existing.fingerprint != request_fingerprint:
+            return error(status.HTTP_422_UNPROCESSABLE_ENTITY, "Key was already used for a different request")
+        if existing.response_status is not None:
+            return Outcome(status_code=existing.response_status, data=existing.response_data, replayed=True)
+        if existing.created_date < now - lock_timeout():
+            # the request holding it died, take it over unless another retry just did
+            if IdempotencyKey.objects.filter(pk=existing.pk, created_date=existing.created_date,
+                                             response_status__isnull=True).update(created_date=now):
+                existing.created_date = now
+                return Outcome(record=existing)
+            continue
+        return None
+
+
+def in_progress() -> Outcome:
+    return error(status.HTTP_409_CONFLICT, "A request with this key is still being processed, retry later")
+
+
+def claim(user, key: str, request_fingerprint: str) -> Outcome:
+    """
+    Claim `key` for a request, or wait for the request that already holds it
+    and return its response
+    """
+    deadline = time.monotonic() + wait_timeout()
+    interval = POLL_INTERVAL
+    while (outcome := attempt(user, key, request_fingerprint)) is None:
+        if time.monotonic() >= deadline:
+            return in_progress()
+        time.sleep(interval)
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+    return outcome
+
+
+async def aclaim(user, key: str, request_fingerprint: str) -> Outcome:
+    """
+    Async version of `claim`, waits without holding a thread
+    """
+    deadline = time.monotonic() + wait_timeout()
+    interval = POLL_INTERVAL
+    while (outcome := await sync_to_async(attempt)(user, key, request_fingerprint)) is None:
+        if time.monotonic() >= deadline:
+            return in_progress()
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+    return outcome
+
+
+def store(record: IdempotencyKey, status_code: int, data):
+    IdempotencyKey.objects.filter(pk=record.pk).update(response_status=status_code, response_data=data)
+
+
+def release(record: IdempotencyKey):
+    """
+    Give the key up so a retry runs the request again
+    """
+    IdempotencyKey.objects.filter(pk=record.pk).delete()
+
+
+def expire() -> int:
+    """
+    Delete the keys older than IDEMPOTENCY_KEY_TTL, returns how many
+    """
+    deleted, _ = IdempotencyKey.objects.filter(created_date__lt=timezone.now() - ttl()).delete()
+    return deleted
+
+
+def idempotent(view):
+    """
+    Make a Django REST framework view (function or method, see
+    `method_decorator`) honour the Idempotency-Key header.
+
+    The view and the storing of its response commit together, so a request
+    is either done and answered from the key or not done at all. Server
+    errors are rolled back and release the key, so they can be retried
+    """
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view(request, *args, **kwargs)
+
+        outcome = claim(request.user, key, fingerprint(request.method, request.path, request.body))
+        if outcome.record is None:
+            response = utils.enveloped_response(outcome.data, outcome.status_code)
+            if outcome.replayed:
+                response[REPLAYED_HEADER] = "true"
+            return response
+
+        try:
+            with transaction.atomic():
+                response = view(request, *args, **kwargs)
+                if response.status_code >= 500:
+                    transaction.set_rollback(True)
+                else:
+                    # round trip through JSON, so a replay is rendered from the same data as the original
+                    store(outcome.record, response.status_code,
+                          renderers.loads(renderers.dumps(utils.response_envelope(response))))
+        except APIException as e:
+            # errors the view raises are replayed like the responses it returns
+            if e.status_code >= 500:
+                release(outcome.record)
+            else:
+                store(outcome.record, e.status_code, renderers.loads(renderers.dumps(utils.exception_envelope(e))))
+            raise
+        except BaseException:
+            release(outcome.record)
+            raise
+        if response.status_code >= 500:
+            release(outcome.record)
+        return response
+
+    return wrapper
+
+
+def aidempotent(view):
+    """
+    `idempotent` for the async views returning JSON.
+
+    The async ORM can't hold a transaction across the view, a request that
+    dies between the view's writes and storing the response is run again by
+    a retry once IDEMPOTENCY_LOCK_TIMEOUT has passed
+    """
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return await view(request, *args, **kwargs)
+
+        outcome = await aclaim(request.user, key, fingerprint(request.method, request.path, request.body))
+        if outcome.record is None:
+            response = HttpResponse(renderers.dumps(outcome.data), status=outcome.status_code,
+                                    content_type="application/json")
+            if outcome.replayed:
+                response[REPLAYED_HEADER] = "true"
+            return response
+
+        try:
+            response = await view(request, *args, **kwargs)
+        except BaseException:
+            await sync_to_async(release)(outcome.record)
+            raise
+        if response.status_code >= 500:
+            await sync_to_async(release)(outcome.record)
+        else:
+            await sync_to_async(store)(outcome.record, response.status_code, renderers.loads(response.content))
+        return response
+
+    return wrapper
@@ -0,0 +1,151 @@
+import datetime
+import uuid
+from decimal import Decimal
+
+from django.db.models import Case, F, OuterRef, Subquery, Sum, When
+from django.utils import timezone
+
+from esgrow_backend.models import User, LedgerEntry, BalanceSnapshot
+
+# Snapshots leave out the most recent entries so a transaction that is still
+# in flight when the snapshot is taken can't commit an entry behind it
+SNAPSHOT_LAG = datetime.timedelta(minutes=1)
+
+
+def apply_balance_deltas(deltas: dict, batch_size: int = 500):
+    """
+    Add each delta to the balance of the user it is keyed by, with one
+    UPDATE per `batch_size` users.
+
+    Must be called inside an atomic block, the rows are locked in primary
+    key order first
+    """
+    deltas = {user_id: delta for user_id, delta in deltas.items() if delta and user_id is not None}
+    user_ids = sorted(deltas)
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        list(User.objects.select_for_update().filter(id__in=batch).order_by("id").values_list("id", flat=True))
+        User.objects.filter(id__in=batch).update(
+            balance=Case(*[When(id=user_id, then=F("balance") + deltas[user_id]) for user_id in batch],
+                         default=F("balance")))
+
+
+def post(deltas: dict, kind: str, **references) -> list[LedgerEntry]:
+    """
+    Record a posting in the ledger and apply it to the materialized user
+    balances.
+
+    `deltas` maps user ids to the amount their balance changes by, the key
+    None is the external account. The amounts must sum to zero.
+    `references` are the escrow_transaction_id/monetary_transaction_id the
+    posting originates from.
+
+    Must be called inside an atomic block
+    """
+    return post_many([(deltas, kind, references)])
+
+
+def post_many(postings: list[tuple[dict, str, dict]]) -> list[LedgerEntry]:
+    """
+    Record several `(deltas, kind, references)` postings at once, see `post`.
+
+    The balance changes are netted per user first so every user row is
+    updated once however many postings touch it
+    """
+    entries, totals = [], {}
+    for deltas, kind, references in postings:
+        deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+        if sum(deltas.values(), Decimal(0)) != 0:
+            raise ValueError("Ledger postings must balance")
+        posting_id = uuid.uuid4()
+        for user_id, amount in deltas.items():
+            entries.append(LedgerEntry(posting_id=posting_id, user_id=user_id, amount=amount, kind=kind,
+                                       **references))
+            totals[user_id] = totals.get(user_id, 0) + amount
+    if not entries:
+        return []
+
+    apply_balance_deltas(totals)
+    return LedgerEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+def balance_as_of(user_id: uuid.UUID, when: datetime.datetime) -> Decimal:
+    """
+    The balance of a user at `when`, read from the latest snapshot before it
+    plus the entries since, without touching the User row
+    """
+    snapshot = BalanceSnapshot.objects.filter(user_id=user_id, as_of__lte=when).order_by("-as_of").first()
+    entries = LedgerEntry.objects.filter(user_id=user_id, created_date__lte=when)
+    balance = Decimal(0)
+    if snapshot is not None:
+        entries = entries.filter(created_date__gt=snapshot.as_of)
+        balance = snapshot.balance
+    return balance + (entries.aggregate(total=Sum("amount"))["total"] or 0)
+
+
+def balances_as_of(user_ids: list[uuid.UUID], when: datetime.datetime) -> dict[uuid.UUID, Decimal]:
+    """
+    `balance_as_of` for a batch of users with two queries: their latest
+    snapshots up to the last checkpoint before `when`, and their entries
+    since that checkpoint. A user's latest snapshot holds at every later
+    checkpoint, `take_snapshots` writes one for each user with new entries
+    """
+    balances = dict.fromkeys(user_ids, Decimal(0))
+    entries = LedgerEntry.objects.filter(user_id__in=user_ids, created_date__lte=when)
+    checkpoint = BalanceSnapshot.objects.filter(as_of__lte=when).order_by("-as_of") \
+        .values_list("as_of", flat=True).first()
+    if checkpoint is not None:
+        latest = BalanceSnapshot.objects.filter(user_id=OuterRef("pk"), as_of__lte=checkpoint) \
+            .order_by("-as_of").values("balance")[:1]
+        for user_id, balance in User.objects.filter(id__in=user_ids).annotate(snapshot=Subquery(latest)) \
+                .values_list("id", "snapshot"):
+            balances[user_id] = balance or Decimal(0)
+        entries = entries.filter(created_date__gt=checkpoint)
+    for user_id, total in entries.values("user_id").annotate(total=Sum("amount")).order_by() \
+            .values_list("user_id", "total"):
+        balances[user_id] += total
+    return balances
+
+
+def take_snapshots(as_of: datetime.datetime = None) -> int:
+    """
+    Checkpoint the balance of every user with ledger entries since the last
+    checkpoint, returns the number of snapshots written
+    """
+    if as_of is None:
+        as_of = timezone.now() - SNAPSHOT_LAG
+    last = BalanceSnapshot.objects.order_by("-as_of").values_list("as_of", flat=True).first()
+    if last is not None and last >= as_of:
+        return 0
+
+    entries = LedgerEntry.objects.filter(user__isnull=False, created_date__lte=as_of)
+    if last is not None:
+        entries = entries.filter(created_date__gt=last)
+    deltas = list(entries.values("user_id").annotate(total=Sum("amount")).order_by())
+
+    previous = BalanceSnapshot.objects.filter(user_id=OuterRef("pk")).order_by("-as_of").values("balance")[:1]
+    opening = dict(User.objects.filter(id__in=[row["user_id"] for row in deltas])
+                   .annotate(previous=Subquery(previous)).values_list("id", "previous"))
+
+    snapshots = BalanceSnapshot.objects.bulk_create([
+        BalanceSnapshot(user_id=row["user_id"], as_of=as_of,
+                        balance=(opening.get(row["user_id"]) or 0) + row["total"])
+        for row in deltas
+    ], batch_size=1000)
+    return len(snapshots)
+
+
+def reconcile() -> dict:
+    """
+    Compare every materialized User.balance with the sum of its ledger
+    entries, returns {user_id: (balance, ledger_total)} for the ones that
+    differ
+    """
+    totals = LedgerEntry.objects.filter(user_id=OuterRef("pk")).order_by().values("user_id") \
+        .annotate(total=Sum("amount")).values("total")
+    mismatches = {}
+    for user_id, balance, total in User.objects.annotate(total=Subquery(totals)) \
+            .values_list("id", "balance", "total").iterator(chunk_size=2000):
+        if balance != (total or 0):
+            mismatches[user_id] = (balance, total or Decimal(0))
+    return mismatches
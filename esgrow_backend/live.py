@@ -0,0 +1,167 @@
+"""
+Live updates of a user's escrows and disputes, for the event stream and
+long-poll endpoints of `esgrow_backend.asgi`.
+
+The outbox (`esgrow_backend.outbox`) is the source of the events. One
+`Notifier` per worker process reads the new outbox rows with a single query
+and hands each event to the open subscriptions of its two parties, so an
+idle connection costs a queue and a sleeping task, not a query. It reads
+as soon as a transaction of this process commits events (`notify`), and
+every SSE_POLL_INTERVAL seconds for the events of other processes, like the
+settlement worker and the other web workers.
+
+Events are numbered by their outbox id. A client reconnecting with the last
+id it saw gets what it missed from the table (`catch_up`), so a slow client
+whose queue overflowed is disconnected rather than buffered without end.
+On PostgreSQL a transaction can commit an id below one already read, the
+event then only reaches clients that catch up past it, the stream is a
+signal to refresh rather than the record of the escrows
+"""
+import asyncio
+import logging
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError, close_old_connections
+from django.db.models import Q
+
+from esgrow_backend import outbox, renderers
+from esgrow_backend.models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """
+    The events of one user for one connection, in a bounded queue
+    """
+
+    def __init__(self, user_id: uuid.UUID, max_size: int):
+        self.user_id = str(user_id)
+        self.queue = asyncio.Queue(max_size)
+        # the id of the last event the client was sent
+        self.last_event_id = 0
+        # events were dropped, the client has to catch up from the table
+        self.overflowed = False
+
+    def put(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def sent(self, event: dict) -> bool:
+        """
+        Whether `event` was sent already, marks it sent otherwise
+        """
+        if event["id"] <= self.last_event_id:
+            return True
+        self.last_event_id = event["id"]
+        return False
+
+
+class Notifier:
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        # the id of the last outbox event read
+        self.last_event_id = 0
+        self._loop = None
+        self._wake = None
+        self._task = None
+
+    async def subscribe(self, user_id: uuid.UUID) -> Subscription:
+        """
+        Subscribe to the events of `user_id` after the last one read, starting
+        the poller of this event loop if it isn't running
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # the subscriptions and poller of a previous loop died with it
+            self._loop, self._wake, self._task = loop, asyncio.Event(), None
+            self.subscriptions.clear()
+        if self._task is None:
+            # events from before the first subscription aren't wanted
+            last_event_id = (await OutboxEvent.objects.order_by("-event_id")
+                             .values_list("event_id", flat=True).afirst()) or 0
+            # another subscription may have started it meanwhile
+            if self._task is None:
+                self.last_event_id = last_event_id
+                self._task = loop.create_task(self.run())
+        subscription = Subscription(user_id, getattr(settings, "SSE_QUEUE_SIZE", 100))
+        subscription.last_event_id = self.last_event_id
+        self.subscriptions[subscription.user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+
+    def notify(self):
+        """
+        Read the outbox now, callable from any thread
+        """
+        loop, wake = self._loop, self._wake
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(wake.set)
+        except RuntimeError:
+            # the loop closed in between
+            pass
+
+    async def run(self):
+        interval = getattr(settings, "SSE_POLL_INTERVAL", 1.0)
+        try:
+            while self.subscriptions:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), interval)
+                except TimeoutError:
+                    pass
+                self._wake.clear()
+                try:
+                    while await self.poll():
+                        pass
+                except DatabaseError:
+                    # the subscriptions wait for the next poll, on a new connection if this one broke
+                    logger.exception("Reading the outbox failed")
+                    await sync_to_async(close_old_connections)()
+        finally:
+            self._task = None
+
+    async def poll(self, batch_size: int = 1000) -> bool:
+        """
+        Hand the new outbox events to their parties' subscriptions, returns
+        whether there may be more
+        """
+        events = [event async for event in OutboxEvent.objects.filter(event_id__gt=self.last_event_id)
+                  .order_by("event_id")[:batch_size]]
+        for event in events:
+            data = outbox.serialize(event)
+            for user_id in {event.payload["from_user_id"], event.payload["to_user_id"]}:
+                for subscription in self.subscriptions.get(user_id, ()):
+                    subscription.put(data)
+        if events:
+            self.last_event_id = events[-1].event_id
+        return len(events) == batch_size
+
+
+notifier = Notifier()
+
+
+async def catch_up(user_id: uuid.UUID, after: int, limit: int) -> list[dict]:
+    """
+    The first `limit` events of the escrows of `user_id` after the id
+    `after`, from the table
+    """
+    events = OutboxEvent.objects.filter(Q(transaction__from_user_id=user_id) | Q(transaction__to_user_id=user_id),
+                                        event_id__gt=after).order_by("event_id")[:limit]
+    return [outbox.serialize(event) async for event in events]
+
+
+def format_event(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {renderers.dumps(event).decode()}\n\n"
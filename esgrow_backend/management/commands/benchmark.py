@@ -0,0 +1,86 @@
+import json
+import pathlib
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from esgrow_backend import benchmarks
+
+DEFAULT_BASELINE = pathlib.Path(settings.BASE_DIR) / "benchmarks" / "baseline.json"
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the API in process against a throwaway database seeded with synthetic data, through "
+            "the sync (WSGI) and async (ASGI) views, and compare the results with a stored baseline")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--escrows", type=int, default=20000)
+        parser.add_argument("--disputes", type=int, default=500)
+        parser.add_argument("--monetary", type=int, default=2000, help="Deposits and withdrawals to seed")
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the data generator")
+        parser.add_argument("--requests", type=int, default=100, help="Requests per benchmark and mode")
+        parser.add_argument("--concurrency", type=int, default=1,
+                            help="Requests in flight at once, SQLite serializes the writes anyway")
+        parser.add_argument("--only", nargs="+", choices=list(benchmarks.BENCHMARKS), help="Benchmarks to run")
+        parser.add_argument("--modes", nargs="+", choices=list(benchmarks.MODES), default=list(benchmarks.MODES))
+        parser.add_argument("--baseline", default=str(DEFAULT_BASELINE),
+                            help="Results to compare against, skipped when the file doesn't exist")
+        parser.add_argument("--tolerance", type=float, default=0.25,
+                            help="Fraction latency and throughput may be worse than the baseline")
+        parser.add_argument("--save-baseline", action="store_true", help="Write the results to --baseline")
+        parser.add_argument("--output", help="Also write the results to this file")
+
+    def handle(self, *args, **options):
+        parameters = {key: options[key] for key in ("users", "escrows", "disputes", "monetary", "seed", "requests",
+                                                    "concurrency")}
+        setup_test_environment()
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            dataset = benchmarks.seed(options["users"], options["escrows"], options["disputes"],
+                                      options["monetary"], options["seed"])
+            results = {}
+            # every request comes from one client, measure the endpoints rather than their throttles
+            with override_settings(THROTTLE_RATES={}, SHED_MAX_IN_FLIGHT=None, SHED_DB_LATENCY_MS=None):
+                for name in options["only"] or benchmarks.BENCHMARKS:
+                    results[name] = {}
+                    for mode in options["modes"]:
+                        self.stderr.write(f"Running {name} ({mode})")
+                        try:
+                            results[name][mode] = benchmarks.run(name, mode, dataset, options["requests"],
+                                                                 options["concurrency"])
+                        except benchmarks.BenchmarkError as e:
+                            raise CommandError(f"{name} ({mode}): {e}")
+            renderer_rates = benchmarks.renderer_rates()
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {"parameters": parameters, "results": results,
+                  "password_hashers": benchmarks.password_hash_rates(), "renderers": renderer_rates}
+        output = json.dumps(report, indent=2)
+        self.stdout.write(output)
+        if options["output"]:
+            pathlib.Path(options["output"]).write_text(output + "\n")
+
+        baseline_path = pathlib.Path(options["baseline"])
+        if options["save_baseline"]:
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(output + "\n")
+            self.stderr.write(f"Saved the baseline to {baseline_path}")
+        elif baseline_path.exists():
+            baseline = json.loads(baseline_path.read_text())
+            if baseline.get("parameters") != parameters:
+                self.stderr.write(f"The baseline was recorded with {baseline.get('parameters')}, "
+                                  "the comparison is only indicative")
+            regressions = benchmarks.compare(baseline, report, options["tolerance"])
+            for regression in regressions:
+                self.stderr.write(regression)
+            if regressions:
+                raise CommandError(f"{len(regressions)} regressions against {baseline_path}")
+            self.stderr.write(f"No regressions against {baseline_path}")
@@ -0,0 +1,40 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from esgrow_backend import webhooks
+
+
+class Command(BaseCommand):
+    help = ("Deliver the outbox events to the webhook endpoints, in batches until nothing is due "
+            "or forever with --follow")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=getattr(settings, "WEBHOOK_BATCH_SIZE", 1000))
+        parser.add_argument("--follow", action="store_true",
+                            help="Keep polling the outbox instead of exiting once nothing is due")
+        parser.add_argument("--interval", type=float, default=1.0,
+                            help="Seconds to wait between polls of an idle outbox with --follow")
+
+    def handle(self, *args, **options):
+        pool = webhooks.ConnectionPool(timeout=getattr(settings, "WEBHOOK_TIMEOUT", 10))
+        delivered = failed = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                counts = webhooks.dispatch(pool, options["batch_size"])
+                if any(counts.values()):
+                    delivered += counts["delivered"]
+                    failed += counts["failed"]
+                    elapsed = time.perf_counter() - start
+                    self.stdout.write(f"Fanned out {counts['fanned_out']}, delivered {counts['delivered']} "
+                                      f"and failed {counts['failed']} deliveries in {elapsed * 1000:.1f}ms")
+                    continue
+                if not options["follow"]:
+                    break
+                time.sleep(options["interval"])
+        finally:
+            pool.close()
+        self.stdout.write(f"Delivered {delivered} and failed {failed} deliveries, "
+                          f"{webhooks.pending()} waiting for a retry")
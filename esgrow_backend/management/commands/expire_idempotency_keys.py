@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from esgrow_backend import idempotency
+
+
+class Command(BaseCommand):
+    help = "Delete the stored responses of Idempotency-Key requests older than IDEMPOTENCY_KEY_TTL, run periodically"
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Deleted {idempotency.expire()} idempotency keys")
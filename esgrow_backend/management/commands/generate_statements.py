@@ -0,0 +1,41 @@
+import datetime
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from esgrow_backend import statements
+
+
+class Command(BaseCommand):
+    help = ("Write every user's monthly statements, opening balance, ledger entries and closing balance, "
+            "as gzipped CSV files per month and user shard. Rerunning resumes an interrupted run")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="first", help="First month, YYYY-MM, defaults to last month")
+        parser.add_argument("--to", dest="last", help="Last month, YYYY-MM, defaults to --from")
+        parser.add_argument("--output", default="statements", help="Directory to write the statements to")
+        parser.add_argument("--shards", type=int, default=16,
+                            help="Ranges of users worked on separately, fixed by the first run into --output")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="Processes working on the shards, 1 works in this process")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Users read from the ledger at once")
+
+    def handle(self, *args, **options):
+        first = options["first"] or (timezone.localdate().replace(day=1) - datetime.timedelta(days=1)).strftime("%Y-%m")
+        last = options["last"] or first
+        try:
+            labels = statements.months(first, last)
+        except ValueError:
+            raise CommandError("--from and --to must be YYYY-MM months")
+        if not labels:
+            raise CommandError("--to is before --from")
+
+        report = statements.generate(options["output"], first, last, shards=options["shards"],
+                                     workers=min(options["workers"], options["shards"]),
+                                     chunk_size=options["chunk_size"])
+        self.stdout.write(
+            f"Wrote {report['statements']} statements with {report['entries']} entries "
+            f"({report['bytes'] / 1024 / 1024:.1f}MB) for {report['months']} months in {report['seconds']}s: "
+            f"{report['statements_per_second']} statements/s, {report['entries_per_second']} entries/s. "
+            f"Resumed {report['resumed']} of {report['months'] * report['shards']} shard months")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from esgrow_backend.models import User
+from esgrow_backend.search import index_user
+
+
+class Command(BaseCommand):
+    help = "Rebuild the user search tokens, e.g. after changing how users are tokenized"
+
+    def handle(self, *args, **options):
+        count = 0
+        for user in User.objects.only("id", "username", "first_name", "last_name").iterator(chunk_size=2000):
+            index_user(user)
+            count += 1
+        self.stdout.write(f"Indexed {count} users")
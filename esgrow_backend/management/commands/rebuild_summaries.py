@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from esgrow_backend import summaries
+
+
+class Command(BaseCommand):
+    help = ("Recompute every user's dashboard summary from the escrows and disputes and store the ones that "
+            "drifted from the incrementally maintained totals")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true",
+                            help="Only report drifted summaries, failing if there are any")
+
+    def handle(self, *args, **options):
+        if options["check"]:
+            drifted = summaries.drifted()
+            for summary in drifted:
+                self.stderr.write(f"Summary of {summary.user_id} drifted")
+            if drifted:
+                raise CommandError(f"{len(drifted)} summaries drifted")
+            self.stdout.write("Every summary is up to date")
+            return
+        self.stdout.write(f"Rebuilt {summaries.rebuild()} summaries")
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from esgrow_backend import settlement
+
+
+class Command(BaseCommand):
+    help = ("Settle the escrows queued by confirmations when SETTLEMENT_DEFERRED is on, "
+            "in batches until the queue is empty or forever with --follow")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--follow", action="store_true",
+                            help="Keep polling the queue instead of exiting once it is empty")
+        parser.add_argument("--interval", type=float, default=1.0,
+                            help="Seconds to wait between polls of an empty queue with --follow")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            start = time.perf_counter()
+            settled = settlement.settle_queued(options["batch_size"])
+            if settled:
+                total += len(settled)
+                elapsed = time.perf_counter() - start
+                self.stdout.write(f"Settled {len(settled)} transactions in {elapsed * 1000:.1f}ms")
+                continue
+            if not options["follow"]:
+                break
+            time.sleep(options["interval"])
+        self.stdout.write(f"Settled {total} transactions")
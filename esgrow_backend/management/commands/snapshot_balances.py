@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from esgrow_backend import ledger
+
+
+class Command(BaseCommand):
+    help = "Checkpoint user balances from the ledger, run periodically (e.g. from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--as-of", help="ISO 8601 time to snapshot at, defaults to a minute ago")
+        parser.add_argument("--reconcile", action="store_true",
+                            help="Also check every User.balance against its ledger entries")
+
+    def handle(self, *args, **options):
+        as_of = None
+        if options["as_of"]:
+            as_of = parse_datetime(options["as_of"])
+            if as_of is None:
+                raise CommandError("--as-of must be an ISO 8601 datetime")
+
+        written = ledger.take_snapshots(as_of)
+        self.stdout.write(f"Wrote {written} balance snapshots")
+
+        if options["reconcile"]:
+            mismatches = ledger.reconcile()
+            for user_id, (balance, total) in mismatches.items():
+                self.stderr.write(f"User {user_id}: balance {balance} but ledger total {total}")
+            if mismatches:
+                raise CommandError(f"{len(mismatches)} balances don't match the ledger")
+            self.stdout.write("All balances match the ledger")
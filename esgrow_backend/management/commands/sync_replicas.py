@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from esgrow_backend import routers, sqlite
+
+
+class Command(BaseCommand):
+    help = ("Copy the primary SQLite database into the replica files of DATABASE_REPLICAS, once or every "
+            "--interval seconds with --follow. A stand-in for replication when trying replicas locally")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--follow", action="store_true", help="Keep copying instead of exiting")
+        parser.add_argument("--interval", type=float, default=1.0,
+                            help="Seconds between copies with --follow, how far the replicas lag")
+
+    def handle(self, *args, **options):
+        aliases = routers.replicas()
+        if not aliases:
+            raise CommandError("No replicas configured, set ESGROW_DATABASE_REPLICAS")
+        while True:
+            for alias in aliases:
+                start = time.perf_counter()
+                try:
+                    sqlite.sync_replica(alias)
+                except ValueError as e:
+                    raise CommandError(str(e))
+                self.stdout.write(f"Synced {alias} in {(time.perf_counter() - start) * 1000:.1f}ms")
+            if not options["follow"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from esgrow_backend.webhook_stub import StubReceiver
+
+
+class Command(BaseCommand):
+    help = "Run a local webhook receiver printing the events it gets, to point a WebhookEndpoint at"
+
+    def add_arguments(self, parser):
+        parser.add_argument("secret", help="The secret of the endpoint")
+        parser.add_argument("--port", type=int, default=8900)
+        parser.add_argument("--fail", type=int, default=0, help="Answer 500 to this many requests first")
+
+    def handle(self, *args, **options):
+        with StubReceiver(options["secret"], port=options["port"], fail=options["fail"]) as receiver:
+            self.stdout.write(f"Receiving webhooks at {receiver.url}")
+            printed = 0
+            try:
+                while True:
+                    time.sleep(0.5)
+                    for event in receiver.events[printed:]:
+                        self.stdout.write(f"{event['id']} {event['type']} {event['data']['transaction_id']}")
+                    printed = len(receiver.events)
+            except KeyboardInterrupt:
+                pass
+        self.stdout.write(f"Received {len(receiver.events)} events, rejected {receiver.rejected} requests")
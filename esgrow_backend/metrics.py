@@ -0,0 +1,271 @@
+"""
+Per view latency, query and response size metrics, exposed in the
+Prometheus text format on /metrics.
+
+`InstrumentationMiddleware` starts a `RequestStats` for every request, the
+database wrapper installed on each connection and the app's serializers
+(`timed_serialization`) add to it, and the middleware records it against
+the url name of the view once the response is ready. Metrics live in the
+worker process, so every worker is scraped on its own like the token cache
+is per process. Only METRICS_ALLOWED_IPS and holders of METRICS_TOKEN may
+read them
+"""
+import bisect
+import contextlib
+import contextvars
+import hmac
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+slow_query_logger = logging.getLogger("esgrow_backend.slow_queries")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+# requests that didn't resolve to a named url
+UNMATCHED = "unmatched"
+
+
+@dataclass
+class RequestStats:
+    view: str = UNMATCHED
+    queries: int = 0
+    query_time: float = 0.0
+    serializer_time: float = 0.0
+    serializing: bool = False
+    slow_queries: int = 0
+
+
+current_request: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar("current_request",
+                                                                                       default=None)
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # label value -> ([count per bucket], sum, count)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label: str, value: float):
+        with self._lock:
+            counts, total, count = self._series.get(label) or ([0] * len(self.buckets), 0.0, 0)
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            self._series[label] = (counts, total + value, count + 1)
+
+    def totals(self, label: str) -> tuple[float, int]:
+        """
+        The sum and count of the values observed for `label`
+        """
+        with self._lock:
+            _, total, count = self._series.get(label, (None, 0, 0))
+            return total, count
+
+    def lines(self, label_name: str):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = sorted((label, (list(counts), total, count))
+                            for label, (counts, total, count) in self._series.items())
+        for label, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}'
+            yield f'{self.name}_bucket{{{label_name}="{label}",le="+Inf"}} {count}'
+            yield f'{self.name}_sum{{{label_name}="{label}"}} {total}'
+            yield f'{self.name}_count{{{label_name}="{label}"}} {count}'
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        # tuple of label pairs -> value
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple, amount: int = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            rendered = ",".join(f'{name}="{label}"' for name, label in labels)
+            yield f"{self.name}{{{rendered}}} {value}"
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+request_duration = Histogram("esgrow_request_duration_seconds", "Time to produce the response.", LATENCY_BUCKETS)
+request_queries = Histogram("esgrow_request_db_queries", "Database queries per request.", QUERY_COUNT_BUCKETS)
+request_query_duration = Histogram("esgrow_request_db_duration_seconds", "Time spent in database queries.",
+                                   LATENCY_BUCKETS)
+request_serializer_duration = Histogram("esgrow_request_serializer_duration_seconds",
+                                        "Time spent producing serializer data.", LATENCY_BUCKETS)
+response_size = Histogram("esgrow_response_size_bytes", "Size of the (non streaming) response body.",
+                          SIZE_BUCKETS)
+responses = Counter("esgrow_responses_total", "Responses by status code.")
+slow_queries = Counter("esgrow_slow_queries_total", "Queries slower than SLOW_QUERY_THRESHOLD_MS.")
+
+HISTOGRAMS = (request_duration, request_queries, request_query_duration, request_serializer_duration,
+              response_size)
+COUNTERS = (responses, slow_queries)
+
+
+def record(request, response, stats: RequestStats, duration: float):
+    request_duration.observe(stats.view, duration)
+    request_queries.observe(stats.view, stats.queries)
+    request_query_duration.observe(stats.view, stats.query_time)
+    request_serializer_duration.observe(stats.view, stats.serializer_time)
+    if not response.streaming:
+        response_size.observe(stats.view, len(response.content))
+    responses.inc((("view", stats.view), ("status", str(response.status_code))))
+    if stats.slow_queries:
+        slow_queries.inc((("view", stats.view),), stats.slow_queries)
+
+
+def render() -> str:
+    from esgrow_backend.authentication import token_cache
+
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.lines("view"))
+    for counter in COUNTERS:
+        lines.extend(counter.lines())
+    for name, value in token_cache.stats().items():
+        lines.append(f"# TYPE esgrow_token_cache_{name} gauge")
+        lines.append(f"esgrow_token_cache_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def clear():
+    for metric in HISTOGRAMS + COUNTERS:
+        metric.clear()
+
+
+def instrument_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper adding every query to the stats of the current
+    request and logging the ones slower than SLOW_QUERY_THRESHOLD_MS
+    """
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_time += duration
+        threshold = getattr(settings, "SLOW_QUERY_THRESHOLD_MS", None)
+        if threshold is not None and duration * 1000 >= threshold:
+            if stats is not None:
+                stats.slow_queries += 1
+            slow_query_logger.warning("%.1fms %s: %s", duration * 1000,
+                                      stats.view if stats is not None else "-", sql)
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """
+    connection_created receiver, the wrapper stays on the connection for its
+    whole life so it also sees the queries of async views, which run in
+    another thread than the middleware
+    """
+    if instrument_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(instrument_query)
+
+
+@contextlib.contextmanager
+def timed_serialization():
+    """
+    Add the time of the block to the serializer time of the current request,
+    see `esgrow_backend.app_serializers.TimedSerializerMixin`. Serializers
+    nest, a block within another isn't counted again
+    """
+    stats = current_request.get()
+    if stats is None or stats.serializing:
+        yield
+        return
+    stats.serializing = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.serializer_time += time.perf_counter() - start
+        stats.serializing = False
+
+
+def scrape_allowed(request) -> bool:
+    """
+    Whether `request` may read the metrics: it comes from one of
+    METRICS_ALLOWED_IPS or has METRICS_TOKEN as bearer token
+    """
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if token and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return True
+    return request.META.get("REMOTE_ADDR") in getattr(settings, "METRICS_ALLOWED_IPS", ())
+
+
+class InstrumentationMiddleware:
+    """
+    Records the metrics of every request, put it first in MIDDLEWARE so the
+    rest of the stack is included in the latency
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = current_request.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        record(request, response, stats, time.perf_counter() - start)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # name the view early so the slow query log can say where queries come from
+        stats = current_request.get()
+        if stats is not None and request.resolver_match.url_name:
+            stats.view = request.resolver_match.url_name
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = current_request.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        record(request, response, stats, time.perf_counter() - start)
+        return response
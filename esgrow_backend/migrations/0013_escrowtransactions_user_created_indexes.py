@@ -0,0 +1,26 @@
+# Generated by Django 5.0.14 on 2026-10-18 14:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0012_disputes_created_date_disputes_modified_date"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="escrowtransactions",
+            index=models.Index(
+                fields=["from_user", "created_date"],
+                name="escrow_from_user_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="escrowtransactions",
+            index=models.Index(
+                fields=["to_user", "created_date"], name="escrow_to_user_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,138 @@
+# Generated by Django 5.0.14 on 2026-10-18 14:43
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+def open_ledger(apps, schema_editor):
+    """
+    Record the balances users already have as opening entries, so the
+    ledger of every user sums to their balance
+    """
+    User = apps.get_model("esgrow_backend", "User")
+    LedgerEntry = apps.get_model("esgrow_backend", "LedgerEntry")
+    posting_id = uuid.uuid4()
+    entries = []
+    for user_id, balance in User.objects.exclude(balance=0).values_list(
+        "id", "balance"
+    ):
+        entries.append(
+            LedgerEntry(
+                posting_id=posting_id, user_id=user_id, amount=balance, kind="Opening"
+            )
+        )
+        entries.append(
+            LedgerEntry(
+                posting_id=posting_id, user_id=None, amount=-balance, kind="Opening"
+            )
+        )
+    LedgerEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0013_escrowtransactions_user_created_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="monetarytransactions",
+            name="time_updated_on_users",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name="monetarytransactions",
+            name="updated_on_users",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name="BalanceSnapshot",
+            fields=[
+                (
+                    "snapshot_id",
+                    models.UUIDField(
+                        default=uuid.uuid4, primary_key=True, serialize=False
+                    ),
+                ),
+                ("balance", models.DecimalField(decimal_places=2, max_digits=100)),
+                ("as_of", models.DateTimeField()),
+                ("created_date", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.RESTRICT,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="LedgerEntry",
+            fields=[
+                ("entry_id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("posting_id", models.UUIDField(default=uuid.uuid4)),
+                ("amount", models.DecimalField(decimal_places=2, max_digits=100)),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("Opening", "Opening"),
+                            ("Escrow", "Escrow"),
+                            ("Deposit", "Deposit"),
+                            ("Withdrawal", "Withdrawal"),
+                        ],
+                        max_length=200,
+                    ),
+                ),
+                ("created_date", models.DateTimeField(auto_now_add=True)),
+                (
+                    "escrow_transaction",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.RESTRICT,
+                        related_name="+",
+                        to="esgrow_backend.escrowtransactions",
+                    ),
+                ),
+                (
+                    "monetary_transaction",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.RESTRICT,
+                        related_name="+",
+                        to="esgrow_backend.monetarytransactions",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.RESTRICT,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="balancesnapshot",
+            constraint=models.UniqueConstraint(
+                fields=("user", "as_of"), name="balance_snapshot_user_as_of_unique"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ledgerentry",
+            index=models.Index(
+                fields=["user", "created_date"], name="ledger_user_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ledgerentry",
+            index=models.Index(fields=["created_date"], name="ledger_created_idx"),
+        ),
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
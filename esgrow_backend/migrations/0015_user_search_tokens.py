@@ -0,0 +1,82 @@
+# Generated by Django 5.0.14 on 2026-10-18 14:47
+
+import re
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def index_users(apps, schema_editor):
+    """
+    Build the search tokens of existing users, as esgrow_backend.search
+    does when a user is saved
+    """
+    User = apps.get_model("esgrow_backend", "User")
+    UserSearchToken = apps.get_model("esgrow_backend", "UserSearchToken")
+    weights = {"username": 3, "first_name": 2, "last_name": 2}
+
+    batch = []
+    for user in User.objects.only(*weights).iterator(chunk_size=2000):
+        tokens = {}
+        for field, weight in weights.items():
+            for word in re.findall(r"\w+", (getattr(user, field) or "").lower()):
+                word = word[:200]
+                tokens[("Word", word)] = max(tokens.get(("Word", word), 0), weight)
+                for i in range(len(word) - 2):
+                    tokens[("Trigram", word[i : i + 3])] = 1
+        batch.extend(
+            UserSearchToken(user_id=user.pk, kind=kind, token=token, weight=weight)
+            for (kind, token), weight in tokens.items()
+        )
+        if len(batch) >= 5000:
+            UserSearchToken.objects.bulk_create(batch)
+            batch = []
+    UserSearchToken.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0014_ledger_entries_and_balance_snapshots"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserSearchToken",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token", models.CharField(max_length=200)),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("Word", "Word"), ("Trigram", "Trigram")],
+                        max_length=20,
+                    ),
+                ),
+                ("weight", models.PositiveSmallIntegerField(default=1)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["kind", "token"], name="search_kind_token_idx")
+                ],
+            },
+        ),
+        migrations.RunPython(index_users, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.14 on 2026-10-18 14:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0016_compliance_uploads"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="escrowtransactions",
+            name="settlement_ready_date",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name="escrowtransactions",
+            index=models.Index(
+                condition=models.Q(
+                    ("settlement_ready_date__isnull", False),
+                    ("updated_on_users", False),
+                ),
+                fields=["settlement_ready_date"],
+                name="escrow_settlement_queue_idx",
+            ),
+        ),
+    ]
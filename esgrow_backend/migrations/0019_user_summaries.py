@@ -0,0 +1,53 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0018_idempotency_keys"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserSummary",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="+",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("pending_in_count", models.IntegerField(default=0)),
+                (
+                    "pending_in_amount",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=100),
+                ),
+                ("pending_out_count", models.IntegerField(default=0)),
+                (
+                    "pending_out_amount",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=100),
+                ),
+                ("completed_in_count", models.IntegerField(default=0)),
+                (
+                    "completed_in_amount",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=100),
+                ),
+                ("completed_out_count", models.IntegerField(default=0)),
+                (
+                    "completed_out_amount",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=100),
+                ),
+                ("cancelled_count", models.IntegerField(default=0)),
+                ("open_disputes", models.IntegerField(default=0)),
+                ("modified_date", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0019_user_summaries"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EscrowStageChange",
+            fields=[
+                ("change_id", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "from_stage",
+                    models.CharField(
+                        choices=[
+                            ("Initiated", "Initiated"),
+                            ("Pending", "Pending"),
+                            ("Completed", "Completed"),
+                            ("Cancelled", "Cancelled"),
+                        ],
+                        max_length=200,
+                    ),
+                ),
+                (
+                    "to_stage",
+                    models.CharField(
+                        choices=[
+                            ("Initiated", "Initiated"),
+                            ("Pending", "Pending"),
+                            ("Completed", "Completed"),
+                            ("Cancelled", "Cancelled"),
+                        ],
+                        max_length=200,
+                    ),
+                ),
+                ("created_date", models.DateTimeField(auto_now_add=True)),
+                (
+                    "transaction",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.RESTRICT,
+                        related_name="+",
+                        to="esgrow_backend.escrowtransactions",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.RESTRICT,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0020_escrow_stage_changes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="disputes",
+            name="assigned_to",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddField(
+            model_name="disputes",
+            name="outcome",
+            field=models.CharField(
+                blank=True,
+                choices=[("Refunded", "Refunded"), ("Settled", "Settled")],
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="disputes",
+            name="resolution",
+            field=models.CharField(blank=True, max_length=300),
+        ),
+        migrations.AddField(
+            model_name="disputes",
+            name="resolved_by",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.RESTRICT,
+                related_name="+",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddField(
+            model_name="disputes",
+            name="resolved_date",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name="disputes",
+            index=models.Index(
+                fields=["stage", "created_date"], name="dispute_stage_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0022_webhook_outbox"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="outboxevent",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("escrow.created", "Escrow created"),
+                    ("escrow.confirmed", "Escrow confirmed"),
+                    ("escrow.completed", "Escrow completed"),
+                    ("escrow.disputed", "Escrow disputed"),
+                    ("dispute.resolved", "Dispute resolved"),
+                ],
+                max_length=50,
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0023_event_kinds"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="complianceupload",
+            name="lease_id",
+            field=models.UUIDField(null=True),
+        ),
+        migrations.AddField(
+            model_name="complianceupload",
+            name="lease_until",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
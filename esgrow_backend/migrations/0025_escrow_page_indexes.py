@@ -0,0 +1,35 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0024_upload_lease"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="escrowtransactions",
+            name="escrow_from_user_created_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="escrowtransactions",
+            name="escrow_to_user_created_idx",
+        ),
+        migrations.AddIndex(
+            model_name="escrowtransactions",
+            index=models.Index(
+                fields=["from_user", "created_date", "transaction_id"],
+                name="escrow_from_user_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="escrowtransactions",
+            index=models.Index(
+                fields=["to_user", "created_date", "transaction_id"],
+                name="escrow_to_user_created_idx",
+            ),
+        ),
+    ]
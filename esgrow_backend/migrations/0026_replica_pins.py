@@ -0,0 +1,23 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0025_escrow_page_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReplicaPin",
+            fields=[
+                (
+                    "key",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("until", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("esgrow_backend", "0026_replica_pins"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="user",
+            name="password",
+            field=models.CharField(max_length=128),
+        ),
+    ]
@@ -4,7 +4,8 @@ import uuid
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.conf import settings
-from django.db.models.signals import post_save, pre_save
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.signals import post_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
@@ -21,7 +22,7 @@ class User(AbstractUser):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4)
     email = models.EmailField()
     username = models.CharField(max_length=200, unique=True)
-    password = models.CharField(max_length=100)
+    password = models.CharField(max_length=128)
     created_date = models.DateTimeField(auto_now_add=True)
     modified_date = models.DateTimeField(auto_now=True)
     balance = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
@@ -49,6 +50,36 @@ class EscrowTransactions(models.Model):
     to_user_confirmed = models.BooleanField(default=False)
     to_user_confirmed_date = models.DateTimeField(null=True)
 
+    # when both users had confirmed and the transaction was queued for the
+    # settlement worker, see esgrow_backend.settlement.queue_transactions
+    settlement_ready_date = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            # keyset pagination of a user's transactions, newest first, in the
+            # (created_date, transaction_id) order of the pages
+            models.Index(fields=["from_user", "created_date", "transaction_id"], name="escrow_from_user_created_idx"),
+            models.Index(fields=["to_user", "created_date", "transaction_id"], name="escrow_to_user_created_idx"),
+            # the settlement queue, only holds the transactions waiting in it
+            models.Index(fields=["settlement_ready_date"], name="escrow_settlement_queue_idx",
+                         condition=models.Q(settlement_ready_date__isnull=False, updated_on_users=False)),
+        ]
+
+
+class EscrowStageChange(models.Model):
+    """
+    One move of an escrow from a stage to another, rows are only ever
+    inserted, by `esgrow_backend.transitions`
+    """
+    # monotonic so the changes of an escrow can be read back in order
+    change_id = models.BigAutoField(primary_key=True)
+    transaction = models.ForeignKey(EscrowTransactions, on_delete=models.RESTRICT, related_name="+")
+    from_stage = models.CharField(choices=TransactionStage.choices, max_length=200)
+    to_stage = models.CharField(choices=TransactionStage.choices, max_length=200)
+    # the user whose request moved the escrow, none for settlement
+    user = models.ForeignKey(User, on_delete=models.RESTRICT, null=True, related_name="+")
+    created_date = models.DateTimeField(auto_now_add=True)
+
 
 class MonetaryTransactions(models.Model):
     transaction_id = models.UUIDField(primary_key=True, default=uuid.uuid4)
@@ -60,6 +91,11 @@ class MonetaryTransactions(models.Model):
     created_date = models.DateTimeField(auto_now_add=True)
     modified_date = models.DateTimeField(auto_now_add=True)
 
+    # Positive amounts are deposits, negative ones withdrawals.
+    # The time the transaction was reflected on the user account
+    updated_on_users = models.BooleanField(default=False)
+    time_updated_on_users = models.DateTimeField(null=True, auto_now_add=False)
+
 
 class ComplianceDocuments(models.Model):
     # users in the system, party A and party B are users with contracts between
@@ -74,8 +110,31 @@ class ComplianceDocuments(models.Model):
     party_b_date_approved_date = models.DateTimeField(default=None, null=True)
 
     created_date = models.DateTimeField(auto_now_add=True)
-    # the contract agreement files
+    # the contract agreement files, documents with the same content share a file
     file = models.FileField()
+    sha256 = models.CharField(max_length=64, null=True, db_index=True)
+    size = models.BigIntegerField(null=True)
+
+
+class ComplianceUpload(models.Model):
+    """
+    A resumable upload of a compliance document, the document is created
+    once all `size` bytes have been received
+    """
+    upload_id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    party_a = models.ForeignKey(User, on_delete=models.RESTRICT, related_name="+")
+    party_b = models.ForeignKey(User, on_delete=models.RESTRICT, related_name="+")
+    filename = models.CharField(max_length=200)
+    size = models.BigIntegerField()
+    # bytes stored so far, the next chunk has to start here
+    received = models.BigIntegerField(default=0)
+    document = models.ForeignKey(ComplianceDocuments, on_delete=models.RESTRICT, null=True, related_name="+")
+    # the request writing to the partial file, until `lease_until`
+    lease_id = models.UUIDField(null=True)
+    lease_until = models.DateTimeField(null=True)
+
+    created_date = models.DateTimeField(auto_now_add=True)
+    modified_date = models.DateTimeField(auto_now=True)
 
 
 class DisputeStage(models.TextChoices):
@@ -84,6 +143,13 @@ class DisputeStage(models.TextChoices):
     Pending = "Pending", "Pending"
 
 
+class DisputeOutcome(models.TextChoices):
+    # the escrow stays cancelled, its amount never left the paying user
+    Refunded = "Refunded", "Refunded"
+    # the escrow is completed and its amount paid to the receiving user
+    Settled = "Settled", "Settled"
+
+
 class Disputes(models.Model):
     dispute_id = models.UUIDField(primary_key=True, default=uuid.uuid4)
 
@@ -95,6 +161,219 @@ class Disputes(models.Model):
     created_date = models.DateTimeField(auto_now_add=True)
     modified_date = models.DateTimeField(auto_now=True)
 
+    # the staff member working on the dispute, see esgrow_backend.disputes
+    assigned_to = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name="+")
+    outcome = models.CharField(choices=DisputeOutcome.choices, max_length=20, blank=True)
+    resolution = models.CharField(max_length=300, blank=True)
+    resolved_by = models.ForeignKey(User, on_delete=models.RESTRICT, null=True, related_name="+")
+    resolved_date = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            # the dispute queue, oldest first per stage
+            models.Index(fields=["stage", "created_date"], name="dispute_stage_created_idx"),
+        ]
+
+
+class UserSummary(models.Model):
+    """
+    Dashboard totals of a user, changed by `esgrow_backend.summaries` as
+    escrows change stage and disputes are opened or resolved, so the
+    dashboard reads one row instead of every escrow.
+
+    Pending escrows are the initiated and pending ones, "in" are the escrows
+    paying the user and "out" the ones the user pays. Open disputes are the
+    unresolved disputes of escrows the user is part of
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="+")
+    pending_in_count = models.IntegerField(default=0)
+    pending_in_amount = models.DecimalField(max_digits=100, decimal_places=2, default=0)
+    pending_out_count = models.IntegerField(default=0)
+    pending_out_amount = models.DecimalField(max_digits=100, decimal_places=2, default=0)
+    completed_in_count = models.IntegerField(default=0)
+    completed_in_amount = models.DecimalField(max_digits=100, decimal_places=2, default=0)
+    completed_out_count = models.IntegerField(default=0)
+    completed_out_amount = models.DecimalField(max_digits=100, decimal_places=2, default=0)
+    cancelled_count = models.IntegerField(default=0)
+    open_disputes = models.IntegerField(default=0)
+    modified_date = models.DateTimeField(auto_now=True)
+
+
+class EventKind(models.TextChoices):
+    Created = "escrow.created", "Escrow created"
+    Confirmed = "escrow.confirmed", "Escrow confirmed"
+    Completed = "escrow.completed", "Escrow completed"
+    Disputed = "escrow.disputed", "Escrow disputed"
+    DisputeResolved = "dispute.resolved", "Dispute resolved"
+
+
+class OutboxEvent(models.Model):
+    """
+    A change of an escrow partners are told about, inserted in the
+    transaction making the change by `esgrow_backend.outbox` and delivered
+    by `esgrow_backend.webhooks` and `esgrow_backend.live`
+    """
+    # monotonic so events are fanned out in the order they happened
+    event_id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(choices=EventKind.choices, max_length=50)
+    transaction = models.ForeignKey(EscrowTransactions, on_delete=models.RESTRICT, related_name="+")
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    created_date = models.DateTimeField(auto_now_add=True)
+    # whether a delivery was created for every endpoint that wants the event
+    fanned_out = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["event_id"], name="outbox_fan_out_idx", condition=models.Q(fanned_out=False)),
+        ]
+
+
+class WebhookEndpoint(models.Model):
+    """
+    A partner URL events are POSTed to, signed with `secret`
+    """
+    endpoint_id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    url = models.URLField(max_length=500)
+    secret = models.CharField(max_length=100)
+    # receives the events of the escrows this user is part of, every event when null
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name="+")
+    # requests sent to the endpoint at once
+    max_concurrency = models.PositiveSmallIntegerField(default=4)
+    active = models.BooleanField(default=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.url
+
+
+class WebhookDelivery(models.Model):
+    """
+    An event to send to an endpoint, retried with backoff until it is
+    delivered or WEBHOOK_MAX_ATTEMPTS attempts failed
+    """
+    delivery_id = models.BigAutoField(primary_key=True)
+    event = models.ForeignKey(OutboxEvent, on_delete=models.CASCADE, related_name="+")
+    endpoint = models.ForeignKey(WebhookEndpoint, on_delete=models.CASCADE, related_name="+")
+    attempts = models.PositiveIntegerField(default=0)
+    # when the next attempt is due, null once delivered or given up on
+    next_attempt_date = models.DateTimeField(null=True)
+    delivered_date = models.DateTimeField(null=True)
+    last_status = models.PositiveSmallIntegerField(null=True)
+    last_error = models.CharField(max_length=300, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["next_attempt_date"], name="webhook_due_idx",
+                         condition=models.Q(next_attempt_date__isnull=False)),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    """
+    The outcome of a request sent with an `Idempotency-Key` header, replayed
+    to retries of the request, see esgrow_backend.idempotency.
+
+    While the first request runs `response_status` is null and retries wait
+    for it
+    """
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    key = models.CharField(max_length=255)
+    # sha256 of the method, path and body, a key can't be reused for another request
+    fingerprint = models.CharField(max_length=64)
+    response_status = models.PositiveSmallIntegerField(null=True)
+    response_data = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    created_date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "key"], name="idempotency_user_key_unique"),
+        ]
+
+
+class SearchTokenKind(models.TextChoices):
+    Word = "Word", "Word"
+    Trigram = "Trigram", "Trigram"
+
+
+class UserSearchToken(models.Model):
+    """
+    The lower cased words and trigrams of a user's username and names, kept
+    up to date on save by `esgrow_backend.search.index_user`
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    token = models.CharField(max_length=200)
+    kind = models.CharField(choices=SearchTokenKind.choices, max_length=20)
+    # how much a match on this token counts towards the rank of the user
+    weight = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["kind", "token"], name="search_kind_token_idx"),
+        ]
+
+
+class LedgerEntryKind(models.TextChoices):
+    Opening = "Opening", "Opening"
+    Escrow = "Escrow", "Escrow"
+    Deposit = "Deposit", "Deposit"
+    Withdrawal = "Withdrawal", "Withdrawal"
+
+
+class LedgerEntry(models.Model):
+    """
+    One leg of a balance movement, rows are only ever inserted.
+
+    All the legs of a posting share a posting_id and sum to zero, a leg
+    without a user belongs to the external clearing account that deposits
+    come from and withdrawals go to
+    """
+    # monotonic so entries can be read back in the order they were written
+    entry_id = models.BigAutoField(primary_key=True)
+    posting_id = models.UUIDField(default=uuid.uuid4)
+    user = models.ForeignKey(User, on_delete=models.RESTRICT, null=True, related_name="+")
+    amount = models.DecimalField(max_digits=100, decimal_places=2)
+    kind = models.CharField(choices=LedgerEntryKind.choices, max_length=200)
+
+    escrow_transaction = models.ForeignKey(EscrowTransactions, on_delete=models.RESTRICT, null=True,
+                                           related_name="+")
+    monetary_transaction = models.ForeignKey(MonetaryTransactions, on_delete=models.RESTRICT, null=True,
+                                             related_name="+")
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created_date"], name="ledger_user_created_idx"),
+            models.Index(fields=["created_date"], name="ledger_created_idx"),
+        ]
+
+
+class BalanceSnapshot(models.Model):
+    """
+    The balance of a user including every ledger entry created up to and
+    including `as_of`
+    """
+    snapshot_id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    user = models.ForeignKey(User, on_delete=models.RESTRICT, related_name="+")
+    balance = models.DecimalField(max_digits=100, decimal_places=2)
+    as_of = models.DateTimeField()
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "as_of"], name="balance_snapshot_user_as_of_unique"),
+        ]
+
+
+class ReplicaPin(models.Model):
+    """
+    A client reading from the primary until `until` because it wrote, see
+    esgrow_backend.routers. Kept in the primary so every worker sees it, one
+    row per Authorization header
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    until = models.DateTimeField()
+
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
@@ -107,25 +386,34 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
         Token.objects.create(user=instance)
 
 
-@receiver(pre_save, sender=EscrowTransactions)
-def update_balance_on_transaction(sender, instance: EscrowTransactions, created=False, **kwargs):
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def create_user_summary(sender, instance=None, created=False, **kwargs):
     """
-    Update the users balance when the transaction is complete
+    Start every user with an empty summary, so maintaining it is a plain
+    UPDATE, see `esgrow_backend.summaries`
     """
-    if (instance.amount > 0
-            and instance.from_user_confirmed
-            and instance.to_user_confirmed):
-        # update user balances
-        from_user = instance.from_user
-        from_user.balance = from_user.balance - instance.amount
-        from_user.save()
+    if created:
+        UserSummary.objects.create(user=instance)
 
-        to_user = instance.to_user
-        to_user.balance = to_user.balance + instance.amount
-        to_user.save()
 
-        # Add date-times
-        instance.updated_on_users = True
-        instance.time_updated_on_users = instance.time_updated_on_users.now()
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def update_search_tokens(sender, instance: User, update_fields=None, **kwargs):
+    """
+    Re-index the user for search when a searchable field may have changed
+    """
+    if update_fields is None or {"username", "first_name", "last_name"} & set(update_fields):
+        # imported here, the search module depends on these models
+        from esgrow_backend.search import index_user
+        index_user(instance)
+
 
-        instance.stage = TransactionStage.Completed
+@receiver(post_save, sender=MonetaryTransactions)
+def settle_completed_monetary_transaction(sender, instance: MonetaryTransactions, **kwargs):
+    """
+    Fold completed deposits and withdrawals into the user balance
+    """
+    if instance.stage == TransactionStage.Completed and not instance.updated_on_users:
+        # imported here, the settlement module depends on these models
+        from esgrow_backend.settlement import settle_monetary_transaction
+        if settle_monetary_transaction(instance.transaction_id):
+            instance.refresh_from_db(fields=["updated_on_users", "time_updated_on_users"])
@@ -0,0 +1,53 @@
+"""
+The transactional outbox of the events partners get webhooks for.
+
+`publish` inserts `OutboxEvent` rows in the transaction changing the
+escrows, so an event exists if and only if its change committed, whatever
+happens to the process afterwards. `esgrow_backend.webhooks` delivers them
+from the table, away from the request, and `esgrow_backend.live` streams
+them to the parties' browsers
+"""
+import uuid
+
+from django.db import transaction
+
+from esgrow_backend import live
+from esgrow_backend.models import OutboxEvent
+
+
+def event(kind: str, transaction_id: uuid.UUID, from_user_id: uuid.UUID, to_user_id: uuid.UUID, amount,
+          **data) -> OutboxEvent:
+    return OutboxEvent(kind=kind, transaction_id=transaction_id, payload={
+        "transaction_id": transaction_id, "from_user_id": from_user_id, "to_user_id": to_user_id, "amount": amount,
+        **data,
+    })
+
+
+def publish(kind: str, rows, **data):
+    """
+    Record a `kind` event for each escrow of `rows`,
+    `(transaction_id, from_user_id, to_user_id, amount)` tuples (longer ones
+    are cut), with `data` added to every payload.
+
+    Must be called inside an atomic block, with the change it reports
+    """
+    insert([event(kind, transaction_id, from_user_id, to_user_id, amount, **data)
+            for transaction_id, from_user_id, to_user_id, amount, *_ in rows])
+
+
+def insert(events: list[OutboxEvent]):
+    """
+    Record `events` made with `event`, see `publish`
+    """
+    if not events:
+        return
+    OutboxEvent.objects.bulk_create(events)
+    # streams in this process hear of the events now, the others on their next poll
+    transaction.on_commit(live.notifier.notify)
+
+
+def serialize(event: OutboxEvent) -> dict:
+    """
+    An event as webhooks and streams send it
+    """
+    return {"id": event.event_id, "type": event.kind, "created_date": event.created_date, "data": event.payload}
@@ -0,0 +1,62 @@
+import functools
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import QuerySet
+from rest_framework import serializers
+
+
+@functools.lru_cache(maxsize=None)
+def related_paths(serializer_class, prefix: str = "") -> tuple[tuple[str, ...], tuple[str, ...]]:
+    """
+    Walk the nested serializers of `serializer_class` and return the
+    relation paths they read, split into `select_related` paths (foreign keys
+    and one-to-one fields) and `prefetch_related` paths (many relations).
+
+    Serializer declarations don't change at runtime so the result is cached
+    """
+    select, prefetch = [], []
+    model = serializer_class.Meta.model
+
+    for field in serializer_class().fields.values():
+        if field.write_only or field.source == "*":
+            continue
+        many = isinstance(field, serializers.ListSerializer)
+        nested = field.child if many else field
+        if not isinstance(nested, serializers.ModelSerializer):
+            continue
+        try:
+            model_field = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            continue
+        if not model_field.is_relation:
+            continue
+
+        path = f"{prefix}{field.source}"
+        if many or model_field.many_to_many or model_field.one_to_many:
+            # everything under a many relation has to be prefetched as well
+            prefetch.append(path)
+            child_select, child_prefetch = related_paths(type(nested), prefix=f"{path}__")
+            prefetch.extend(child_select + child_prefetch)
+        else:
+            select.append(path)
+            child_select, child_prefetch = related_paths(type(nested), prefix=f"{path}__")
+            select.extend(child_select)
+            prefetch.extend(child_prefetch)
+    return tuple(select), tuple(prefetch)
+
+
+def optimise_queryset(queryset, serializer_class) -> QuerySet:
+    """
+    Apply the `select_related`/`prefetch_related` calls that `serializer_class`
+    needs so serializing the queryset runs a constant number of queries
+    regardless of how many rows it has.
+
+    `queryset` can also be a model manager.
+    """
+    select, prefetch = related_paths(serializer_class)
+    queryset = queryset.all()
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset
@@ -0,0 +1,84 @@
+"""
+Renderers wrapping what views return in the response envelope, see
+`esgrow_backend.utils.envelope`.
+
+`EnvelopeORJSONRenderer` encodes with orjson when it is installed, which
+handles UUIDs, datetimes and dict/list subclasses like serializer data in
+C. It falls back to the stock encoder otherwise, so orjson stays optional
+"""
+import datetime
+import decimal
+import json
+
+from django.db.models.query import QuerySet
+from django.utils.functional import Promise
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from esgrow_backend.utils import response_envelope
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class EnvelopeJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get("response")
+        if response is not None and response.status_code != 204:
+            data = response_envelope(response)
+        return super().render(data, accepted_media_type, renderer_context)
+
+
+def orjson_default(obj):
+    """
+    What orjson doesn't encode itself, the same way as DRF's JSONEncoder
+    """
+    if isinstance(obj, decimal.Decimal):
+        # COERCE_DECIMAL_TO_STRING is off, amounts are numbers
+        return float(obj)
+    if isinstance(obj, datetime.timedelta):
+        return str(obj.total_seconds())
+    if isinstance(obj, Promise):
+        return str(obj)
+    if isinstance(obj, bytes):
+        return obj.decode()
+    if isinstance(obj, QuerySet):
+        return list(obj)
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    if hasattr(obj, "__iter__"):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def dumps(data, indent: bool = False) -> bytes:
+    """
+    Encode `data` with orjson if available, else with DRF's encoder
+    """
+    if orjson is None:
+        return json.dumps(data, cls=JSONEncoder, indent=4 if indent else None,
+                          separators=None if indent else (",", ":")).encode()
+    return orjson.dumps(data, default=orjson_default,
+                        option=ORJSON_OPTIONS | (orjson.OPT_INDENT_2 if indent else 0))
+
+
+def loads(content: bytes | str):
+    return json.loads(content) if orjson is None else orjson.loads(content)
+
+
+class EnvelopeORJSONRenderer(EnvelopeJSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        renderer_context = renderer_context or {}
+        response = renderer_context.get("response")
+        if response is not None and response.status_code != 204:
+            data = response_envelope(response)
+        if data is None:
+            return b""
+        return dumps(data, indent=bool(self.get_indent(accepted_media_type, renderer_context)))
@@ -0,0 +1,210 @@
+"""
+Routing of reads to read replicas.
+
+Replicas are the database aliases in DATABASE_REPLICAS, copies of the
+primary ("default") kept up to date by the database's replication, or by
+the sync_replicas command for SQLite files standing in for replicas.
+
+`ReplicaRoutingMiddleware` lets the reads of the views named in
+REPLICA_READ_VIEWS go to a replica, everything else and every write goes to
+the primary. Once a request writes, its reads go to the primary too, and so
+do the requests of the same client (Authorization header) for
+REPLICA_PIN_SECONDS, so clients read their own writes while the replicas
+catch up. The pin is a `ReplicaPin` row in the primary, so it holds whichever
+worker the next request reaches. A streamed response is routed while its
+content is generated, and pins the client if generating it wrote
+"""
+import contextlib
+import contextvars
+import datetime
+import hashlib
+import random
+from dataclasses import dataclass
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+PRIMARY = DEFAULT_DB_ALIAS
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+@dataclass
+class Routing:
+    replica: str | None = None
+    wrote: bool = False
+
+
+current_routing: contextvars.ContextVar[Routing | None] = contextvars.ContextVar("current_routing", default=None)
+
+
+def replicas() -> list[str]:
+    return getattr(settings, "DATABASE_REPLICAS", [])
+
+
+@contextlib.contextmanager
+def use_primary():
+    """
+    Read from the primary within the block, for reads that must not lag
+    """
+    token = current_routing.set(None)
+    try:
+        yield
+    finally:
+        current_routing.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = current_routing.get()
+        if routing is None or routing.wrote or routing.replica is None:
+            return PRIMARY
+        return routing.replica
+
+    def db_for_write(self, model, **hints):
+        routing = current_routing.get()
+        if routing is not None:
+            routing.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema from the primary
+        return db not in replicas()
+
+
+def pin_key(request) -> str | None:
+    authorization = request.headers.get("Authorization")
+    if not authorization:
+        return None
+    return hashlib.sha256(authorization.encode()).hexdigest()
+
+
+def pin_key_if_wrote(request, routing: Routing) -> str | None:
+    """
+    The pin key of the client of `request` if it wrote and there are
+    replicas to pin it away from
+    """
+    if not routing.wrote or not replicas():
+        return None
+    return pin_key(request)
+
+
+def pin_until() -> datetime.datetime:
+    return timezone.now() + datetime.timedelta(seconds=getattr(settings, "REPLICA_PIN_SECONDS", 5))
+
+
+# one query that creates the client's pin or extends it
+UPSERT = {"update_conflicts": True, "unique_fields": ["key"], "update_fields": ["until"]}
+
+
+def pin(key: str):
+    # imported here, the router is loaded with the settings, before the models
+    from esgrow_backend.models import ReplicaPin
+
+    ReplicaPin.objects.bulk_create([ReplicaPin(key=key, until=pin_until())], **UPSERT)
+
+
+async def apin(key: str):
+    from esgrow_backend.models import ReplicaPin
+
+    await ReplicaPin.objects.abulk_create([ReplicaPin(key=key, until=pin_until())], **UPSERT)
+
+
+def pinned(key: str) -> bool:
+    from esgrow_backend.models import ReplicaPin
+
+    return ReplicaPin.objects.using(PRIMARY).filter(key=key, until__gt=timezone.now()).exists()
+
+
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        routing = Routing()
+        token = current_routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        if response.streaming:
+            response.streaming_content = self.stream(request, routing, response.streaming_content)
+        elif key := pin_key_if_wrote(request, routing):
+            pin(key)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        routing = current_routing.get()
+        if routing is None or not replicas() or request.method not in SAFE_METHODS:
+            return
+        if request.resolver_match.url_name not in getattr(settings, "REPLICA_READ_VIEWS", ()):
+            return
+        key = pin_key(request)
+        if key is not None and pinned(key):
+            return
+        routing.replica = random.choice(replicas())
+
+    async def __acall__(self, request):
+        routing = Routing()
+        token = current_routing.set(routing)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        if response.streaming:
+            stream = self.astream if response.is_async else self.stream
+            response.streaming_content = stream(request, routing, response.streaming_content)
+        elif key := pin_key_if_wrote(request, routing):
+            await apin(key)
+        return response
+
+    @staticmethod
+    def stream(request, routing: Routing, content):
+        """
+        Generate `content` under the routing of the request, the view returned
+        before any of it ran, then pin the client if that wrote
+        """
+        iterator = iter(content)
+        try:
+            while True:
+                token = current_routing.set(routing)
+                try:
+                    chunk = next(iterator, None)
+                finally:
+                    current_routing.reset(token)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            if key := pin_key_if_wrote(request, routing):
+                pin(key)
+
+    @staticmethod
+    async def astream(request, routing: Routing, content):
+        iterator = aiter(content)
+        try:
+            while True:
+                token = current_routing.set(routing)
+                try:
+                    chunk = await anext(iterator, None)
+                finally:
+                    current_routing.reset(token)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            if key := pin_key_if_wrote(request, routing):
+                await apin(key)
@@ -0,0 +1,130 @@
+import re
+import uuid
+
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Q, Sum, When
+
+from esgrow_backend.models import User, UserSearchToken, SearchTokenKind
+from esgrow_backend.pagination import decode_cursor, encode_cursor
+
+MIN_QUERY_LENGTH = 2
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 50
+
+# a prefix match on one of these fields counts this much, an exact match
+# on the whole word twice as much
+FIELD_WEIGHTS = {"username": 3, "first_name": 2, "last_name": 2}
+# a trigram match is only worth one, so it never outranks a prefix match
+PREFIX_MULTIPLIER = 10
+
+# every character sorts below this one, so `token < prefix + PREFIX_END`
+# bounds a prefix range that can be answered from the (kind, token) index
+PREFIX_END = "\U0010ffff"
+
+
+def words(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def trigrams(word: str) -> set[str]:
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def search_tokens(user: User) -> list[UserSearchToken]:
+    """
+    The (unsaved) search tokens of a user
+    """
+    tokens = {}
+    for field, weight in FIELD_WEIGHTS.items():
+        for word in words(getattr(user, field) or ""):
+            word = word[:200]
+            key = (SearchTokenKind.Word, word)
+            tokens[key] = max(tokens.get(key, 0), weight)
+            for trigram in trigrams(word):
+                tokens[(SearchTokenKind.Trigram, trigram)] = 1
+    return [UserSearchToken(user=user, kind=kind, token=token, weight=weight)
+            for (kind, token), weight in tokens.items()]
+
+
+def index_user(user: User):
+    """
+    Replace the search tokens of a user
+    """
+    tokens = search_tokens(user)
+    with transaction.atomic():
+        UserSearchToken.objects.filter(user=user).delete()
+        UserSearchToken.objects.bulk_create(tokens)
+
+
+def search(query: str, limit: int = DEFAULT_LIMIT, cursor: str = None) -> tuple[list[User], str | None]:
+    """
+    Rank users by how well their username and names match `query`.
+
+    Each query word matches the words starting with it through a range scan
+    of the token index, words of three or more letters also match by their
+    trigrams so a query for the middle of a name still finds it. Users need
+    at least a prefix match or half of the query trigrams to be returned.
+
+    Returns a page of users, best match first, and the cursor of the next
+    page
+    """
+    ranked = ranked_user_ids(query, cursor)
+    if ranked is None:
+        return [], None
+    rows, next_cursor = page(list(ranked[:limit + 1]), limit)
+    users = User.objects.in_bulk([user_id for user_id, _ in rows])
+    return [users[user_id] for user_id, _ in rows if user_id in users], next_cursor
+
+
+async def asearch(query: str, limit: int = DEFAULT_LIMIT, cursor: str = None) -> tuple[list[User], str | None]:
+    """
+    Async version of `search`
+    """
+    ranked = ranked_user_ids(query, cursor)
+    if ranked is None:
+        return [], None
+    rows, next_cursor = page([row async for row in ranked[:limit + 1]], limit)
+    users = await User.objects.ain_bulk([user_id for user_id, _ in rows])
+    return [users[user_id] for user_id, _ in rows if user_id in users], next_cursor
+
+
+def ranked_user_ids(query: str, cursor: str = None):
+    """
+    The (user_id, score) rows matching `query` after `cursor`, best first.
+    None when the query is too short to search for
+    """
+    query_words = words(query)
+    if len("".join(query_words)) < MIN_QUERY_LENGTH:
+        return None
+    query_trigrams = set().union(*(trigrams(word) for word in query_words))
+
+    matches = Q()
+    for word in query_words:
+        matches |= Q(kind=SearchTokenKind.Word, token__gte=word, token__lt=word + PREFIX_END)
+    if query_trigrams:
+        matches |= Q(kind=SearchTokenKind.Trigram, token__in=query_trigrams)
+
+    ranked = UserSearchToken.objects.filter(matches).values("user_id").annotate(
+        prefix_score=Sum(Case(
+            When(kind=SearchTokenKind.Word, token__in=query_words, then=F("weight") * 2),
+            When(kind=SearchTokenKind.Word, then=F("weight")),
+            default=0, output_field=IntegerField())),
+        trigram_hits=Count("pk", filter=Q(kind=SearchTokenKind.Trigram)),
+    ).annotate(
+        score=F("prefix_score") * PREFIX_MULTIPLIER + F("trigram_hits"),
+    ).filter(
+        Q(prefix_score__gt=0) | Q(trigram_hits__gte=(len(query_trigrams) + 1) // 2 or 1)
+    ).order_by("-score", "user_id")
+
+    if cursor:
+        last_score, last_user_id = decode_cursor(cursor, int, uuid.UUID)
+        ranked = ranked.filter(Q(score__lt=last_score) | Q(score=last_score, user_id__gt=last_user_id))
+    return ranked.values_list("user_id", "score")
+
+
+def page(rows: list, limit: int):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], str(rows[-1][0]))
+    return rows, next_cursor
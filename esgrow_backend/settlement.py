@@ -0,0 +1,245 @@
+import uuid
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+from esgrow_backend import ledger, outbox, transitions
+from esgrow_backend.models import EscrowTransactions, MonetaryTransactions, TransactionStage, LedgerEntryKind, \
+    EventKind
+
+
+class SettlementConflict(Exception):
+    """
+    Raised when an escrow selected for settlement was settled by someone
+    else before it could be claimed
+    """
+
+
+class ConfirmResult(models.TextChoices):
+    Confirmed = "Confirmed", "Confirmed"
+    Settled = "Settled", "Settled"
+    NotFound = "NotFound", "Transaction wasn't found"
+    NotParty = "NotParty", "Logged In user is not part of the transaction"
+    Cancelled = "Cancelled", "Transaction was cancelled"
+    Completed = "Completed", "Transaction was previously completed"
+    Queued = "Queued", "Queued for settlement"
+
+
+def settle_transaction(transaction_id: uuid.UUID) -> bool:
+    """
+    Move the amount of a fully confirmed escrow from the paying user to the
+    receiving user and mark the escrow completed.
+
+    Returns True if this call settled the escrow, False if it wasn't ready
+    or had already been settled
+    """
+    return transaction_id in settle_transactions([transaction_id])
+
+
+def settle_or_queue(transaction_ids) -> tuple[set[uuid.UUID], set[uuid.UUID]]:
+    """
+    Settle the fully confirmed escrows in `transaction_ids` now, or with the
+    SETTLEMENT_DEFERRED setting queue them for the settlement worker so the
+    balance updates stay off the request.
+
+    Returns the ids that were settled and the ids that were queued
+    """
+    if getattr(settings, "SETTLEMENT_DEFERRED", False):
+        return set(), queue_transactions(transaction_ids)
+    return settle_transactions(transaction_ids), set()
+
+
+def queue_transactions(transaction_ids) -> set[uuid.UUID]:
+    """
+    Mark the fully confirmed escrows in `transaction_ids` ready for the
+    settlement worker, returns the ids that were queued
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ready = set(EscrowTransactions.objects.select_for_update().filter(
+            transaction_id__in=transaction_ids,
+            amount__gt=0,
+            from_user_confirmed=True,
+            to_user_confirmed=True,
+            updated_on_users=False,
+            settlement_ready_date__isnull=True,
+            stage__in=transitions.OPEN_STAGES,
+        ).values_list("transaction_id", flat=True))
+        if ready:
+            EscrowTransactions.objects.filter(transaction_id__in=ready).update(settlement_ready_date=now)
+    return ready
+
+
+def settle_queued(batch_size: int = 1000) -> set[uuid.UUID]:
+    """
+    Settle the oldest `batch_size` queued escrows in one atomic unit.
+
+    Balance changes are netted per user, so each user is updated once per
+    batch however many of the escrows they are part of. The escrows are
+    claimed in the same transaction as the balances are changed, so a worker
+    that crashes halfway leaves them queued and they are settled exactly
+    once by the next run. Returns the ids that were settled
+    """
+    queued = list(EscrowTransactions.objects.filter(
+        settlement_ready_date__isnull=False,
+        updated_on_users=False,
+        amount__gt=0,
+        from_user_confirmed=True,
+        to_user_confirmed=True,
+        stage__in=transitions.OPEN_STAGES,
+    ).order_by("settlement_ready_date")
+                  .values_list("transaction_id", flat=True)[:batch_size])
+    if not queued:
+        return set()
+    # another worker may be settling the same rows, skip them rather than wait
+    return settle_transactions(queued, skip_locked=True)
+
+
+def settle_transactions(transaction_ids, skip_locked: bool = False) -> set[uuid.UUID]:
+    """
+    Settle every fully confirmed escrow in `transaction_ids`.
+
+    Everything happens in one atomic block:
+    1. the escrows ready for settlement are locked and moved to completed by
+       `transitions.move`, whose conditional update claims them, so when both
+       parties confirm at the same time only one request settles them and a
+       cancelled escrow is never settled by confirmations
+    2. the user rows are locked in primary key order, so concurrent
+       settlements between the same users can't deadlock
+    3. the balances are changed with `F()` updates touching only the balance
+       column, one per user however many escrows they are part of, and each
+       movement is recorded in the ledger
+
+    Returns the ids of the escrows this call settled
+    """
+    with transaction.atomic():
+        ready = list(EscrowTransactions.objects.select_for_update(skip_locked=skip_locked).filter(
+            transaction_id__in=transaction_ids,
+            amount__gt=0,
+            from_user_confirmed=True,
+            to_user_confirmed=True,
+            updated_on_users=False,
+            stage__in=transitions.OPEN_STAGES,
+        ).order_by("transaction_id")
+                     .values_list("transaction_id", "from_user_id", "to_user_id", "amount", "stage"))
+        if not ready:
+            return set()
+
+        try:
+            settle(ready)
+        except transitions.IllegalTransition as e:
+            raise SettlementConflict("Escrows were settled concurrently") from e
+    return {transaction_id for transaction_id, *_ in ready}
+
+
+def settle(rows, user_id: uuid.UUID = None, disputes=()):
+    """
+    Complete the escrows of `rows` and move their amounts, with
+    `transitions.move` which takes the same rows, `user_id` and `disputes`,
+    and publish their escrow.completed events.
+
+    Must be called inside an atomic block
+    """
+    rows = list(rows)
+    transitions.move(rows, TransactionStage.Completed, user_id=user_id, disputes=disputes,
+                     updated_on_users=True, time_updated_on_users=timezone.now())
+    postings = []
+    for transaction_id, from_user_id, to_user_id, amount, _ in rows:
+        deltas = {from_user_id: -amount}
+        deltas[to_user_id] = deltas.get(to_user_id, 0) + amount
+        postings.append((deltas, LedgerEntryKind.Escrow, {"escrow_transaction_id": transaction_id}))
+    ledger.post_many(postings)
+    outbox.publish(EventKind.Completed, rows)
+
+
+def confirm_transactions(user_id: uuid.UUID, transaction_ids: list[uuid.UUID]) -> dict[uuid.UUID, str]:
+    """
+    Confirm a batch of escrows on behalf of `user_id` and settle (or queue)
+    the ones that become fully confirmed.
+
+    The escrows are loaded and locked with one query and confirmed with at
+    most two updates (escrows the user pays and escrows the user receives),
+    their escrow.confirmed events with one insert, only for the escrows the
+    user hadn't confirmed yet so a retried batch doesn't publish them again.
+    Returns a `ConfirmResult` per transaction id, escrows that can't be
+    confirmed don't stop the others
+    """
+    now = timezone.now()
+    results = {}
+    with transaction.atomic():
+        rows = {row[0]: row for row in EscrowTransactions.objects.select_for_update()
+                .filter(transaction_id__in=transaction_ids).order_by("transaction_id")
+                .values_list("transaction_id", "from_user_id", "to_user_id", "stage", "amount",
+                             "from_user_confirmed", "to_user_confirmed")}
+
+        from_ids, to_ids, confirmed = [], [], []
+        for transaction_id in transaction_ids:
+            row = rows.get(transaction_id)
+            if row is None:
+                results[transaction_id] = ConfirmResult.NotFound
+                continue
+            _, from_user_id, to_user_id, stage, amount, from_user_confirmed, to_user_confirmed = row
+            if user_id not in (from_user_id, to_user_id):
+                results[transaction_id] = ConfirmResult.NotParty
+            elif stage == TransactionStage.Cancelled:
+                results[transaction_id] = ConfirmResult.Cancelled
+            elif stage == TransactionStage.Completed:
+                results[transaction_id] = ConfirmResult.Completed
+            else:
+                newly_confirmed = False
+                if user_id == from_user_id and not from_user_confirmed:
+                    from_ids.append(transaction_id)
+                    newly_confirmed = True
+                if user_id == to_user_id and not to_user_confirmed:
+                    to_ids.append(transaction_id)
+                    newly_confirmed = True
+                if newly_confirmed:
+                    confirmed.append((transaction_id, from_user_id, to_user_id, amount))
+                results[transaction_id] = ConfirmResult.Confirmed
+
+        # databases without row locks (SQLite) rely on the stage condition to
+        # keep an escrow cancelled since it was read from being confirmed
+        open_escrows = EscrowTransactions.objects.filter(stage__in=transitions.OPEN_STAGES)
+        if from_ids:
+            open_escrows.filter(transaction_id__in=from_ids).update(
+                from_user_confirmed=True, from_user_confirmed_date=now, modified_date=now)
+        if to_ids:
+            open_escrows.filter(transaction_id__in=to_ids).update(
+                to_user_confirmed=True, to_user_confirmed_date=now, modified_date=now)
+        outbox.publish(EventKind.Confirmed, confirmed, user_id=user_id)
+
+        # escrows confirmed before are settled too, a retry finishes what a failed settlement left
+        settled, queued = settle_or_queue([transaction_id for transaction_id, result in results.items()
+                                           if result == ConfirmResult.Confirmed])
+        for transaction_id in settled:
+            results[transaction_id] = ConfirmResult.Settled
+        for transaction_id in queued:
+            results[transaction_id] = ConfirmResult.Queued
+    return results
+
+
+def settle_monetary_transaction(transaction_id: uuid.UUID) -> bool:
+    """
+    Apply a completed deposit (positive amount) or withdrawal (negative
+    amount) to the user balance, against the external account.
+
+    The row is claimed with a conditional update so it is applied at most
+    once. Returns True if this call applied it
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        claimed = MonetaryTransactions.objects.filter(
+            transaction_id=transaction_id,
+            stage=TransactionStage.Completed,
+            updated_on_users=False,
+        ).update(updated_on_users=True, time_updated_on_users=now)
+        if not claimed:
+            return False
+
+        user_id, amount = MonetaryTransactions.objects.values_list("user_id", "amount") \
+            .get(transaction_id=transaction_id)
+        kind = LedgerEntryKind.Deposit if amount > 0 else LedgerEntryKind.Withdrawal
+        ledger.post({user_id: amount, None: -amount}, kind, monetary_transaction_id=transaction_id)
+    return True
+
@@ -0,0 +1,40 @@
+"""
+SQLite tuning for the single node deployment and SQLite files standing in
+for read replicas.
+
+`apply_pragmas` runs SQLITE_PRAGMAS on every new SQLite connection. With the
+write-ahead log readers don't block the writer and the writer doesn't block
+readers, so the listing doesn't wait on settlement. `sync_replica` copies
+the primary into a replica file with SQLite's online backup, which is what
+the sync_replicas command runs in place of real replication
+"""
+import sqlite3
+
+from django.conf import settings
+from django.db import connections
+
+from esgrow_backend.routers import PRIMARY
+
+
+def apply_pragmas(sender, connection, **kwargs):
+    if connection.vendor != "sqlite" or connection.is_in_memory_db():
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in getattr(settings, "SQLITE_PRAGMAS", {}).items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+
+
+def sync_replica(alias: str, pages: int = 1024):
+    """
+    Copy the primary into the replica `alias`, `pages` pages at a time so the
+    primary isn't locked for the whole copy
+    """
+    primary, replica = connections[PRIMARY], connections[alias]
+    if primary.vendor != "sqlite" or replica.vendor != "sqlite":
+        raise ValueError("Only SQLite replicas are synced, others use the database's own replication")
+    primary.ensure_connection()
+    target = sqlite3.connect(replica.settings_dict["NAME"])
+    try:
+        primary.connection.backup(target, pages=pages)
+    finally:
+        target.close()
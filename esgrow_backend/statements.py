@@ -0,0 +1,196 @@
+"""
+Monthly statements: per user, the opening balance, every ledger entry of
+the month (escrow settlements, deposits and withdrawals) and the closing
+balance.
+
+`generate` splits the users into shards of contiguous id ranges and works
+through them in a process pool. A shard takes the months in date order, in
+batches of `chunk_size` users: the opening balances of the first month come
+from the balance snapshots (`ledger.balances_as_of`), and every month's
+closing balances open the next, so the ledger is read once, a month at a
+time, along its (user, created_date) index.
+
+A month of a shard is written to `<directory>/<month>/shard-<n>.csv.gz`
+and renamed into place once complete. A rerun skips the files that exist
+and reads the closing balances of the next month back from them, the shard
+boundaries are kept in manifest.json so the files line up. A month runs
+from after midnight of its first day to midnight of the next month's
+first day included, like `ledger.balance_as_of` counts entries up to and
+including a time
+"""
+import csv
+import datetime
+import gzip
+import json
+import os
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from pathlib import Path
+
+import django
+from django.db import connections
+from django.utils import timezone
+
+from esgrow_backend import ledger
+from esgrow_backend.models import User, LedgerEntry
+
+COLUMNS = ("user_id", "month", "date", "type", "kind", "escrow_transaction_id", "monetary_transaction_id",
+           "amount", "balance")
+
+
+def month(label: str) -> tuple[datetime.datetime, datetime.datetime]:
+    """
+    The start and end of a "YYYY-MM" month in the current time zone
+    """
+    first = datetime.datetime.strptime(label, "%Y-%m")
+    following = (first + datetime.timedelta(days=32)).replace(day=1)
+    return timezone.make_aware(first), timezone.make_aware(following)
+
+
+def months(first: str, last: str) -> list[str]:
+    labels = []
+    start, _ = month(first)
+    while start <= month(last)[0]:
+        labels.append(start.strftime("%Y-%m"))
+        start = month(labels[-1])[1]
+    return labels
+
+
+def shard_boundaries(shards: int) -> list[str | None]:
+    """
+    User ids splitting the users into `shards` ranges of about the same
+    size, the first range is open below and the last above
+    """
+    count = User.objects.count()
+    size = max(-(-count // shards), 1)
+    ids = User.objects.order_by("id").values_list("id", flat=True)
+    return [None, *[str(ids[size * shard - 1]) for shard in range(1, shards) if size * shard < count], None]
+
+
+def shard_users(low: str | None, high: str | None):
+    users = User.objects.order_by("id")
+    if low is not None:
+        users = users.filter(id__gt=low)
+    if high is not None:
+        users = users.filter(id__lte=high)
+    return users
+
+
+def read_closings(path: Path) -> dict[uuid.UUID, Decimal]:
+    with gzip.open(path, "rt", newline="") as file:
+        return {uuid.UUID(row["user_id"]): Decimal(row["balance"])
+                for row in csv.DictReader(file) if row["type"] == "closing"}
+
+
+def write_month(path: Path, label: str, user_ids: list[uuid.UUID], previous: dict | None,
+                chunk_size: int) -> tuple[dict, int]:
+    """
+    Write the statements of `user_ids` for month `label`, opening with the
+    `previous` month's closing balances, or the ledger's when None. Returns
+    the closing balances and the number of entries written
+    """
+    start, end = month(label)
+    closings, written = {}, 0
+    partial = path.with_name(f"{path.name}.part")
+    with gzip.open(partial, "wt", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        for offset in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[offset:offset + chunk_size]
+            entries = defaultdict(list)
+            for user_id, *entry in LedgerEntry.objects.filter(
+                    user_id__in=chunk, created_date__gt=start, created_date__lte=end,
+            ).order_by("created_date", "entry_id").values_list(
+                "user_id", "created_date", "kind", "escrow_transaction_id", "monetary_transaction_id", "amount"):
+                entries[user_id].append(entry)
+
+            if previous is None:
+                openings = ledger.balances_as_of(chunk, start)
+            else:
+                # users who joined since have nothing before the month
+                openings = {user_id: previous.get(user_id, Decimal(0)) for user_id in chunk}
+            for user_id, balance in openings.items():
+                writer.writerow((user_id, label, start.isoformat(), "opening", "", "", "", "", balance))
+                for created_date, kind, escrow_transaction_id, monetary_transaction_id, amount in entries[user_id]:
+                    balance += amount
+                    writer.writerow((user_id, label, timezone.localtime(created_date).isoformat(), "entry", kind,
+                                     escrow_transaction_id or "", monetary_transaction_id or "", amount, balance))
+                writer.writerow((user_id, label, end.isoformat(), "closing", "", "", "", "", balance))
+                closings[user_id] = balance
+                written += len(entries[user_id])
+    os.replace(partial, path)
+    return closings, written
+
+
+def generate_shard(directory: str, labels: list[str], shard: int, low: str | None, high: str | None,
+                   chunk_size: int = 1000) -> dict:
+    """
+    Write the statements of the users with ids in (`low`, `high`] for the
+    `labels` months, returns counts of what was done
+    """
+    users = list(shard_users(low, high).values_list("id", "created_date"))
+    counts = {"statements": 0, "entries": 0, "bytes": 0, "resumed": 0}
+    closings = None
+    for label in labels:
+        path = Path(directory) / label / f"shard-{shard:04}.csv.gz"
+        if path.exists():
+            closings = read_closings(path)
+            counts["resumed"] += 1
+            continue
+
+        _, end = month(label)
+        user_ids = [user_id for user_id, created_date in users if created_date <= end]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        closings, written = write_month(path, label, user_ids, closings, chunk_size)
+        counts["statements"] += len(user_ids)
+        counts["entries"] += written
+        counts["bytes"] += path.stat().st_size
+    return counts
+
+
+def setup_worker():
+    # started with the spawn method the worker has no Django yet, forked
+    # ones already have it and open their own connections
+    django.setup()
+
+
+def generate(directory: str, first: str, last: str, shards: int = 16, workers: int = 1,
+             chunk_size: int = 1000) -> dict:
+    """
+    Write the statements of every user for the months `first` to `last`,
+    "YYYY-MM", skipping the files a previous run completed. Returns counts
+    and throughput of the run
+    """
+    labels = months(first, last)
+    manifest_path = Path(directory) / "manifest.json"
+    if manifest_path.exists():
+        boundaries = json.loads(manifest_path.read_text())["boundaries"]
+    else:
+        boundaries = shard_boundaries(shards)
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        manifest_path.write_text(json.dumps({"boundaries": boundaries}))
+    jobs = [(directory, labels, shard, low, high, chunk_size)
+            for shard, (low, high) in enumerate(zip(boundaries, boundaries[1:]))]
+
+    started = time.perf_counter()
+    if workers <= 1:
+        results = [generate_shard(*job) for job in jobs]
+    else:
+        # the workers must not share the parent's connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=setup_worker) as executor:
+            results = list(executor.map(generate_shard, *zip(*jobs)))
+    elapsed = time.perf_counter() - started
+
+    report = {key: sum(result[key] for result in results) for key in ("statements", "entries", "bytes", "resumed")}
+    report.update({
+        "months": len(labels),
+        "shards": len(jobs),
+        "seconds": round(elapsed, 2),
+        "statements_per_second": round(report["statements"] / elapsed, 1) if elapsed else 0,
+        "entries_per_second": round(report["entries"] / elapsed, 1) if elapsed else 0,
+    })
+    return report
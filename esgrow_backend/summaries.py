@@ -0,0 +1,180 @@
+"""
+The `UserSummary` dashboard totals, maintained incrementally.
+
+Every write creating an escrow, changing its stage or opening or resolving
+a dispute reports the change with `record`, in the same transaction. The
+changes are turned into per user deltas and applied with one UPDATE per
+batch of users, the way `ledger.apply_balance_deltas` applies balances.
+
+`compute` derives the totals from the escrows and disputes themselves,
+`rebuild` (the rebuild_summaries command) stores them in place of the
+maintained ones and reports the users whose totals had drifted
+"""
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, Count, F, Sum, When
+from django.utils import timezone
+
+from esgrow_backend.models import User, UserSummary, EscrowTransactions, TransactionStage, Disputes, DisputeStage
+
+PENDING_STAGES = (TransactionStage.Initiated, TransactionStage.Pending)
+
+FIELDS = ("pending_in_count", "pending_in_amount", "pending_out_count", "pending_out_amount",
+          "completed_in_count", "completed_in_amount", "completed_out_count", "completed_out_amount",
+          "cancelled_count", "open_disputes")
+
+
+def stage_prefix(stage: str | None) -> str | None:
+    if stage in PENDING_STAGES:
+        return "pending"
+    if stage == TransactionStage.Completed:
+        return "completed"
+    return None
+
+
+def add_escrow(deltas, from_user_id, to_user_id, amount: Decimal, stage: str | None, sign: int):
+    prefix = stage_prefix(stage)
+    if prefix is not None:
+        deltas[to_user_id][f"{prefix}_in_count"] += sign
+        deltas[to_user_id][f"{prefix}_in_amount"] += sign * amount
+        deltas[from_user_id][f"{prefix}_out_count"] += sign
+        deltas[from_user_id][f"{prefix}_out_amount"] += sign * amount
+    elif stage == TransactionStage.Cancelled:
+        for user_id in {from_user_id, to_user_id}:
+            deltas[user_id]["cancelled_count"] += sign
+
+
+def record(escrows=(), disputes=()):
+    """
+    Apply escrow and dispute changes to the summaries of their parties.
+
+    `escrows` are `(from_user_id, to_user_id, amount, old_stage, new_stage)`
+    tuples, the old stage of a created escrow is None. `disputes` are
+    `(from_user_id, to_user_id, was_open, is_open)` tuples with the parties
+    of the disputed escrow, a created dispute wasn't open.
+
+    Must be called inside an atomic block, with the write it reports
+    """
+    deltas = defaultdict(lambda: defaultdict(int))
+    for from_user_id, to_user_id, amount, old_stage, new_stage in escrows:
+        if old_stage != new_stage:
+            add_escrow(deltas, from_user_id, to_user_id, amount, old_stage, -1)
+            add_escrow(deltas, from_user_id, to_user_id, amount, new_stage, 1)
+    for from_user_id, to_user_id, was_open, is_open in disputes:
+        change = int(is_open) - int(was_open)
+        if change:
+            for user_id in {from_user_id, to_user_id}:
+                deltas[user_id]["open_disputes"] += change
+    apply(deltas)
+
+
+def apply(deltas: dict, batch_size: int = 500):
+    """
+    Add `deltas`, user id to {field: delta}, to the summaries with one
+    UPDATE per `batch_size` users. Users without a summary row yet get one
+    first, which costs an INSERT and a second UPDATE
+    """
+    deltas = {user_id: {field: delta for field, delta in changes.items() if delta}
+              for user_id, changes in deltas.items()}
+    user_ids = sorted(user_id for user_id, changes in deltas.items() if changes)
+    now = timezone.now()
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        fields = {field for user_id in batch for field in deltas[user_id]}
+
+        def update(user_ids):
+            return UserSummary.objects.filter(user_id__in=user_ids).update(modified_date=now, **{
+                field: Case(*[When(user_id=user_id, then=F(field) + deltas[user_id][field])
+                              for user_id in user_ids if field in deltas[user_id]], default=F(field))
+                for field in fields
+            })
+
+        if update(batch) < len(batch):
+            existing = set(UserSummary.objects.filter(user_id__in=batch).values_list("user_id", flat=True))
+            missing = [user_id for user_id in batch if user_id not in existing]
+            # a concurrent first write may create the same rows, theirs win and ours are updated
+            UserSummary.objects.bulk_create([UserSummary(user_id=user_id) for user_id in missing],
+                                            ignore_conflicts=True)
+            update(missing)
+
+
+def get(user_id: uuid.UUID) -> UserSummary:
+    """
+    The summary of a user, all zeros for a user without escrows
+    """
+    return UserSummary.objects.filter(user_id=user_id).first() or UserSummary(user_id=user_id)
+
+
+def grouped(queryset, *columns, amounts: bool = False):
+    """
+    Rows of `columns` followed by the count (and sum of amounts) of each
+    group of `queryset`
+    """
+    totals = {"count": Count("pk")}
+    if amounts:
+        totals["total"] = Sum("amount")
+    return queryset.order_by().values(*columns).annotate(**totals).values_list(*columns, *totals)
+
+
+def compute() -> dict[uuid.UUID, dict]:
+    """
+    Every user's totals, from the escrows and disputes with grouped queries
+    """
+    totals = defaultdict(lambda: dict.fromkeys(FIELDS, 0))
+    for direction, column in (("out", "from_user_id"), ("in", "to_user_id")):
+        for user_id, stage, count, amount in grouped(EscrowTransactions.objects, column, "stage", amounts=True):
+            prefix = stage_prefix(stage)
+            if prefix is not None:
+                totals[user_id][f"{prefix}_{direction}_count"] += count
+                totals[user_id][f"{prefix}_{direction}_amount"] += amount
+            elif stage == TransactionStage.Cancelled:
+                totals[user_id]["cancelled_count"] += count
+
+    # cancellations and disputes count once per party, take off the second
+    # count of escrows between a user and themselves
+    cancelled = EscrowTransactions.objects.filter(stage=TransactionStage.Cancelled)
+    for user_id, count in grouped(cancelled.filter(from_user_id=F("to_user_id")), "from_user_id"):
+        totals[user_id]["cancelled_count"] -= count
+
+    open_disputes = Disputes.objects.exclude(stage=DisputeStage.Resolved)
+    for column in ("transaction__from_user_id", "transaction__to_user_id"):
+        for user_id, count in grouped(open_disputes, column):
+            totals[user_id]["open_disputes"] += count
+    for user_id, count in grouped(open_disputes.filter(transaction__from_user_id=F("transaction__to_user_id")),
+                                  "transaction__from_user_id"):
+        totals[user_id]["open_disputes"] -= count
+    return totals
+
+
+def drifted() -> list[UserSummary]:
+    """
+    The summaries, with the computed totals, of the users whose stored
+    summary differs from them or who have none
+    """
+    totals = compute()
+    stored = {summary.user_id: summary for summary in UserSummary.objects.all()}
+    summaries = []
+    for user_id in User.objects.values_list("id", flat=True).iterator(chunk_size=2000):
+        expected = totals.get(user_id) or dict.fromkeys(FIELDS, 0)
+        summary = stored.get(user_id)
+        if summary is None or any(getattr(summary, field) != expected[field] for field in FIELDS):
+            summaries.append(UserSummary(user_id=user_id, **expected))
+    return summaries
+
+
+def rebuild(batch_size: int = 1000) -> int:
+    """
+    Recompute every summary from scratch and store the ones that drifted,
+    returns how many did.
+
+    Writes committing while the totals are computed can be overwritten,
+    run it when writes are quiet or run it again to check
+    """
+    with transaction.atomic():
+        summaries = drifted()
+        UserSummary.objects.bulk_create(summaries, batch_size=batch_size, update_conflicts=True,
+                                        unique_fields=["user"], update_fields=[*FIELDS, "modified_date"])
+    return len(summaries)
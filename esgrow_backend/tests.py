@@ -1,3 +1,1643 @@
-from django.test import TestCase
+import asyncio
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import make_password
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, OperationalError
+from django.db.models import Q
+from django.db.transaction import atomic
+from django.http import StreamingHttpResponse
+from django.test import AsyncClient, override_settings, RequestFactory, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+from rest_framework import serializers
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from esgrow import settings as project_settings
+from esgrow_backend import benchmarks, idempotency, ledger, live, metrics, outbox, renderers, routers, sqlite, \
+    statements, summaries, throttling, transitions, uploads, webhooks
+from esgrow_backend.asgi import LiveUpdatesApplication, POLL_PATH, STREAM_PATH
+from esgrow_backend.authentication import TokenCache, token_cache
+from esgrow_backend.models import User, EscrowTransactions, TransactionStage, Disputes, DisputeStage, \
+    MonetaryTransactions, LedgerEntry, LedgerEntryKind, BalanceSnapshot, ComplianceDocuments, IdempotencyKey, \
+    UserSummary, EscrowStageChange, EventKind, OutboxEvent, WebhookEndpoint, WebhookDelivery, ComplianceUpload, \
+    ReplicaPin
+from esgrow_backend.pagination import keyset_queryset
+from esgrow_backend.settlement import settle_transaction, settle_queued
+from esgrow_backend.uploads import hash_cache
+from esgrow_backend.views import EscrowTransactionBulkAddView, EscrowTransactionsView, open_dispute
+from esgrow_backend.webhook_stub import StubReceiver
+
+
+def create_user(username: str, balance=0) -> User:
+    user = User.objects.create(username=username, email=f"{username}@esgrow.org", balance=balance)
+    user.set_password("password")
+    user.save()
+    return user
+
+
+def create_escrow(from_user: User, to_user: User, amount="10.00", stage=TransactionStage.Initiated,
+                  created_date=None) -> EscrowTransactions:
+    transaction = EscrowTransactions.objects.create(from_user=from_user, to_user=to_user,
+                                                    amount=Decimal(amount), stage=stage)
+    if created_date is not None:
+        # created_date is auto_now_add, so it can only be back-dated with an update
+        EscrowTransactions.objects.filter(pk=transaction.pk).update(created_date=created_date)
+        transaction.refresh_from_db()
+    return transaction
+
+
+# hashing is not what these tests are about, keep it cheap
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class EsgrowTestCase(APITestCase):
+    def setUp(self):
+        token_cache.clear()
+        throttling.get_store().clear()
+        throttling.shedder.reset()
+        self.alice = create_user("alice", balance=1000)
+        self.bob = create_user("bob", balance=1000)
+        self.carol = create_user("carol", balance=1000)
+        self.authenticate(self.alice)
+
+    def authenticate(self, user: User):
+        token = Token.objects.get(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+
+
+class EscrowTransactionsViewTests(EsgrowTestCase):
+    def setUp(self):
+        super().setUp()
+        start = timezone.now() - datetime.timedelta(days=30)
+        for day in range(30):
+            from_user, to_user = (self.alice, self.bob) if day % 2 else (self.carol, self.alice)
+            stage = TransactionStage.Completed if day % 3 == 0 else TransactionStage.Initiated
+            create_escrow(from_user, to_user, stage=stage, created_date=start + datetime.timedelta(days=day))
+        # not visible to alice
+        create_escrow(self.bob, self.carol)
+
+    def fetch_all(self, **params):
+        seen, cursor = [], None
+        while True:
+            if cursor:
+                params["cursor"] = cursor
+            response = self.client.get(reverse("view_transactions"), params)
+            self.assertEqual(response.status_code, 200, response.data)
+            seen.extend(response.json()["data"]["transactions"])
+            cursor = response.json()["data"]["next_cursor"]
+            if cursor is None:
+                return seen
+
+    def test_pages_cover_both_directions_newest_first(self):
+        transactions = self.fetch_all(limit=7)
+        self.assertEqual(len(transactions), 30)
+        self.assertEqual(len({t["transaction_id"] for t in transactions}), 30)
+        dates = [t["created_date"] for t in transactions]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+    def test_pages_split_ties_between_directions(self):
+        when = timezone.now()
+        for from_user, to_user in ((self.alice, self.bob), (self.bob, self.alice)) * 3:
+            create_escrow(from_user, to_user, created_date=when)
+        transactions = self.fetch_all(limit=4)
+        self.assertEqual(len({t["transaction_id"] for t in transactions}), 36)
+        keys = [(t["created_date"], t["transaction_id"]) for t in transactions]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    @skipUnless(connection.vendor == "sqlite", "reads SQLite's query plans")
+    def test_pages_are_read_along_the_indexes(self):
+        cursor = self.client.get(reverse("view_transactions"), {"limit": 5}).json()["data"]["next_cursor"]
+        for params in ({}, {"cursor": cursor}, {"cursor": cursor, "stage": TransactionStage.Completed}):
+            querysets = EscrowTransactionsView.filter_transactions(self.alice, params)
+            self.assertEqual(len(querysets), 2)
+            for queryset in querysets:
+                plan = keyset_queryset(queryset, params.get("cursor"), "transaction_id", "created_date")[:6].explain()
+                self.assertIn("_user_created_idx", plan)
+                self.assertNotIn("TEMP B-TREE", plan)
+                if "cursor" in params:
+                    self.assertIn("created_date<", plan)
+
+    def test_filters(self):
+        self.assertEqual(len(self.fetch_all(direction="from")), 15)
+        self.assertEqual(len(self.fetch_all(counterparty=str(self.carol.id))), 15)
+        self.assertEqual(len(self.fetch_all(stage=TransactionStage.Completed)), 10)
+
+        after = timezone.now() - datetime.timedelta(days=10, hours=12)
+        transactions = self.fetch_all(created_after=after.isoformat())
+        self.assertEqual(len(transactions), 10)
+        for transaction in transactions:
+            self.assertGreaterEqual(parse_datetime(transaction["created_date"]), after)
+
+    def test_invalid_parameters(self):
+        for params in ({"cursor": "garbage"}, {"stage": "Unknown"}, {"direction": "sideways"},
+                       {"limit": "zero"}, {"created_before": "yesterday"}):
+            response = self.client.get(reverse("view_transactions"), params)
+            self.assertEqual(response.status_code, 400, params)
+
+
+class QueryCountTests(EsgrowTestCase):
+    """
+    Every endpoint must run the same number of queries whatever the size of
+    its result, otherwise a serializer is loading relations one row at a time
+    """
+
+    def count_queries(self, method, url, data=None):
+        # measure every request with a cold authentication cache
+        token_cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url, data, format="json")
+        self.assertLess(response.status_code, 300, response.data)
+        return len(context)
+
+    def grow(self, count: int):
+        for i in range(count):
+            counterparty = create_user(f"user{User.objects.count()}")
+            transaction = create_escrow(self.alice, counterparty)
+            Disputes.objects.create(transaction=transaction, user_initiated=counterparty,
+                                    reason="", stage=DisputeStage.Pending)
+
+    def assertConstantQueries(self, method, url, data=None):
+        self.grow(2)
+        small = self.count_queries(method, url, data)
+        self.grow(10)
+        large = self.count_queries(method, url, data)
+        self.assertEqual(small, large, f"{method.upper()} {url} query count grows with result size")
+
+    def test_view_transactions(self):
+        self.assertConstantQueries("get", reverse("view_transactions"))
+
+    def test_search_users(self):
+        self.assertConstantQueries("get", reverse("search_users"), {"name": "user"})
+
+    def test_confirm_transaction(self):
+        transaction = create_escrow(self.alice, self.bob)
+        self.assertConstantQueries("post", reverse("confirm_transaction", args=[transaction.transaction_id]))
+
+    def test_dispute_queue(self):
+        User.objects.filter(pk=self.alice.pk).update(is_staff=True)
+        self.assertConstantQueries("get", reverse("dispute_queue"))
+
+    def test_dispute_transaction(self):
+        def dispute():
+            transaction = create_escrow(self.alice, self.bob)
+            return self.count_queries("post", reverse("dispute_transaction", args=[transaction.transaction_id]),
+                                      {"reason": "not delivered"})
+
+        self.grow(2)
+        small = dispute()
+        self.grow(10)
+        self.assertEqual(small, dispute())
+
+
+class CachedTokenAuthenticationTests(EsgrowTestCase):
+    def request(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("view_transactions"))
+        return response.status_code, len(context)
+
+    def test_cache_saves_the_token_query(self):
+        status, cold = self.request()
+        self.assertEqual(status, 200)
+        hits = token_cache.hits
+        status, warm = self.request()
+        self.assertEqual(status, 200)
+        self.assertEqual(warm, cold - 1)
+        self.assertEqual(token_cache.hits, hits + 1)
+
+    def test_deleted_token_is_rejected(self):
+        self.request()
+        Token.objects.filter(user=self.alice).delete()
+        self.assertEqual(self.request()[0], 401)
+
+    def test_changed_user_is_reloaded(self):
+        self.request()
+        self.alice.is_active = False
+        self.alice.save()
+        self.assertEqual(self.request()[0], 401)
+
+    def test_cache_is_bounded(self):
+        cache = TokenCache(max_size=2, ttl=60)
+        for key in ("a", "b", "c"):
+            cache.set(key, self.alice, None)
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+        cache = TokenCache(max_size=2, ttl=-1)
+        cache.set("a", self.alice, None)
+        self.assertIsNone(cache.get("a"))
+
+
+class SettlementTests(EsgrowTestCase):
+    def test_second_confirmation_settles(self):
+        transaction = create_escrow(self.alice, self.bob, amount="250.00")
+        response = self.client.post(reverse("confirm_transaction", args=[transaction.transaction_id]))
+        self.assertEqual(response.json()["data"]["stage"], TransactionStage.Initiated)
+
+        self.authenticate(self.bob)
+        response = self.client.post(reverse("confirm_transaction", args=[transaction.transaction_id]))
+        self.assertEqual(response.json()["data"]["stage"], TransactionStage.Completed)
+
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertEqual(self.alice.balance, Decimal("750.00"))
+        self.assertEqual(self.bob.balance, Decimal("1250.00"))
+
+    def test_settles_once(self):
+        transaction = create_escrow(self.alice, self.bob, amount="100.00")
+        EscrowTransactions.objects.filter(pk=transaction.pk).update(from_user_confirmed=True, to_user_confirmed=True)
+        self.assertTrue(settle_transaction(transaction.transaction_id))
+        self.assertFalse(settle_transaction(transaction.transaction_id))
+        self.bob.refresh_from_db()
+        self.assertEqual(self.bob.balance, Decimal("1100.00"))
+
+    def test_unconfirmed_or_cancelled_is_not_settled(self):
+        transaction = create_escrow(self.alice, self.bob, stage=TransactionStage.Cancelled)
+        EscrowTransactions.objects.filter(pk=transaction.pk).update(from_user_confirmed=True)
+        self.assertFalse(settle_transaction(transaction.transaction_id))
+        EscrowTransactions.objects.filter(pk=transaction.pk).update(to_user_confirmed=True)
+        self.assertFalse(settle_transaction(transaction.transaction_id))
+
+
+class TransitionTests(EsgrowTestCase):
+    def test_cancelled_escrow_is_not_confirmed_or_settled(self):
+        transaction = create_escrow(self.alice, self.bob)
+        self.authenticate(self.bob)
+        self.client.post(reverse("confirm_transaction", args=[transaction.transaction_id]))
+        response = self.client.post(reverse("dispute_transaction", args=[transaction.transaction_id]),
+                                    {"reason": "never arrived"})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(reverse("dispute_transaction", args=[transaction.transaction_id]))
+        self.assertEqual(response.status_code, 409)
+
+        self.authenticate(self.alice)
+        response = self.client.post(reverse("confirm_transaction", args=[transaction.transaction_id]))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["errors"], {"transaction_id": ["Transaction was cancelled"]})
+        transaction.refresh_from_db()
+        self.assertEqual(transaction.stage, TransactionStage.Cancelled)
+        self.assertFalse(transaction.from_user_confirmed or transaction.to_user_confirmed)
+
+        EscrowTransactions.objects.filter(pk=transaction.pk).update(from_user_confirmed=True, to_user_confirmed=True)
+        self.assertFalse(settle_transaction(transaction.transaction_id))
+        self.assertEqual(Disputes.objects.count(), 1)
+        self.assertEqual(list(EscrowStageChange.objects.values_list("from_stage", "to_stage", "user_id")),
+                         [(TransactionStage.Initiated, TransactionStage.Cancelled, self.bob.pk)])
+
+    def test_stale_transitions_are_rejected(self):
+        settled = create_escrow(self.alice, self.bob, amount="100.00")
+        stale = create_escrow(self.alice, self.bob, amount="50.00")
+        EscrowTransactions.objects.filter(pk=stale.pk).update(stage=TransactionStage.Cancelled)
+        rows = [(escrow.pk, self.alice.pk, self.bob.pk, escrow.amount, TransactionStage.Initiated)
+                for escrow in (settled, stale)]
+        with self.assertRaises(transitions.IllegalTransition), atomic():
+            transitions.move(rows, TransactionStage.Completed)
+        with self.assertRaises(transitions.IllegalTransition):
+            transitions.move(rows[:1], TransactionStage.Initiated)
+
+        # nothing moved, not even the escrow that could
+        settled.refresh_from_db()
+        self.assertEqual(settled.stage, TransactionStage.Initiated)
+        self.assertFalse(EscrowStageChange.objects.exists())
+
+        EscrowTransactions.objects.filter(pk=settled.pk).update(from_user_confirmed=True, to_user_confirmed=True)
+        self.assertTrue(settle_transaction(settled.transaction_id))
+        change = EscrowStageChange.objects.get()
+        self.assertEqual((change.transaction_id, change.from_stage, change.to_stage, change.user_id),
+                         (settled.pk, TransactionStage.Initiated, TransactionStage.Completed, None))
+
+
+@override_settings(SETTLEMENT_DEFERRED=True)
+class DeferredSettlementTests(EsgrowTestCase):
+    def confirm_both(self, transaction: EscrowTransactions):
+        self.client.post(reverse("confirm_transaction", args=[transaction.transaction_id]))
+        self.authenticate(transaction.to_user)
+        response = self.client.post(reverse("confirm_transaction", args=[transaction.transaction_id]))
+        self.authenticate(transaction.from_user)
+        return response
+
+    def test_confirmation_queues_and_worker_settles(self):
+        paying = create_escrow(self.alice, self.bob, amount="250.00")
+        returning = create_escrow(self.bob, self.alice, amount="50.00")
+        response = self.confirm_both(paying)
+        self.assertEqual(response.json()["data"]["stage"], TransactionStage.Initiated)
+        self.authenticate(self.bob)
+        self.confirm_both(returning)
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.balance, Decimal("1000.00"))
+
+        # both users are changed once for the whole batch
+        with CaptureQueriesContext(connection) as queries:
+            settled = settle_queued()
+        self.assertEqual(settled, {paying.pk, returning.pk})
+        # plus one insert each for the stage change audit rows and the outbox events
+        self.assertLess(len(queries), 12)
+        self.assertEqual(settle_queued(), set())
+
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertEqual(self.alice.balance, Decimal("800.00"))
+        self.assertEqual(self.bob.balance, Decimal("1200.00"))
+        paying.refresh_from_db()
+        self.assertEqual(paying.stage, TransactionStage.Completed)
+        self.assertIsNotNone(paying.time_updated_on_users)
+
+    def test_crashed_batch_is_retried(self):
+        transaction = create_escrow(self.alice, self.bob, amount="100.00")
+        self.confirm_both(transaction)
+        with mock.patch.object(ledger, "post_many", side_effect=RuntimeError("crash")):
+            with self.assertRaises(RuntimeError):
+                settle_queued()
+        transaction.refresh_from_db()
+        self.assertFalse(transaction.updated_on_users)
+
+        self.assertEqual(settle_queued(), {transaction.pk})
+        self.bob.refresh_from_db()
+        self.assertEqual(self.bob.balance, Decimal("1100.00"))
+        self.assertEqual(LedgerEntry.objects.filter(escrow_transaction=transaction).count(), 2)
+
+    def test_disputed_transaction_leaves_the_queue(self):
+        transaction = create_escrow(self.alice, self.bob, amount="100.00")
+        self.confirm_both(transaction)
+        self.client.post(reverse("dispute_transaction", args=[transaction.transaction_id]), {"reason": "late"})
+        self.assertEqual(settle_queued(), set())
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.balance, Decimal("1000.00"))
+
+    def test_batch_confirm_reports_queued(self):
+        transaction = create_escrow(self.alice, self.bob)
+        EscrowTransactions.objects.filter(pk=transaction.pk).update(to_user_confirmed=True)
+        response = self.client.post(reverse("confirm_transactions"), {"transaction_ids": [str(transaction.pk)]},
+                                    format="json")
+        self.assertEqual(response.json()["data"]["results"][0]["result"], "Queued")
+
+
+class IdempotencyTests(EsgrowTestCase):
+    def dispute(self, transaction, key, reason="never arrived"):
+        return self.client.post(reverse("dispute_transaction", args=[transaction.transaction_id]), {"reason": reason},
+                                format="json", HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retries_are_replayed(self):
+        transaction = create_escrow(self.alice, self.bob)
+        first = self.dispute(transaction, "retry-1")
+        self.assertEqual(first.status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            second = self.dispute(transaction, "retry-1")
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(Disputes.objects.filter(transaction=transaction).count(), 1)
+        self.assertFalse([query for query in queries if "escrowtransactions" in query["sql"]
+                          or "disputes" in query["sql"]])
+
+        # keys are per user and not shared with other requests
+        self.assertEqual(self.dispute(transaction, "retry-1", reason="changed my mind").status_code, 422)
+        self.authenticate(self.bob)
+        self.assertNotIn("Idempotent-Replayed", self.dispute(transaction, "retry-1"))
+
+    def test_create_is_not_repeated(self):
+        data = {"from_user": str(self.alice.id), "to_user": str(self.bob.id), "amount": "25.00"}
+        responses = [self.client.post(reverse("create_transactions"), data, format="json",
+                                      HTTP_IDEMPOTENCY_KEY="create-1") for _ in range(3)]
+        self.assertEqual({response.status_code for response in responses}, {201})
+        self.assertEqual(EscrowTransactions.objects.count(), 1)
+        self.assertEqual(len({response.json()["data"]["transaction_id"] for response in responses}), 1)
+
+    @override_settings(IDEMPOTENCY_WAIT_TIMEOUT=0.1, IDEMPOTENCY_LOCK_TIMEOUT=60)
+    def test_in_flight_and_abandoned_keys(self):
+        transaction = create_escrow(self.alice, self.bob)
+        url = reverse("confirm_transaction", args=[transaction.transaction_id])
+        claimed = IdempotencyKey.objects.create(user=self.alice, key="confirm-1",
+                                                fingerprint=idempotency.fingerprint("POST", url, b""))
+        response = self.client.post(url, HTTP_IDEMPOTENCY_KEY="confirm-1")
+        self.assertEqual(response.status_code, 409)
+        transaction.refresh_from_db()
+        self.assertFalse(transaction.from_user_confirmed)
+
+        IdempotencyKey.objects.filter(pk=claimed.pk).update(created_date=timezone.now() - datetime.timedelta(
+            minutes=5))
+        response = self.client.post(url, HTTP_IDEMPOTENCY_KEY="confirm-1")
+        self.assertEqual(response.status_code, 200)
+        transaction.refresh_from_db()
+        self.assertTrue(transaction.from_user_confirmed)
+
+    def test_expired_keys_run_again(self):
+        transaction = create_escrow(self.alice, self.bob)
+        self.dispute(transaction, "expiring")
+        IdempotencyKey.objects.update(created_date=timezone.now() - datetime.timedelta(days=2))
+        # the request runs again, and a cancelled escrow can't be disputed twice
+        response = self.dispute(transaction, "expiring")
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Disputes.objects.count(), 1)
+
+        IdempotencyKey.objects.update(created_date=timezone.now() - datetime.timedelta(days=2))
+        self.assertEqual(idempotency.expire(), 1)
+
+
+class BatchConfirmTests(EsgrowTestCase):
+    def confirm(self, transaction_ids):
+        response = self.client.post(reverse("confirm_transactions"), {"transaction_ids": transaction_ids},
+                                    format="json")
+        self.assertEqual(response.status_code, 200, response.data)
+        return {str(item["transaction_id"]): item["result"] for item in response.json()["data"]["results"]}
+
+    def test_partial_failures_do_not_abort_the_batch(self):
+        paying = create_escrow(self.alice, self.bob, amount="100.00")
+        receiving = create_escrow(self.bob, self.alice, amount="40.00")
+        EscrowTransactions.objects.filter(pk=receiving.pk).update(from_user_confirmed=True)
+        cancelled = create_escrow(self.alice, self.bob, stage=TransactionStage.Cancelled)
+        foreign = create_escrow(self.bob, self.carol)
+        missing = "00000000-0000-0000-0000-000000000000"
+
+        results = self.confirm([str(paying.pk), str(receiving.pk), str(cancelled.pk), str(foreign.pk), missing,
+                                "not-an-id"])
+        self.assertEqual(results, {
+            str(paying.pk): "Confirmed",
+            str(receiving.pk): "Settled",
+            str(cancelled.pk): "Cancelled",
+            str(foreign.pk): "NotParty",
+            missing: "NotFound",
+            "not-an-id": "Invalid",
+        })
+        paying.refresh_from_db()
+        self.assertTrue(paying.from_user_confirmed)
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.balance, Decimal("1040.00"))
+
+        self.assertEqual(self.confirm([str(receiving.pk)]), {str(receiving.pk): "Completed"})
+
+    def test_settles_set_wise(self):
+        escrows = [create_escrow(self.bob, self.alice, amount="5.00") for _ in range(40)]
+        EscrowTransactions.objects.update(from_user_confirmed=True)
+
+        with CaptureQueriesContext(connection) as context:
+            results = self.confirm([str(escrow.pk) for escrow in escrows])
+        self.assertEqual(set(results.values()), {"Settled"})
+        # one query per step, not per escrow
+        self.assertLess(len(context), 20)
+
+        self.bob.refresh_from_db()
+        self.assertEqual(self.bob.balance, Decimal("800.00"))
+        self.assertEqual(LedgerEntry.objects.filter(kind=LedgerEntryKind.Escrow).count(), 80)
+
+    def test_rejects_bad_payload(self):
+        response = self.client.post(reverse("confirm_transactions"), {"transaction_ids": []}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class UserSummaryTests(EsgrowTestCase):
+    def summary(self, user: User) -> dict:
+        self.authenticate(user)
+        response = self.client.get(reverse("user_summary"))
+        self.assertEqual(response.status_code, 200)
+        return response.json()["data"]
+
+    def create(self, from_user: User, to_user: User, amount: str) -> str:
+        self.authenticate(from_user)
+        response = self.client.post(reverse("create_transactions"), {"from_user": str(from_user.id),
+                                                                     "to_user": str(to_user.id), "amount": amount},
+                                    format="json")
+        self.assertEqual(response.status_code, 201)
+        return response.json()["data"]["transaction_id"]
+
+    def test_follows_escrows_and_disputes(self):
+        settled = self.create(self.alice, self.bob, "30.00")
+        disputed = self.create(self.alice, self.bob, "20.00")
+        self.create(self.bob, self.alice, "5.00")
+        alice = self.summary(self.alice)
+        self.assertEqual((alice["pending_out_count"], alice["pending_out_amount"], alice["pending_in_count"],
+                          alice["pending_in_amount"]), (2, 50.0, 1, 5.0))
+
+        self.authenticate(self.bob)
+        self.client.post(reverse("confirm_transaction", args=[settled]))
+        self.client.post(reverse("dispute_transaction", args=[disputed]), {"reason": "late"}, format="json")
+        self.authenticate(self.alice)
+        self.client.post(reverse("confirm_transaction", args=[settled]))
+
+        alice, bob = self.summary(self.alice), self.summary(self.bob)
+        self.assertEqual((alice["pending_out_count"], alice["completed_out_amount"], alice["cancelled_count"],
+                          alice["open_disputes"]), (0, 30.0, 1, 1))
+        self.assertEqual((bob["pending_out_count"], bob["completed_in_amount"], bob["cancelled_count"],
+                          bob["open_disputes"]), (1, 30.0, 1, 1))
+        self.assertEqual(self.summary(self.carol)["pending_in_count"], 0)
+        self.assertEqual(summaries.drifted(), [])
+
+        # the token is cached, the summary is one primary key lookup
+        self.authenticate(self.alice)
+        with self.assertNumQueries(1):
+            self.client.get(reverse("user_summary"))
+
+    def test_rebuild_repairs_drift(self):
+        self.create(self.alice, self.bob, "30.00")
+        create_escrow(self.bob, self.carol, amount="7.00")
+        UserSummary.objects.filter(user=self.alice).update(pending_out_amount=0)
+
+        with self.assertRaises(CommandError):
+            call_command("rebuild_summaries", "--check", stderr=io.StringIO())
+        call_command("rebuild_summaries", stdout=io.StringIO())
+        self.assertEqual(self.summary(self.alice)["pending_out_amount"], 30.0)
+        self.assertEqual(self.summary(self.carol)["pending_in_amount"], 7.0)
+        self.assertEqual(summaries.rebuild(), 0)
+
+
+class DisputeQueueTests(EsgrowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.support = create_user("support")
+        User.objects.filter(pk=self.support.pk).update(is_staff=True)
+        self.authenticate(self.support)
+
+    def dispute(self, amount: str, days_ago: int = 0) -> Disputes:
+        dispute = open_dispute(create_escrow(self.alice, self.bob, amount=amount), self.bob, "never arrived")
+        Disputes.objects.filter(pk=dispute.pk).update(created_date=timezone.now() - datetime.timedelta(days=days_ago))
+        return dispute
+
+    def queue(self, **params) -> tuple[list[str], str]:
+        response = self.client.get(reverse("dispute_queue"), params)
+        self.assertEqual(response.status_code, 200, response.data)
+        data = response.json()["data"]
+        return [dispute["dispute_id"] for dispute in data["disputes"]], data["next_cursor"]
+
+    def post(self, name: str, data: dict):
+        return self.client.post(reverse(name), data, format="json")
+
+    def test_queue_is_oldest_first_and_staff_only(self):
+        newest, oldest, middle = self.dispute("1.00", 0), self.dispute("2.00", 3), self.dispute("3.00", 1)
+        page, cursor = self.queue(limit=2)
+        self.assertEqual(page, [str(oldest.pk), str(middle.pk)])
+        self.assertEqual(self.queue(limit=2, cursor=cursor), ([str(newest.pk)], None))
+
+        response = self.post("assign_disputes", {"dispute_ids": [str(middle.pk), str(uuid.uuid4())],
+                                                 "user_id": str(self.support.pk)})
+        self.assertEqual(response.json()["data"]["assigned"], [str(middle.pk)])
+        self.assertEqual(self.queue(assigned_to="me")[0], [str(middle.pk)])
+        self.assertEqual(self.queue(assigned_to="none")[0], [str(oldest.pk), str(newest.pk)])
+        response = self.post("assign_disputes", {"dispute_ids": [str(oldest.pk)], "user_id": str(self.alice.pk)})
+        self.assertEqual(response.status_code, 400)
+
+        self.authenticate(self.alice)
+        self.assertEqual(self.client.get(reverse("dispute_queue")).status_code, 403)
+
+    def test_bulk_resolve_settles_or_refunds(self):
+        settled, refunded = self.dispute("30.00"), self.dispute("20.00")
+        summaries.rebuild()
+
+        response = self.post("resolve_disputes", {"dispute_ids": [str(settled.pk)], "outcome": "Settled"})
+        self.assertEqual(response.json()["data"]["settled"], [str(settled.transaction_id)])
+        response = self.post("resolve_disputes", {"dispute_ids": [str(refunded.pk), str(settled.pk)],
+                                                  "outcome": "Refunded", "resolution": "goods never shipped"})
+        self.assertEqual(response.json()["data"], {"resolved": [str(refunded.pk)], "skipped": [str(settled.pk)],
+                                                   "settled": []})
+
+        self.bob.refresh_from_db()
+        self.assertEqual(self.bob.balance, Decimal("1030.00"))
+        self.assertEqual(EscrowTransactions.objects.get(pk=refunded.transaction_id).stage, TransactionStage.Cancelled)
+        self.assertEqual(EscrowStageChange.objects.filter(to_stage=TransactionStage.Completed).get().user_id,
+                         self.support.pk)
+        self.assertEqual(list(Disputes.objects.order_by("outcome").values_list("stage", "outcome", "resolved_by")),
+                         [(DisputeStage.Resolved, "Refunded", self.support.pk),
+                          (DisputeStage.Resolved, "Settled", self.support.pk)])
+        self.assertEqual(summaries.drifted(), [])
+
+    def test_resolving_is_all_or_nothing(self):
+        first = self.dispute("10.00")
+        # a second dispute on the same escrow, from before they were refused
+        second = Disputes.objects.create(transaction=first.transaction, user_initiated=self.alice, reason="",
+                                         stage=DisputeStage.Pending)
+        valid = self.dispute("5.00")
+        self.post("resolve_disputes", {"dispute_ids": [str(first.pk)], "outcome": "Settled"})
+
+        response = self.post("resolve_disputes", {"dispute_ids": [str(second.pk), str(valid.pk)],
+                                                  "outcome": "Refunded"})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Disputes.objects.filter(stage=DisputeStage.Resolved).count(), 1)
+
+
+class CreateTransactionTests(EsgrowTestCase):
+    def test_create_single(self):
+        response = self.client.post(reverse("create_transactions"),
+                                    {"from_user": str(self.alice.id), "to_user": str(self.bob.id), "amount": "12.50"},
+                                    format="json")
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(EscrowTransactions.objects.get().amount, Decimal("12.50"))
+
+        response = self.client.post(reverse("create_transactions"),
+                                    {"from_user": str(self.bob.id), "to_user": str(self.carol.id), "amount": "1"},
+                                    format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_create(self):
+        rows = [{"from_user": str(self.alice.id), "to_user": str(user.id), "amount": f"{i + 1}.00"}
+                for i, user in enumerate([self.bob, self.carol] * 1250)]
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse("bulk_create_transactions"), {"transactions": rows}, format="json")
+            self.assertEqual(response.status_code, 201)
+            body = response.json()
+        # one user lookup and a handful of multi-row INSERTs of escrows and
+        # their outbox events (SQLite caps the rows per INSERT by its variable
+        # limit), not a query per row
+        self.assertLess(len(context), 80)
+
+        self.assertEqual(body["errors"], {})
+        self.assertEqual(len(body["data"]["transaction_ids"]), 2500)
+        self.assertEqual(EscrowTransactions.objects.filter(from_user=self.alice).count(), 2500)
+        self.assertEqual(set(EscrowTransactions.objects.values_list("stage", flat=True)), {TransactionStage.Initiated})
+
+    def test_bulk_create_is_all_or_nothing(self):
+        rows = [{"from_user": str(self.alice.id), "to_user": str(self.bob.id), "amount": "1.00"}] * 5
+        original = outbox.publish
+
+        def publish(kind, rows, **data):
+            if EscrowTransactions.objects.count() > 2:
+                raise OperationalError("database is locked at /var/lib/esgrow.sqlite3")
+            original(kind, rows, **data)
+
+        with mock.patch.object(EscrowTransactionBulkAddView, "chunk_size", 2), \
+                mock.patch("esgrow_backend.outbox.publish", publish), self.assertLogs("esgrow_backend", "ERROR"):
+            response = self.client.post(reverse("bulk_create_transactions"), {"transactions": rows}, format="json")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()["errors"], {"exception": ["Internal server error"]})
+        self.assertFalse(EscrowTransactions.objects.exists())
+
+    def test_bulk_create_validates_every_row(self):
+        rows = [
+            {"from_user": str(self.alice.id), "to_user": str(self.bob.id), "amount": "5.00"},
+            {"from_user": str(self.bob.id), "to_user": str(self.carol.id), "amount": "5.00"},
+            {"from_user": str(self.alice.id), "to_user": "00000000-0000-0000-0000-000000000000", "amount": "5.00"},
+        ]
+        response = self.client.post(reverse("bulk_create_transactions"), {"transactions": rows}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()["errors"]), {"1", "2"})
+        self.assertIn("to_user", response.json()["errors"]["2"])
+
+        rows[0]["amount"] = "-1"
+        response = self.client.post(reverse("bulk_create_transactions"), {"transactions": rows}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(EscrowTransactions.objects.exists())
+
+
+class SearchUsersTests(EsgrowTestCase):
+    def setUp(self):
+        super().setUp()
+        for username, first_name, last_name in (("jsmith", "John", "Smith"), ("johnny", "Johnny", "Walker"),
+                                                ("mary", "Mary", "Johnson"), ("smithy", "Anna", "Blacksmith")):
+            User.objects.create(username=username, first_name=first_name, last_name=last_name)
+
+    def search(self, name, **params):
+        response = self.client.get(reverse("search_users"), {"name": name, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return [user["username"] for user in response.json()["data"]["users"]], response.json()["data"]["next_cursor"]
+
+    def test_ranks_exact_and_prefix_matches_first(self):
+        usernames, _ = self.search("john")
+        self.assertEqual(usernames[0], "jsmith")
+        self.assertEqual(set(usernames[:3]), {"jsmith", "johnny", "mary"})
+
+        usernames, _ = self.search("smith")
+        self.assertEqual(usernames[:2], ["jsmith", "smithy"])
+
+    def test_matches_inside_words(self):
+        usernames, _ = self.search("ohnso")
+        self.assertEqual(usernames, ["mary"])
+
+    def test_minimum_length_and_pagination(self):
+        self.assertEqual(self.search("j"), ([], None))
+
+        seen, cursor = [], None
+        while True:
+            usernames, cursor = self.search("jo", limit=1, **({"cursor": cursor} if cursor else {}))
+            seen.extend(usernames)
+            if cursor is None:
+                break
+        self.assertEqual(sorted(seen), ["johnny", "jsmith", "mary"])
+
+    def test_index_follows_renames(self):
+        self.assertEqual(self.search("walker")[0], ["johnny"])
+        user = User.objects.get(username="johnny")
+        user.last_name = "Parker"
+        user.save()
+        self.assertEqual(self.search("walker")[0], [])
+        self.assertEqual(self.search("parker")[0], ["johnny"])
+
+
+class WebhookTests(EsgrowTestCase):
+    def dispatch(self):
+        pool = webhooks.ConnectionPool(timeout=5)
+        try:
+            return webhooks.dispatch(pool)
+        finally:
+            pool.close()
+
+    def test_stage_changes_publish_events(self):
+        settled = create_escrow(self.alice, self.bob)
+        disputed = create_escrow(self.alice, self.bob)
+        self.client.post(reverse("confirm_transaction", args=[settled.transaction_id]))
+        self.authenticate(self.bob)
+        self.client.post(reverse("confirm_transaction", args=[settled.transaction_id]))
+        self.client.post(reverse("dispute_transaction", args=[disputed.transaction_id]), {"reason": "late"})
+        response = self.client.post(reverse("confirm_transaction", args=[disputed.transaction_id]))
+        self.assertEqual(response.status_code, 409)
+
+        events = list(OutboxEvent.objects.order_by("event_id").values_list("kind", "transaction_id", "payload"))
+        self.assertEqual([(kind, transaction_id) for kind, transaction_id, _ in events], [
+            (EventKind.Confirmed, settled.pk), (EventKind.Confirmed, settled.pk), (EventKind.Completed, settled.pk),
+            (EventKind.Disputed, disputed.pk),
+        ])
+        self.assertEqual(events[1][2]["user_id"], str(self.bob.pk))
+        self.assertEqual(events[3][2]["reason"], "late")
+        self.assertEqual(events[3][2]["dispute_id"], str(Disputes.objects.get().pk))
+
+    def test_retried_confirmations_publish_once(self):
+        single, batched = create_escrow(self.alice, self.bob), create_escrow(self.alice, self.carol)
+        for _ in range(2):
+            response = self.client.post(reverse("confirm_transaction", args=[single.transaction_id]))
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post(reverse("confirm_transactions"),
+                                        {"transaction_ids": [str(batched.pk)]}, format="json")
+            self.assertEqual(response.json()["data"]["results"][0]["result"], "Confirmed")
+        self.assertEqual(sorted(OutboxEvent.objects.values_list("transaction_id", flat=True)),
+                         sorted([single.pk, batched.pk]))
+
+    def test_events_are_delivered_signed(self):
+        with StubReceiver("secret") as receiver, StubReceiver("secret") as other:
+            WebhookEndpoint.objects.create(url=receiver.url, secret="secret")
+            WebhookEndpoint.objects.create(url=other.url, secret="secret", user=self.carol)
+            escrow = create_escrow(self.alice, self.bob)
+            self.client.post(reverse("confirm_transaction", args=[escrow.transaction_id]))
+
+            self.assertEqual(self.dispatch(), {"fanned_out": 1, "delivered": 1, "failed": 0})
+            self.assertEqual(self.dispatch(), {"fanned_out": 0, "delivered": 0, "failed": 0})
+        self.assertEqual([(event["type"], event["data"]["transaction_id"]) for event in receiver.events],
+                         [(EventKind.Confirmed, str(escrow.pk))])
+        self.assertEqual((receiver.rejected, other.requests), (0, 0))
+
+        body = b'{"events": []}'
+        signature = webhooks.sign("secret", body, int(time.time()))
+        self.assertTrue(webhooks.verify("secret", body, signature))
+        self.assertFalse(webhooks.verify("other", body, signature))
+        self.assertFalse(webhooks.verify("secret", b'{"events": [1]}', signature))
+        self.assertFalse(webhooks.verify("secret", body, signature, now=time.time() + 600))
+
+    @override_settings(WEBHOOK_RETRY_BASE=4, WEBHOOK_MAX_ATTEMPTS=2)
+    def test_failed_deliveries_are_retried_with_backoff(self):
+        with StubReceiver("secret", fail=3) as receiver:
+            WebhookEndpoint.objects.create(url=receiver.url, secret="secret")
+            with atomic():
+                outbox.publish(EventKind.Completed, [(create_escrow(self.alice, self.bob).pk, self.alice.pk,
+                                                      self.bob.pk, Decimal("10.00"))])
+            before = timezone.now()
+            self.assertEqual(self.dispatch(), {"fanned_out": 1, "delivered": 0, "failed": 1})
+            delivery = WebhookDelivery.objects.get()
+            self.assertEqual((delivery.attempts, delivery.last_status), (1, 500))
+            self.assertTrue(before + datetime.timedelta(seconds=2) <= delivery.next_attempt_date
+                            <= timezone.now() + datetime.timedelta(seconds=4))
+            # not due yet
+            self.assertEqual(self.dispatch()["failed"], 0)
+
+            WebhookDelivery.objects.update(next_attempt_date=timezone.now())
+            self.assertEqual(self.dispatch()["failed"], 1)
+            delivery.refresh_from_db()
+            # out of attempts
+            self.assertEqual((delivery.attempts, delivery.next_attempt_date, delivery.delivered_date), (2, None, None))
+
+            WebhookDelivery.objects.update(next_attempt_date=timezone.now())
+            self.assertEqual(self.dispatch()["failed"], 1)
+            WebhookDelivery.objects.update(next_attempt_date=timezone.now())
+            self.assertEqual(self.dispatch()["delivered"], 1)
+        self.assertEqual(receiver.requests, 4)
+        self.assertEqual(len(receiver.events), 1)
+
+    @override_settings(WEBHOOK_EVENTS_PER_REQUEST=2)
+    def test_requests_per_endpoint_are_limited(self):
+        with StubReceiver("secret", delay=0.05) as receiver:
+            WebhookEndpoint.objects.create(url=receiver.url, secret="secret", max_concurrency=2)
+            with atomic():
+                outbox.publish(EventKind.Completed, [(create_escrow(self.alice, self.bob).pk, self.alice.pk,
+                                                      self.bob.pk, Decimal("10.00")) for _ in range(20)])
+            self.assertEqual(self.dispatch()["delivered"], 20)
+        self.assertEqual(receiver.requests, 10)
+        self.assertEqual(receiver.max_in_flight, 2)
+        self.assertEqual(sorted(event["id"] for event in receiver.events),
+                         list(OutboxEvent.objects.order_by("event_id").values_list("event_id", flat=True)))
+
+
+class ThrottlingTests(EsgrowTestCase):
+    def search(self, user: User = None):
+        self.client.credentials(**({"HTTP_AUTHORIZATION": f"Token {Token.objects.get(user=user).key}"}
+                                   if user else {}))
+        return self.client.get(reverse("search_users"), {"name": "alice"})
+
+    def test_buckets_refill(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for store in (throttling.MemoryBucketStore(), throttling.SQLiteBucketStore(f"{directory}/buckets")):
+                self.assertEqual([store.take("a", 2, 1.0, now=100) for _ in range(3)], [0, 0, 1.0])
+                self.assertEqual(store.take("a", 2, 1.0, now=100.5), 0.5)
+                self.assertEqual(store.take("a", 2, 1.0, now=101), 0)
+                self.assertEqual(store.take("b", 2, 1.0, now=101), 0)
+
+    @override_settings(THROTTLE_RATES={"search": {"token": "2/minute", "ip": "3/minute"},
+                                       "login": {"global": "1/hour"}})
+    def test_token_ip_and_global_limits(self):
+        self.assertEqual([self.search(self.alice).status_code for _ in range(3)], [200, 200, 429])
+        response = self.search(self.alice)
+        self.assertEqual(response["Retry-After"], "30")
+        self.assertIn("detail", response.json()["errors"])
+        # bob has his own token bucket but shares the address, whose bucket alice's requests drained
+        self.assertEqual([self.search(self.bob).status_code for _ in range(2)], [200, 429])
+        self.assertEqual(self.search().status_code, 429)
+
+        with override_settings(ROOT_URLCONF="esgrow_backend.async_urls"):
+            response = self.client.get(reverse("search_users"), {"name": "alice"})
+        self.assertEqual((response.status_code, response["Retry-After"]), (429, "20"))
+
+        credentials = {"username": "carol", "password": "password"}
+        self.assertEqual(self.client.post(reverse("login"), credentials).status_code, 200)
+        self.assertEqual(self.client.post(reverse("login"), credentials, REMOTE_ADDR="10.0.0.2").status_code, 429)
+
+    @override_settings(SHED_MAX_IN_FLIGHT=0)
+    def test_overloaded_workers_shed_expensive_views(self):
+        response = self.search()
+        self.assertEqual((response.status_code, response["Retry-After"]), (503, "1"))
+        transaction = create_escrow(self.alice, self.bob)
+        self.authenticate(self.alice)
+        response = self.client.post(reverse("confirm_transaction", args=[transaction.transaction_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(throttling.shedder.in_flight, 0)
+
+    def test_slow_queries_shed_until_they_recover(self):
+        shedder = throttling.LoadShedder(weight=0.5, half_life=1)
+        shedder.started()
+        shedder.finished(metrics.RequestStats(queries=2, query_time=1.0), now=10)
+        self.assertEqual(shedder.latency(now=10), 0.25)
+        self.assertEqual(shedder.latency(now=12), 0.0625)
+        with override_settings(SHED_DB_LATENCY_MS=100), mock.patch("time.monotonic", return_value=10):
+            self.assertIsNotNone(shedder.overloaded())
+        with override_settings(SHED_DB_LATENCY_MS=100), mock.patch("time.monotonic", return_value=12):
+            self.assertIsNone(shedder.overloaded())
+
+
+@override_settings(ROOT_URLCONF="esgrow_backend.async_urls")
+class AsyncViewsTests(EsgrowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.async_client = AsyncClient()
+
+    async def request(self, method, name, user: User, args=(), data=None):
+        token = await Token.objects.aget(user=user)
+        response = await getattr(self.async_client, method)(
+            reverse(name, args=args), data, headers={"Authorization": f"Token {token.key}"},
+            **({"content_type": "application/json"} if method == "post" else {}))
+        return response.status_code, json.loads(response.content)
+
+    async def test_listing_matches_the_sync_view(self):
+        for _ in range(3):
+            await sync_to_async(create_escrow)(self.alice, self.bob)
+        status, body = await self.request("get", "view_transactions", self.alice, data={"limit": 2})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body["data"]["transactions"]), 2)
+        self.assertIsNotNone(body["data"]["next_cursor"])
+
+        with override_settings(ROOT_URLCONF="esgrow_backend.urls"):
+            sync_body = (await sync_to_async(self.client.get)(reverse("view_transactions"), {"limit": 2})).json()
+        self.assertEqual(body["data"], sync_body["data"])
+
+    async def test_confirm_and_dispute(self):
+        transaction = await sync_to_async(create_escrow)(self.alice, self.bob, amount="30.00")
+        status, body = await self.request("post", "confirm_transaction", self.alice, [transaction.pk])
+        self.assertEqual((status, body["data"]["stage"]), (200, TransactionStage.Initiated))
+        status, body = await self.request("post", "confirm_transaction", self.bob, [transaction.pk])
+        self.assertEqual((status, body["data"]["stage"]), (200, TransactionStage.Completed))
+        self.assertEqual((await User.objects.aget(pk=self.bob.pk)).balance, Decimal("1030.00"))
+
+        disputed = await sync_to_async(create_escrow)(self.alice, self.bob)
+        status, body = await self.request("post", "dispute_transaction", self.carol, [disputed.pk])
+        self.assertEqual(status, 400)
+        status, body = await self.request("post", "dispute_transaction", self.bob, [disputed.pk],
+                                          {"reason": "never arrived"})
+        self.assertEqual((status, body["data"]["reason"]), (200, "never arrived"))
+        self.assertEqual((await EscrowTransactions.objects.aget(pk=disputed.pk)).stage, TransactionStage.Cancelled)
+
+    async def test_idempotency_key(self):
+        disputed = await sync_to_async(create_escrow)(self.alice, self.bob)
+        token = await Token.objects.aget(user=self.bob)
+        headers = {"Authorization": f"Token {token.key}", "Idempotency-Key": "async-1"}
+        url = reverse("dispute_transaction", args=[disputed.pk])
+        first = await self.async_client.post(url, {"reason": "late"}, content_type="application/json",
+                                             headers=headers)
+        second = await self.async_client.post(url, {"reason": "late"}, content_type="application/json",
+                                              headers=headers)
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(json.loads(second.content), json.loads(first.content))
+        self.assertEqual(await Disputes.objects.filter(transaction_id=disputed.pk).acount(), 1)
+
+    async def test_search_and_authentication(self):
+        status, body = await self.request("get", "search_users", self.alice, data={"name": "car"})
+        self.assertEqual([user["username"] for user in body["data"]["users"]], ["carol"])
+
+        response = await self.async_client.get(reverse("view_transactions"), headers={"Authorization": "Token x"})
+        self.assertEqual(response.status_code, 401)
+
+
+# the test transaction never commits, so streams only hear of events by polling
+@override_settings(SSE_POLL_INTERVAL=0.05)
+class LiveUpdatesTests(EsgrowTestCase):
+    async def open(self, path: str, user: User = None, query: str = "", headers=()):
+        """
+        Send a GET to the live updates app, returns its task, the queue of the
+        messages it receives and of those it sends, and the response start
+        """
+        headers = list(headers)
+        if user is not None:
+            token = await Token.objects.aget(user=user)
+            headers.append((b"authorization", f"Token {token.key}".encode()))
+        scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(), "headers": headers}
+        received, sent = asyncio.Queue(), asyncio.Queue()
+        await received.put({"type": "http.request", "body": b"", "more_body": False})
+        task = asyncio.ensure_future(LiveUpdatesApplication(None)(scope, received.get, sent.put))
+        return task, received, sent, await asyncio.wait_for(sent.get(), 2)
+
+    async def poll(self, user: User, query: str = "timeout=0"):
+        task, _, sent, start = await self.open(POLL_PATH, user, query)
+        body = json.loads((await asyncio.wait_for(sent.get(), 2))["body"])
+        await task
+        return start["status"], body
+
+    async def post(self, user: User, name: str, transaction: EscrowTransactions, data=None):
+        await sync_to_async(self.authenticate)(user)
+        return await sync_to_async(self.client.post)(reverse(name, args=[transaction.pk]), data)
+
+    async def test_long_poll(self):
+        status, body = await self.poll(self.alice)
+        self.assertEqual((status, body["data"]["events"]), (200, []))
+        after = body["data"]["last_event_id"]
+
+        transaction = await sync_to_async(create_escrow)(self.alice, self.bob)
+        waiting = asyncio.ensure_future(self.poll(self.alice, "timeout=5"))
+        await asyncio.sleep(0.1)
+        await self.post(self.bob, "confirm_transaction", transaction)
+        status, body = await asyncio.wait_for(waiting, 2)
+        self.assertEqual([(event["type"], event["data"]["transaction_id"]) for event in body["data"]["events"]],
+                         [(EventKind.Confirmed, str(transaction.pk))])
+
+        # catching up from the table
+        status, body = await self.poll(self.alice, f"after={after}")
+        self.assertEqual([event["id"] for event in body["data"]["events"]], [body["data"]["last_event_id"]])
+        status, body = await self.poll(self.carol, f"after={after}&timeout=0")
+        self.assertEqual(body["data"]["events"], [])
+        status, body = await self.poll(self.alice, "after=x")
+        self.assertEqual((status, body["errors"]), (400, {"after": ["Expected an event id"]}))
+        status, body = await self.poll(None)
+        self.assertEqual(status, 401)
+
+    async def test_event_stream(self):
+        transaction = await sync_to_async(create_escrow)(self.alice, self.bob)
+        await self.post(self.alice, "confirm_transaction", transaction)
+        missed = await OutboxEvent.objects.order_by("event_id").alast()
+
+        task, received, sent, start = await self.open(STREAM_PATH, self.bob,
+                                                      headers=[(b"last-event-id", str(missed.event_id - 1).encode())])
+        self.assertEqual((start["status"], dict(start["headers"])[b"content-type"]), (200, b"text/event-stream"))
+
+        async def chunk():
+            return (await asyncio.wait_for(sent.get(), 2))["body"]
+
+        self.assertEqual(await chunk(), b"retry: 3000\n\n")
+        self.assertIn(f"id: {missed.event_id}\nevent: escrow.confirmed\n".encode(), await chunk())
+
+        await self.post(self.bob, "dispute_transaction", transaction, {"reason": "late"})
+        body = await chunk()
+        self.assertIn(b"event: escrow.disputed\n", body)
+        event = json.loads(body.split(b"data: ", 1)[1])
+        self.assertEqual((event["data"]["reason"], event["id"]), ("late", missed.event_id + 1))
+
+        # the client going away ends the stream and its subscription
+        await received.put({"type": "http.disconnect"})
+        await asyncio.wait_for(task, 2)
+        self.assertEqual(live.notifier.subscriptions, {})
+
+
+class EnvelopeTests(EsgrowTestCase):
+    def assertEnvelope(self, response, status_code: int, status_description: str):
+        body = response.json()
+        self.assertEqual(set(body), {"status", "status_description", "errors", "data"})
+        self.assertEqual(response.status_code, status_code)
+        self.assertEqual((body["status"], body["status_description"]), (status_code, status_description))
+        return body
+
+    def test_every_response_is_enveloped(self):
+        transaction = create_escrow(self.alice, self.bob)
+        body = self.assertEnvelope(self.client.get(reverse("view_transactions")), 200, "OK")
+        self.assertEqual(body["errors"], {})
+        self.assertEqual(body["data"]["transactions"][0]["amount"], 10.0)
+
+        body = self.assertEnvelope(self.client.post(reverse("create_transactions"),
+                                                    {"from_user": str(self.bob.id), "to_user": str(self.carol.id),
+                                                     "amount": "5.00"}, format="json"), 400, "BAD REQUEST")
+        self.assertEqual(body["errors"], {"user_id": ["Logged in user is not part of the transaction"]})
+
+        body = self.assertEnvelope(self.client.post(reverse("confirm_transaction", args=[uuid.uuid4()])),
+                                   404, "NOT FOUND")
+        self.assertEqual(body["errors"], {"transaction_id": ["Transaction wasn't found"]})
+
+        self.client.credentials()
+        body = self.assertEnvelope(self.client.post(reverse("confirm_transaction",
+                                                            args=[transaction.transaction_id])),
+                                   401, "UNAUTHORIZED")
+        self.assertEqual(list(body["errors"]), ["detail"])
+
+    def test_orjson_renders_like_the_stock_renderer(self):
+        for i in range(50):
+            create_escrow(self.alice, self.bob, amount=f"{i}.25")
+        response = self.client.get(reverse("view_transactions"), {"limit": 50})
+        context = {"response": response}
+
+        stock = renderers.EnvelopeJSONRenderer().render(response.data, renderer_context=context)
+        fast = renderers.EnvelopeORJSONRenderer().render(response.data, renderer_context=context)
+        self.assertEqual(json.loads(fast), json.loads(stock))
+        self.assertEqual(json.loads(fast), response.json())
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+                   DATABASE_REPLICAS=["replica"])
+class ReplicaRoutingTests(APITransactionTestCase):
+    """
+    A temporary SQLite file as the replica, the backup that fills it can't
+    run inside a test case's transaction
+    """
+
+    def setUp(self):
+        token_cache.clear()
+        throttling.get_store().clear()
+        throttling.shedder.reset()
+        self.alice = create_user("alice", balance=1000)
+        self.bob = create_user("bob", balance=1000)
+        self.authenticate(self.alice)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        connections.settings["replica"] = dict(connections.settings["default"],
+                                               NAME=os.path.join(directory, "replica.sqlite3"))
+        self.addCleanup(self.remove_replica)
+
+        # the replica lags behind the primary by one escrow
+        self.replicated = create_escrow(self.alice, self.bob)
+        sqlite.sync_replica("replica")
+        self.latest = create_escrow(self.alice, self.bob)
+
+    def authenticate(self, user: User):
+        token = Token.objects.get(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+
+    @staticmethod
+    def remove_replica():
+        connections["replica"].close()
+        del connections["replica"]
+        del connections.settings["replica"]
+
+    def listed(self) -> set[str]:
+        response = self.client.get(reverse("view_transactions"))
+        self.assertEqual(response.status_code, 200)
+        return {item["transaction_id"] for item in response.json()["data"]["transactions"]}
+
+    def test_reads_follow_the_client_to_the_primary_after_a_write(self):
+        replicated, latest = str(self.replicated.transaction_id), str(self.latest.transaction_id)
+        self.assertEqual(self.listed(), {replicated})
+
+        response = self.client.post(reverse("confirm_transaction", args=[self.latest.transaction_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.listed(), {replicated, latest})
+
+        self.authenticate(self.bob)
+        self.assertEqual(self.listed(), {replicated})
+
+    def test_pins_are_kept_in_the_primary(self):
+        self.client.post(reverse("confirm_transaction", args=[self.latest.transaction_id]))
+        # what another worker sees, nothing of this process is involved
+        pin = ReplicaPin.objects.get()
+        self.assertEqual(pin.key, routers.pin_key(self.client.get(reverse("view_transactions")).wsgi_request))
+        self.assertEqual(len(self.listed()), 2)
+
+        ReplicaPin.objects.update(until=timezone.now())
+        self.assertEqual(len(self.listed()), 1)
+
+    def test_streamed_writes_pin_the_client(self):
+        def view(request):
+            def content():
+                yield "["
+                create_escrow(self.alice, self.bob)
+                yield "]"
+            return StreamingHttpResponse(content())
+
+        request = RequestFactory().post("/", HTTP_AUTHORIZATION="Token streamed")
+        response = routers.ReplicaRoutingMiddleware(view)(request)
+        self.assertFalse(ReplicaPin.objects.exists())
+        self.assertEqual(b"".join(response.streaming_content), b"[]")
+        self.assertEqual(ReplicaPin.objects.get().key, routers.pin_key(request))
+
+    def test_replica_files_use_the_write_ahead_log(self):
+        with connections["replica"].cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            self.assertEqual(cursor.fetchone()[0], "wal")
+
+
+class MetricsTests(EsgrowTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+
+    def sample(self, name: str, **labels) -> float:
+        rendered = ",".join(f'{label}="{value}"' for label, value in labels.items())
+        prefix = f"{name}{{{rendered}}} "
+        body = self.client.get("/metrics").content.decode()
+        lines = [line for line in body.splitlines() if line.startswith(prefix)]
+        self.assertEqual(len(lines), 1, body)
+        return float(lines[0][len(prefix):])
+
+    def test_records_per_view(self):
+        create_escrow(self.alice, self.bob)
+        for _ in range(3):
+            self.client.get(reverse("view_transactions"))
+        self.client.get(reverse("view_transactions"), {"cursor": "bad"})
+
+        self.assertEqual(self.sample("esgrow_request_duration_seconds_count", view="view_transactions"), 4)
+        self.assertEqual(self.sample("esgrow_responses_total", view="view_transactions", status="200"), 3)
+        self.assertEqual(self.sample("esgrow_responses_total", view="view_transactions", status="400"), 1)
+        self.assertGreater(self.sample("esgrow_request_db_queries_sum", view="view_transactions"), 0)
+        self.assertGreater(self.sample("esgrow_request_serializer_duration_seconds_sum", view="view_transactions"), 0)
+        self.assertGreater(self.sample("esgrow_response_size_bytes_sum", view="view_transactions"), 0)
+        self.assertEqual(self.sample("esgrow_request_duration_seconds_bucket", view="view_transactions", le="+Inf"),
+                         4)
+
+    def test_only_this_apps_serializers_are_timed(self):
+        self.assertEqual(serializers.BaseSerializer.data.fget.__module__, "rest_framework.serializers")
+        self.client.get(reverse("search_users"), {"name": "bob"})
+        self.assertGreater(self.sample("esgrow_request_serializer_duration_seconds_sum", view="search_users"), 0)
+
+    @override_settings(METRICS_ALLOWED_IPS=[], METRICS_TOKEN="scrape")
+    def test_scrapers_must_be_allowed(self):
+        self.client.credentials()
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape").status_code, 200)
+        with override_settings(METRICS_ALLOWED_IPS=["10.0.0.7"]):
+            self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.7").status_code, 200)
+
+    @override_settings(ROOT_URLCONF="esgrow_backend.async_urls")
+    async def test_counts_queries_of_async_views(self):
+        token = await Token.objects.aget(user=self.alice)
+        response = await AsyncClient().get(reverse("view_transactions"),
+                                           headers={"Authorization": f"Token {token.key}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('esgrow_request_db_queries_count{view="view_transactions"} 1', metrics.render())
+        self.assertNotIn('esgrow_request_db_queries_sum{view="view_transactions"} 0', metrics.render())
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=0)
+    def test_slow_query_log(self):
+        with self.assertLogs("esgrow_backend.slow_queries", level="WARNING") as logs:
+            self.client.get(reverse("view_transactions"))
+        self.assertIn("view_transactions", logs.output[0])
+        self.assertGreater(self.sample("esgrow_slow_queries_total", view="view_transactions"), 0)
+
+
+@override_settings(PASSWORD_HASHERS=["esgrow_backend.hashers.ScryptPasswordHasher",
+                                     "django.contrib.auth.hashers.PBKDF2PasswordHasher"],
+                   SCRYPT_WORK_FACTOR=2 ** 10)
+class PasswordHashingTests(EsgrowTestCase):
+    def login(self, user: User):
+        response = self.client.post(reverse("login"), {"username": user.username, "password": "password"})
+        self.assertEqual(response.status_code, 200, response.data)
+        user.refresh_from_db()
+
+    def test_registration_writes_the_user_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse("users"), {"username": "dave", "email": "dave@esgrow.org",
+                                                           "password": "password"})
+        self.assertEqual(response.status_code, 201, response.data)
+        writes = [query["sql"] for query in queries if '"esgrow_backend_user"' in query["sql"]
+                  and not query["sql"].startswith("SELECT")]
+        self.assertEqual(len(writes), 1, writes)
+        self.assertTrue(User.objects.get(username="dave").password.startswith("scrypt$1024$"))
+
+    def test_older_hashes_are_upgraded_on_login(self):
+        self.alice.password = make_password("password", hasher="pbkdf2_sha256")
+        self.alice.save(update_fields=["password"])
+        self.login(self.alice)
+        self.assertTrue(self.alice.password.startswith("scrypt$1024$"))
+
+        with self.settings(SCRYPT_WORK_FACTOR=2 ** 11):
+            self.login(self.alice)
+        self.assertTrue(self.alice.password.startswith("scrypt$2048$"))
+
+    def test_every_configured_hash_fits_the_password_column(self):
+        max_length = User._meta.get_field("password").max_length
+        for path in project_settings.PASSWORD_HASHERS:
+            with self.subTest(hasher=path):
+                hasher = import_string(path)()
+                try:
+                    encoded = make_password("x", hasher=hasher)
+                except ValueError:
+                    self.skipTest(f"{path} needs a library that is not installed")
+                self.assertLessEqual(len(encoded), max_length)
+
+
+class BenchmarkTests(EsgrowTestCase):
+    def test_seed_is_skewed(self):
+        dataset = benchmarks.seed(users=30, escrows=300, disputes=10, monetary=20, random_seed=1)
+        self.assertEqual(User.objects.count(), 33)
+        self.assertEqual(Disputes.objects.count(), 10)
+        busiest, quietest = dataset.users[0], dataset.users[-1]
+        self.assertGreater(EscrowTransactions.objects.filter(Q(from_user=busiest) | Q(to_user=busiest)).count(),
+                           EscrowTransactions.objects.filter(Q(from_user=quietest) | Q(to_user=quietest)).count())
+        response = self.client.post(reverse("login"), {"username": quietest.username,
+                                                       "password": benchmarks.PASSWORD})
+        self.assertEqual(response.status_code, 200)
+
+    def test_every_benchmark_runs(self):
+        dataset = benchmarks.seed(users=10, escrows=20, disputes=2, monetary=5)
+        for name in benchmarks.BENCHMARKS:
+            result = benchmarks.run(name, "wsgi", dataset, count=3)
+            self.assertEqual(result["requests"], 3, name)
+            self.assertGreater(result["queries_per_request"], 0, name)
+        rates = benchmarks.renderer_rates(rows=10, rounds=1)
+        self.assertEqual({rate["rows"] for rate in rates.values()}, {10})
+
+    def test_compare(self):
+        result = {"requests": 10, "requests_per_second": 100.0, "p50_ms": 5.0, "p95_ms": 8.0, "p99_ms": 9.0,
+                  "queries_per_request": 3.0}
+        baseline = {"results": {"listing": {"wsgi": result}}}
+        self.assertEqual(benchmarks.compare(baseline, baseline, tolerance=0.25), [])
+
+        slower = dict(result, p95_ms=20.0, queries_per_request=4.0)
+        regressions = benchmarks.compare(baseline, {"results": {"listing": {"wsgi": slower}}}, tolerance=0.25)
+        self.assertEqual(len(regressions), 2)
+
+
+class ExportTests(EsgrowTestCase):
+    def setUp(self):
+        super().setUp()
+        for _ in range(5):
+            create_escrow(self.alice, self.bob, amount="10.25")
+        disputed = create_escrow(self.carol, self.alice)
+        create_escrow(self.bob, self.carol)
+        Disputes.objects.create(transaction=disputed, user_initiated=self.carol, reason="late",
+                                stage=DisputeStage.Pending)
+        MonetaryTransactions.objects.create(user=self.alice, external_entity="mpesa", amount=Decimal("99.99"),
+                                            stage=TransactionStage.Completed)
+
+    def export(self, kind, file_format, **params):
+        response = self.client.get(reverse("export", args=[kind, file_format]), params,
+                                   HTTP_ACCEPT="text/csv")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode("utf-8")
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export("transactions", "csv"))))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0]["from_username"], "alice")
+        self.assertEqual(rows[0]["amount"], "10.25")
+
+    def test_ndjson(self):
+        lines = self.export("disputes", "ndjson").splitlines()
+        self.assertEqual([json.loads(line)["reason"] for line in lines], ["late"])
+
+        lines = self.export("monetary", "ndjson").splitlines()
+        self.assertEqual(json.loads(lines[0])["amount"], "99.99")
+
+    def test_scope(self):
+        self.assertEqual(self.client.get(reverse("export", args=["transactions", "csv"]), {"scope": "all"})
+                         .status_code, 403)
+        self.alice.is_staff = True
+        self.alice.save()
+        rows = list(csv.DictReader(io.StringIO(self.export("transactions", "csv", scope="all"))))
+        self.assertEqual(len(rows), 7)
+
+    def test_unknown_export(self):
+        self.assertEqual(self.client.get(reverse("export", args=["users", "csv"])).status_code, 404)
+        self.assertEqual(self.client.get(reverse("export", args=["transactions", "xml"])).status_code, 404)
+
+
+class ComplianceUploadTests(EsgrowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.content = os.urandom(300 * 1024 + 17)
+
+    def start(self, size=None):
+        response = self.client.post(reverse("create_compliance_document"),
+                                    {"party_b": str(self.bob.id), "filename": "contract.pdf",
+                                     "size": size or len(self.content)}, format="json")
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.json()["data"]["upload_id"]
+
+    def put(self, upload_id, start, end):
+        return self.client.put(reverse("upload_compliance_document", args=[upload_id]), self.content[start:end],
+                               content_type="application/octet-stream",
+                               HTTP_CONTENT_RANGE=f"bytes {start}-{end - 1}/{len(self.content)}")
+
+    def upload(self, chunk_size=100 * 1024):
+        upload_id = self.start()
+        for start in range(0, len(self.content), chunk_size):
+            response = self.put(upload_id, start, min(start + chunk_size, len(self.content)))
+            self.assertEqual(response.status_code, 200, response.data)
+        return response.json()["data"]["document"]
+
+    def test_chunked_upload_and_download(self):
+        document = self.upload()
+        self.assertEqual(document["sha256"], hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(document["size"], len(self.content))
+        self.assertFalse(os.listdir(os.path.join(self.media_root, "uploads")))
+
+        url = reverse("download_compliance_document", args=[document["compliance_id"]])
+        response = self.client.get(url)
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+
+        response = self.client.get(url, HTTP_RANGE="bytes=100-199")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.content[100:200])
+        response = self.client.get(url, HTTP_RANGE="bytes=-10")
+        self.assertEqual(b"".join(response.streaming_content), self.content[-10:])
+
+        self.authenticate(self.carol)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_resume_after_a_conflict(self):
+        upload_id = self.start()
+        self.assertEqual(self.put(upload_id, 0, 1000).status_code, 200)
+        response = self.put(upload_id, 5000, 6000)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["data"]["received"], 1000)
+
+        # as if the next chunk went to another worker, which has to hash from disk
+        hash_cache.take(uuid.UUID(upload_id), 1000)
+        response = self.put(upload_id, 1000, len(self.content))
+        self.assertEqual(response.json()["data"]["document"]["sha256"], hashlib.sha256(self.content).hexdigest())
+
+    def test_one_writer_per_chunk(self):
+        upload_id = self.start()
+        upload = ComplianceUpload.objects.get(pk=upload_id)
+        # a retry arriving while the first attempt is still writing the chunk
+        uploads.Lease(upload, 0).acquire()
+        response = self.put(upload_id, 0, 1000)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(os.path.exists(uploads.partial_path(upload)))
+
+        # the first attempt died without letting go, its lease runs out
+        ComplianceUpload.objects.filter(pk=upload_id).update(lease_until=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(self.put(upload_id, 0, 1000).status_code, 200)
+        upload.refresh_from_db()
+        self.assertEqual((upload.received, upload.lease_id), (1000, None))
+
+    def test_last_chunk_is_resent_when_finishing_fails(self):
+        upload_id = self.start()
+        self.assertEqual(self.put(upload_id, 0, 1000).status_code, 200)
+        with mock.patch("esgrow_backend.uploads.default_storage.save", side_effect=OSError("disk full")), \
+                self.assertLogs("esgrow_backend", "ERROR"):
+            self.assertEqual(self.put(upload_id, 1000, len(self.content)).status_code, 500)
+        upload = ComplianceUpload.objects.get(pk=upload_id)
+        self.assertEqual((upload.received, upload.document_id, upload.lease_id), (1000, None, None))
+
+        response = self.put(upload_id, 1000, len(self.content))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["received"], len(self.content))
+        self.assertEqual(response.json()["data"]["document"]["sha256"], hashlib.sha256(self.content).hexdigest())
+
+    def test_identical_documents_share_a_file(self):
+        first = self.upload()
+        second = self.upload(chunk_size=64 * 1024)
+        self.assertNotEqual(first["compliance_id"], second["compliance_id"])
+        files = set(ComplianceDocuments.objects.values_list("file", flat=True))
+        self.assertEqual(len(files), 1)
+
+    def test_rejects_bad_ranges(self):
+        upload_id = self.start()
+        response = self.client.put(reverse("upload_compliance_document", args=[upload_id]), b"abc",
+                                   content_type="application/octet-stream", HTTP_CONTENT_RANGE="bytes 0-2/3")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse("create_compliance_document"),
+                                    {"party_b": str(self.bob.id), "filename": "contract.pdf", "size": 0},
+                                    format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class SettlementStressTests(TransactionTestCase):
+    """
+    Both parties of every escrow confirm at the same time from different
+    threads, money must neither be created nor lost
+    """
+    threads = 8
+    escrows = 200
+
+    def confirm(self, transaction_id, column):
+        for attempt in range(200):
+            try:
+                EscrowTransactions.objects.filter(pk=transaction_id).update(**{column: True})
+                settle_transaction(transaction_id)
+                return
+            except OperationalError:
+                # SQLite only allows one writer at a time and reports the
+                # others as locked instead of making them wait
+                time.sleep(0.001 * attempt)
+        raise AssertionError("Could not confirm transaction")
+
+    def test_balances_are_conserved(self):
+        users = [User.objects.create(username=f"user{i}", balance=1000) for i in range(5)]
+        rng = random.Random(7)
+        escrows = [create_escrow(*rng.sample(users, 2), amount=f"{rng.randint(1, 100)}.{rng.randint(0, 99):02}")
+                   for _ in range(self.escrows)]
+
+        work = [(escrow.pk, column) for escrow in escrows for column in ("from_user_confirmed", "to_user_confirmed")]
+        rng.shuffle(work)
+        errors = []
+
+        def worker(items):
+            try:
+                for item in items:
+                    self.confirm(*item)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(work[i::self.threads],)) for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        expected = {user.pk: Decimal(1000) for user in users}
+        for escrow in escrows:
+            expected[escrow.from_user_id] -= escrow.amount
+            expected[escrow.to_user_id] += escrow.amount
+
+        self.assertEqual(dict(User.objects.values_list("id", "balance")), expected)
+        self.assertEqual(sum(expected.values()), Decimal(5000))
+        self.assertFalse(EscrowTransactions.objects.exclude(stage=TransactionStage.Completed).exists())
+
+
+class LedgerTests(EsgrowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dave = create_user("dave")
+        self.erin = create_user("erin")
+
+    def move(self, user: User, amount: str, stage=TransactionStage.Completed) -> MonetaryTransactions:
+        return MonetaryTransactions.objects.create(user=user, external_entity="mpesa", amount=Decimal(amount),
+                                                   stage=stage)
+
+    def test_deposits_and_withdrawals(self):
+        deposit = self.move(self.dave, "500.00")
+        self.move(self.dave, "-120.00")
+        pending = self.move(self.dave, "1000.00", stage=TransactionStage.Pending)
+        deposit.save()
+
+        self.dave.refresh_from_db()
+        self.assertEqual(self.dave.balance, Decimal("380.00"))
+        self.assertEqual(LedgerEntry.objects.filter(user=self.dave).count(), 2)
+
+        pending.stage = TransactionStage.Completed
+        pending.save()
+        self.dave.refresh_from_db()
+        self.assertEqual(self.dave.balance, Decimal("1380.00"))
+        self.assertEqual(ledger.reconcile().keys() & {self.dave.id, self.erin.id}, set())
+
+    def test_escrow_settlement_is_double_entry(self):
+        self.move(self.dave, "300.00")
+        transaction = create_escrow(self.dave, self.erin, amount="75.50")
+        EscrowTransactions.objects.filter(pk=transaction.pk).update(from_user_confirmed=True, to_user_confirmed=True)
+        settle_transaction(transaction.transaction_id)
+
+        legs = LedgerEntry.objects.filter(escrow_transaction=transaction)
+        self.assertEqual(sorted(legs.values_list("amount", flat=True)), [Decimal("-75.50"), Decimal("75.50")])
+        self.assertEqual(len(set(legs.values_list("posting_id", flat=True))), 1)
+        self.assertEqual(ledger.reconcile().keys() & {self.dave.id, self.erin.id}, set())
+
+    def test_balance_as_of(self):
+        now = timezone.now()
+        days = [now - datetime.timedelta(days=d) for d in (10, 5, 1)]
+        for when, amount in zip(days, ("100.00", "50.00", "-30.00")):
+            transaction = self.move(self.dave, amount)
+            LedgerEntry.objects.filter(monetary_transaction=transaction).update(created_date=when)
+
+        self.assertEqual(ledger.take_snapshots(now - datetime.timedelta(days=3)), 1)
+        self.assertEqual(ledger.take_snapshots(now - datetime.timedelta(days=4)), 0)
+        snapshot = BalanceSnapshot.objects.get(user=self.dave)
+        self.assertEqual(snapshot.balance, Decimal("150.00"))
+
+        self.assertEqual(ledger.balance_as_of(self.dave.id, now - datetime.timedelta(days=20)), 0)
+        self.assertEqual(ledger.balance_as_of(self.dave.id, now - datetime.timedelta(days=7)), Decimal("100.00"))
+        self.assertEqual(ledger.balance_as_of(self.dave.id, now - datetime.timedelta(days=2)), Decimal("150.00"))
+        self.assertEqual(ledger.balance_as_of(self.dave.id, now), Decimal("120.00"))
+
+        self.assertEqual(ledger.take_snapshots(now), 1)
+        self.assertEqual(BalanceSnapshot.objects.filter(user=self.dave).latest("as_of").balance, Decimal("120.00"))
+
+    def test_postings_must_balance(self):
+        with self.assertRaises(ValueError):
+            ledger.post({self.dave.id: Decimal(10)}, LedgerEntryKind.Deposit)
+
+
+class StatementTests(EsgrowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dave = create_user("dave")
+        self.erin = create_user("erin")
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def at(self, day: str, entries):
+        entries.update(created_date=timezone.make_aware(datetime.datetime.fromisoformat(day)))
+
+    def move(self, user: User, amount: str, day: str):
+        transaction = MonetaryTransactions.objects.create(user=user, external_entity="mpesa", amount=Decimal(amount),
+                                                          stage=TransactionStage.Completed)
+        self.at(day, LedgerEntry.objects.filter(monetary_transaction=transaction))
+
+    def statements(self) -> dict:
+        rows = {}
+        for path in sorted(os.listdir(self.directory)):
+            for shard in sorted(os.listdir(os.path.join(self.directory, path))) if path != "manifest.json" else ():
+                with gzip.open(os.path.join(self.directory, path, shard), "rt", newline="") as file:
+                    for row in csv.DictReader(file):
+                        rows.setdefault((row["user_id"], row["month"]), []).append(row)
+        return rows
+
+    def setUpLedger(self):
+        self.move(self.dave, "500.00", "2026-01-10 12:00")
+        transaction = create_escrow(self.dave, self.erin, amount="75.50")
+        EscrowTransactions.objects.filter(pk=transaction.pk).update(from_user_confirmed=True, to_user_confirmed=True)
+        settle_transaction(transaction.transaction_id)
+        self.at("2026-02-03 09:00", LedgerEntry.objects.filter(escrow_transaction=transaction))
+        self.move(self.dave, "-20.00", "2026-02-20 18:00")
+        User.objects.filter(pk__in=[self.dave.pk, self.erin.pk]).update(
+            created_date=timezone.make_aware(datetime.datetime(2026, 1, 1)))
+
+    def test_balances_as_of(self):
+        self.setUpLedger()
+        ledger.take_snapshots(timezone.make_aware(datetime.datetime(2026, 1, 20)))
+        for day in ("2026-01-01", "2026-01-15", "2026-02-10", "2026-03-01"):
+            when = timezone.make_aware(datetime.datetime.fromisoformat(day))
+            balances = ledger.balances_as_of([self.dave.id, self.erin.id], when)
+            self.assertEqual(balances, {user.id: ledger.balance_as_of(user.id, when)
+                                        for user in (self.dave, self.erin)})
+        self.assertEqual(balances, {self.dave.id: Decimal("404.50"), self.erin.id: Decimal("75.50")})
+
+    def test_generate(self):
+        self.setUpLedger()
+        report = statements.generate(self.directory, "2026-01", "2026-02", shards=2)
+        self.assertEqual((report["entries"], report["resumed"], report["months"]), (4, 0, 2))
+        # the other users joined after February
+        self.assertEqual(report["statements"], 4)
+
+        rows = self.statements()
+        dave, erin = str(self.dave.id), str(self.erin.id)
+        self.assertEqual([row["type"] for row in rows[dave, "2026-01"]], ["opening", "entry", "closing"])
+        self.assertEqual(rows[dave, "2026-01"][-1]["balance"], "500.00")
+        self.assertEqual(rows[dave, "2026-02"][0]["balance"], "500.00")
+        self.assertEqual([row["balance"] for row in rows[dave, "2026-02"]], ["500.00", "424.50", "404.50", "404.50"])
+        self.assertEqual(rows[dave, "2026-02"][1]["kind"], LedgerEntryKind.Escrow)
+        self.assertEqual([row["balance"] for row in rows[erin, "2026-01"]], ["0", "0"])
+        self.assertEqual(rows[erin, "2026-02"][-1]["balance"], "75.50")
+
+        # a rerun only writes what is missing, continuing from the files written
+        report = statements.generate(self.directory, "2026-01", "2026-02", shards=2)
+        self.assertEqual((report["entries"], report["resumed"]), (0, 4))
+        february = os.path.join(self.directory, "2026-02")
+        os.remove(os.path.join(february, sorted(os.listdir(february))[0]))
+        report = statements.generate(self.directory, "2026-01", "2026-02", shards=2)
+        self.assertEqual(report["resumed"], 3)
+        self.assertEqual(self.statements(), rows)
+
+    def test_command(self):
+        self.setUpLedger()
+        output = io.StringIO()
+        call_command("generate_statements", "--from", "2026-02", "--output", self.directory, "--workers", "1",
+                     stdout=output)
+        self.assertIn("with 3 entries", output.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("generate_statements", "--from", "February", "--output", self.directory)
@@ -0,0 +1,314 @@
+"""
+Token bucket throttling and load shedding.
+
+A throttled scope (login, register, search) takes a token from up to three
+buckets per request, THROTTLE_RATES gives the rate of each:
+- "token": one bucket per Authorization header, for clients sending one
+- "ip": one bucket per client address, as DRF identifies it (NUM_PROXIES)
+- "global": one bucket shared by every client
+A request finding one of them empty gets a 429 with Retry-After. Buckets
+live in the worker process, or with THROTTLE_DATABASE in a SQLite file the
+workers of a host share, which makes "global" per host instead of per
+worker.
+
+`LoadSheddingMiddleware` answers requests to SHED_VIEWS with a 503 while
+the worker has more than SHED_MAX_IN_FLIGHT requests in flight, or its
+recent queries took more than SHED_DB_LATENCY_MS on average, so the
+expensive endpoints give way and the rest keep their latency in a spike
+"""
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.throttling import BaseThrottle
+
+from esgrow_backend import metrics, renderers, utils
+
+PERIODS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+def parse_rate(rate: str) -> tuple[int, float]:
+    """
+    The capacity and tokens per second of a "<requests>/<period>" rate, the
+    period being second, minute, hour or day
+    """
+    count, period = rate.split("/")
+    return int(count), int(count) / PERIODS[period[0]]
+
+
+def refill(state: tuple[float, float] | None, capacity: int, rate: float, now: float) -> tuple[float, float]:
+    """
+    Take a token from a bucket in `state`, (tokens, updated), None for a
+    full bucket. Returns the tokens left and 0, or the tokens and the
+    seconds until one is available when it is empty
+    """
+    tokens, updated = state or (capacity, now)
+    tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBucketStore:
+    """
+    Buckets in the worker process, the least recently used are dropped
+    (refilled) beyond `max_size`
+    """
+
+    def __init__(self, max_size: int = 100_000):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: int, rate: float, now: float) -> float:
+        """
+        Take a token from the bucket `key`, returns 0 or the seconds to wait
+        """
+        with self._lock:
+            tokens, wait = refill(self._buckets.pop(key, None), capacity, rate, now)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBucketStore:
+    """
+    Buckets in a SQLite file shared by the worker processes of a host.
+
+    A bucket is read and written in one IMMEDIATE transaction, so workers
+    taking from it at once are serialized by the file lock. Buckets that
+    would be full again are deleted every `prune_every` takes
+    """
+
+    def __init__(self, path: str, prune_every: int = 1000):
+        self.path = path
+        self.prune_every = prune_every
+        self._takes = 0
+        self._local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets "
+                               "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, "
+                               "full_at REAL NOT NULL)")
+            self._local.connection = connection
+        return connection
+
+    def take(self, key: str, capacity: int, rate: float, now: float) -> float:
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            state = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, wait = refill(state, capacity, rate, now)
+            connection.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                               (key, tokens, now, now + (capacity - tokens) / rate))
+            self._takes += 1
+            if self._takes % self.prune_every == 0:
+                connection.execute("DELETE FROM buckets WHERE full_at < ?", (now,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+    def clear(self):
+        self.connection().execute("DELETE FROM buckets")
+
+
+_stores = {}
+
+
+def get_store() -> MemoryBucketStore | SQLiteBucketStore:
+    path = getattr(settings, "THROTTLE_DATABASE", None)
+    store = _stores.get(path)
+    if store is None:
+        store = _stores.setdefault(path, SQLiteBucketStore(path) if path else MemoryBucketStore())
+    return store
+
+
+def identities(request):
+    """
+    The (axis, identity) of the buckets of `request`, None when it has none
+    on that axis
+    """
+    authorization = request.headers.get("Authorization")
+    yield "token", hashlib.sha256(authorization.encode()).hexdigest() if authorization else None
+    yield "ip", BaseThrottle().get_ident(request)
+    yield "global", ""
+
+
+def check(request, scope: str) -> float | None:
+    """
+    Take a token from every bucket of `scope` for `request`. Returns None if
+    the request may go ahead, otherwise the seconds the client should wait
+    """
+    rates = getattr(settings, "THROTTLE_RATES", {}).get(scope) or {}
+    store = get_store()
+    now = time.time()
+    for axis, identity in identities(request):
+        rate = rates.get(axis)
+        if rate is None or identity is None:
+            continue
+        wait = store.take(f"{scope}:{axis}:{identity}", *parse_rate(rate), now)
+        if wait:
+            return wait
+    return None
+
+
+async def acheck(request, scope: str) -> float | None:
+    # the shared store blocks on the file lock, keep it off the event loop
+    if isinstance(get_store(), MemoryBucketStore):
+        return check(request, scope)
+    return await sync_to_async(check)(request, scope)
+
+
+class BucketThrottle(BaseThrottle):
+    scope = None
+
+    def allow_request(self, request, view):
+        self.wait_seconds = check(request, self.scope)
+        return self.wait_seconds is None
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class LoginThrottle(BucketThrottle):
+    scope = "login"
+
+
+class RegisterThrottle(BucketThrottle):
+    scope = "register"
+
+
+class SearchThrottle(BucketThrottle):
+    scope = "search"
+
+
+class Overloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "The service is overloaded, try again shortly"
+
+
+def unavailable(exc: APIException, retry_after: float) -> HttpResponse:
+    """
+    The envelope of a `Throttled` or `Overloaded` error, for the async views
+    and the middleware, which DRF's exception handler doesn't see
+    """
+    response = HttpResponse(renderers.dumps(utils.exception_envelope(exc)), status=exc.status_code,
+                            content_type="application/json")
+    response["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+
+class LoadShedder:
+    """
+    The requests in flight in this worker and the average time of its recent
+    queries.
+
+    The average moves `weight` of the way to every request's query time and
+    decays towards zero with a `half_life` in seconds, so it recovers while
+    every request is shed
+    """
+
+    def __init__(self, weight: float = 0.1, half_life: float = 5.0):
+        self.weight = weight
+        self.half_life = half_life
+        self.in_flight = 0
+        self._latency = 0.0
+        self._sampled = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _decayed(self, now: float) -> float:
+        return self._latency * 0.5 ** (max(now - self._sampled, 0) / self.half_life)
+
+    def latency(self, now: float = None) -> float:
+        with self._lock:
+            return self._decayed(time.monotonic() if now is None else now)
+
+    def started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finished(self, stats: metrics.RequestStats | None, now: float = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.in_flight -= 1
+            if stats is not None and stats.queries:
+                latency = self._decayed(now)
+                self._latency = latency + self.weight * (stats.query_time / stats.queries - latency)
+                self._sampled = now
+
+    def overloaded(self) -> str | None:
+        """
+        Why requests should be shed, None while they shouldn't
+        """
+        max_in_flight = getattr(settings, "SHED_MAX_IN_FLIGHT", None)
+        if max_in_flight is not None and self.in_flight > max_in_flight:
+            return "Too many requests in flight, try again shortly"
+        threshold = getattr(settings, "SHED_DB_LATENCY_MS", None)
+        if threshold is not None and self.latency() * 1000 > threshold:
+            return "The database is slow, try again shortly"
+        return None
+
+    def reset(self):
+        with self._lock:
+            self.in_flight = 0
+            self._latency = 0.0
+
+
+shedder = LoadShedder()
+
+
+class LoadSheddingMiddleware:
+    """
+    Put it right after `metrics.InstrumentationMiddleware`, whose request
+    stats it reads the query time from
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        shedder.started()
+        try:
+            return self.get_response(request)
+        finally:
+            shedder.finished(metrics.current_request.get())
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match.url_name not in getattr(settings, "SHED_VIEWS", ()):
+            return None
+        reason = shedder.overloaded()
+        if reason is None:
+            return None
+        return unavailable(Overloaded(reason), getattr(settings, "SHED_RETRY_AFTER", 1))
+
+    async def __acall__(self, request):
+        shedder.started()
+        try:
+            return await self.get_response(request)
+        finally:
+            shedder.finished(metrics.current_request.get())
@@ -0,0 +1,84 @@
+"""
+The escrow state machine.
+
+`TRANSITIONS` lists the stages an escrow may move to from each stage.
+Completed escrows never move again and cancelled ones only when a dispute
+on them is settled, see `esgrow_backend.disputes`. `move` changes the stage
+of escrows with one conditional UPDATE per stage they were read in,
+`WHERE stage = <that stage>`, so of two requests racing to move the same
+escrow only one does, without locking it first, and the other gets
+`IllegalTransition`. Every move is recorded as an `EscrowStageChange` row
+and in the summaries of the parties, in the same transaction
+"""
+import uuid
+from collections import defaultdict
+
+from django.utils import timezone
+
+from esgrow_backend import summaries
+from esgrow_backend.models import EscrowTransactions, EscrowStageChange, TransactionStage
+
+TRANSITIONS = {
+    TransactionStage.Initiated: (TransactionStage.Pending, TransactionStage.Completed, TransactionStage.Cancelled),
+    TransactionStage.Pending: (TransactionStage.Completed, TransactionStage.Cancelled),
+    TransactionStage.Cancelled: (TransactionStage.Completed,),
+    TransactionStage.Completed: (),
+}
+
+# the stages the parties can still confirm, dispute or settle an escrow in
+OPEN_STAGES = (TransactionStage.Initiated, TransactionStage.Pending)
+
+
+class IllegalTransition(Exception):
+    """
+    Raised when an escrow can't move to `target` from the stage it is in,
+    `stage` is None when it moved concurrently
+    """
+
+    def __init__(self, transaction_ids, target: str, stage: str = None):
+        self.transaction_ids = list(transaction_ids)
+        self.target = target
+        self.stage = stage
+        if stage is None:
+            super().__init__(f"Transactions changed stage before they could become {target}")
+        else:
+            super().__init__(f"Transactions that are {stage} can't become {target}")
+
+
+def allowed(stage: str, target: str) -> bool:
+    return target in TRANSITIONS.get(stage, ())
+
+
+def move(rows, target: str, user_id: uuid.UUID = None, disputes=(), **fields):
+    """
+    Move escrows to the `target` stage, setting `fields` on them too.
+
+    `rows` are `(transaction_id, from_user_id, to_user_id, amount, stage)`
+    tuples, with the stage each escrow was read in. Escrows are moved only
+    if they are still in that stage, when one isn't `IllegalTransition` is
+    raised and the caller's atomic block rolls the others back. `disputes`
+    opened or resolved with the move are recorded in the summaries with it,
+    see `summaries.record`.
+
+    Must be called inside an atomic block
+    """
+    rows = list(rows)
+    by_stage = defaultdict(list)
+    for transaction_id, _, _, _, stage in rows:
+        if not allowed(stage, target):
+            raise IllegalTransition([transaction_id], target, stage)
+        by_stage[stage].append(transaction_id)
+
+    now = timezone.now()
+    for stage, transaction_ids in by_stage.items():
+        moved = EscrowTransactions.objects.filter(transaction_id__in=transaction_ids, stage=stage) \
+            .update(stage=target, modified_date=now, **fields)
+        if moved != len(transaction_ids):
+            raise IllegalTransition(transaction_ids, target)
+
+    EscrowStageChange.objects.bulk_create([
+        EscrowStageChange(transaction_id=transaction_id, from_stage=stage, to_stage=target, user_id=user_id)
+        for transaction_id, _, _, _, stage in rows
+    ])
+    summaries.record(escrows=[(from_user_id, to_user_id, amount, stage, target)
+                              for _, from_user_id, to_user_id, amount, stage in rows], disputes=disputes)
@@ -0,0 +1,273 @@
+import datetime
+import hashlib
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from esgrow_backend.models import ComplianceDocuments, ComplianceUpload
+
+CHUNK_SIZE = 64 * 1024
+
+CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class UploadConflict(Exception):
+    """
+    Raised when a chunk doesn't start where the upload left off, `received`
+    is where the client should resume from
+    """
+
+    def __init__(self, received: int):
+        super().__init__(f"Upload continues at byte {received}")
+        self.received = received
+
+
+class HashCache:
+    """
+    The running SHA-256 of uploads in progress in this process, so chunks
+    are hashed as they arrive.
+
+    hashlib objects can't be stored in the database, when the next chunk of
+    an upload lands on another worker (or after a restart) the file written
+    so far is hashed again from disk instead
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, upload_id, offset: int):
+        """
+        Remove and return the hash of the first `offset` bytes of an upload,
+        None if this process doesn't have it
+        """
+        with self._lock:
+            entry = self._hashes.pop(upload_id, None)
+        if entry is None or entry[0] != offset:
+            return None
+        return entry[1]
+
+    def put(self, upload_id, offset: int, sha256):
+        with self._lock:
+            self._hashes[upload_id] = (offset, sha256)
+            while len(self._hashes) > self.max_size:
+                self._hashes.popitem(last=False)
+
+
+hash_cache = HashCache()
+
+
+def partial_path(upload: ComplianceUpload) -> str:
+    return os.path.join(settings.MEDIA_ROOT, "uploads", f"{upload.upload_id}.part")
+
+
+def hash_file(path: str, length: int):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            sha256.update(chunk)
+            length -= len(chunk)
+    return sha256
+
+
+def parse_content_range(header: str, size: int) -> tuple[int, int]:
+    """
+    Parse `Content-Range: bytes <start>-<end>/<size>` into (start, end + 1)
+    """
+    match = CONTENT_RANGE.match(header or "")
+    if match is None:
+        raise ValueError("Expected a Content-Range header of the form bytes <start>-<end>/<size>")
+    start, end, total = (int(group) for group in match.groups())
+    if total != size or start > end or end >= size:
+        raise ValueError(f"Content-Range must be within the {size} bytes of the upload")
+    return start, end + 1
+
+
+class Lease:
+    """
+    The exclusive right of one request to write an upload's partial file,
+    taken while the upload is at `start` and renewed before every write
+    once half of it has passed
+    """
+
+    def __init__(self, upload: ComplianceUpload, start: int):
+        self.upload = upload
+        self.start = start
+        self.lease_id = uuid.uuid4()
+        self.seconds = getattr(settings, "UPLOAD_LEASE", 60)
+        self.until = None
+
+    def acquire(self):
+        now = timezone.now()
+        until = now + datetime.timedelta(seconds=self.seconds)
+        if not ComplianceUpload.objects.filter(Q(lease_until__isnull=True) | Q(lease_until__lt=now),
+                                               pk=self.upload.pk, received=self.start) \
+                .update(lease_id=self.lease_id, lease_until=until):
+            # either the upload moved on or another request is writing this chunk
+            self.upload.refresh_from_db(fields=["received"])
+            raise UploadConflict(self.upload.received)
+        self.until = until
+
+    def renew(self):
+        now = timezone.now()
+        if now < self.until - datetime.timedelta(seconds=self.seconds / 2):
+            return
+        until = now + datetime.timedelta(seconds=self.seconds)
+        if not ComplianceUpload.objects.filter(pk=self.upload.pk, lease_id=self.lease_id).update(lease_until=until):
+            # it expired and another request took over the file
+            self.upload.refresh_from_db(fields=["received"])
+            raise UploadConflict(self.upload.received)
+        self.until = until
+
+    def release(self, **fields) -> bool:
+        return bool(ComplianceUpload.objects.filter(pk=self.upload.pk, lease_id=self.lease_id)
+                    .update(lease_id=None, lease_until=None, **fields))
+
+
+def write_chunk(upload: ComplianceUpload, stream, start: int, end: int) -> ComplianceUpload:
+    """
+    Copy bytes [start, end) of the upload from `stream` to its partial file,
+    hashing them on the way, and finish the upload when it is complete.
+
+    The body is read CHUNK_SIZE bytes at a time so memory use doesn't depend
+    on the chunk size the client picked. The file is only touched under the
+    upload's lease, so two requests for the same range (a client retrying
+    one that is still running) never write it at once
+    """
+    if start != upload.received:
+        raise UploadConflict(upload.received)
+    if stream is None:
+        raise ValueError("Request body is empty")
+
+    lease = Lease(upload, start)
+    lease.acquire()
+    try:
+        path = partial_path(upload)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        sha256 = hash_cache.take(upload.upload_id, start)
+        if sha256 is None:
+            sha256 = hash_file(path, start) if start else hashlib.sha256()
+
+        remaining = end - start
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = stream.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                lease.renew()
+                f.write(chunk)
+                sha256.update(chunk)
+                remaining -= len(chunk)
+            # drop anything left behind by an earlier attempt that failed halfway
+            f.truncate()
+        if remaining:
+            raise ValueError(f"Request body ended {remaining} bytes short of the Content-Range")
+        if end == upload.size:
+            return finish(upload, sha256.hexdigest(), lease)
+    except BaseException:
+        lease.release()
+        raise
+
+    if not lease.release(received=end):
+        upload.refresh_from_db(fields=["received"])
+        raise UploadConflict(upload.received)
+    upload.received = end
+    hash_cache.put(upload.upload_id, end, sha256)
+    return upload
+
+
+def finish(upload: ComplianceUpload, digest: str, lease: Lease) -> ComplianceUpload:
+    """
+    Turn a complete upload into a compliance document, reusing the stored
+    file of a document with the same content if there is one.
+
+    The last chunk is only counted as received in the transaction creating
+    the document, if storing the file fails the client sends it again
+    """
+    path = partial_path(upload)
+    existing = ComplianceDocuments.objects.filter(sha256=digest).exclude(file="") \
+        .values_list("file", flat=True).first()
+    if existing is not None:
+        name = existing
+    else:
+        extension = os.path.splitext(upload.filename)[1][:10]
+        with open(path, "rb") as f:
+            name = default_storage.save(f"compliance/{digest[:2]}/{digest}{extension}", File(f))
+
+    lease.renew()
+    with transaction.atomic():
+        document = ComplianceDocuments.objects.create(party_a_id=upload.party_a_id, party_b_id=upload.party_b_id,
+                                                      file=name, sha256=digest, size=upload.size)
+        released = lease.release(received=upload.size, document=document)
+        if not released:
+            # the lease ran out while storing and another request took over
+            transaction.set_rollback(True)
+    if not released:
+        upload.refresh_from_db(fields=["received"])
+        raise UploadConflict(upload.received)
+    upload.received = upload.size
+    upload.document = document
+    os.remove(path)
+    return upload
+
+
+def file_response(document: ComplianceDocuments, range_header: str = None):
+    """
+    Serve a document, either whole through FileResponse (which WSGI servers
+    can hand to sendfile) or the single byte range a client asked for
+    """
+    f = document.file.open("rb")
+    size = document.size if document.size is not None else document.file.size
+    filename = f"{document.compliance_id}{os.path.splitext(document.file.name)[1]}"
+
+    match = RANGE.match(range_header or "")
+    if match is None or match.groups() == ("", ""):
+        response = FileResponse(f, as_attachment=True, filename=filename)
+        response["Accept-Ranges"] = "bytes"
+        return response
+
+    first, last = match.groups()
+    if first == "":
+        # a suffix range, the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        f.close()
+        response = StreamingHttpResponse([], status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    def read_range():
+        with f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    response = StreamingHttpResponse(read_range(), status=206, content_type="application/octet-stream")
+    response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
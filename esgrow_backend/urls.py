@@ -1,14 +1,27 @@
 from django.urls import path, include
 
 from .views import LoginUserView, CreateUserView, EscrowTransactionsView, EscrowTransactionAddView, confirm_transaction, \
-    search_users, dispute_transaction
+    search_users, dispute_transaction, confirm_transactions, EscrowTransactionBulkAddView, \
+    ExportView, create_compliance_document, upload_compliance_document, download_compliance_document, user_summary, \
+    dispute_queue, assign_disputes, resolve_disputes
 
 urlpatterns = [
     path("v1/users/register", CreateUserView.as_view(), name="users"),
     path("v1/users/login", LoginUserView.as_view(), name="login"),
     path("v1/transactions/view", EscrowTransactionsView.as_view(), name="view_transactions"),
-    path("v1/transactions/confirm/<uuid:transaction_id>", confirm_transaction, name=""),
+    path("v1/transactions/confirm", confirm_transactions, name="confirm_transactions"),
+    path("v1/transactions/confirm/<uuid:transaction_id>", confirm_transaction, name="confirm_transaction"),
     path("v1/transactions/dispute/<uuid:transaction_id>", dispute_transaction, name="dispute_transaction"),
     path("v1/transactions/create", EscrowTransactionAddView.as_view(), name="create_transactions"),
-    path("v1/users/search", search_users, name="search_users")
+    path("v1/transactions/create/bulk", EscrowTransactionBulkAddView.as_view(), name="bulk_create_transactions"),
+    path("v1/disputes", dispute_queue, name="dispute_queue"),
+    path("v1/disputes/assign", assign_disputes, name="assign_disputes"),
+    path("v1/disputes/resolve", resolve_disputes, name="resolve_disputes"),
+    path("v1/users/search", search_users, name="search_users"),
+    path("v1/users/summary", user_summary, name="user_summary"),
+    path("v1/exports/<str:kind>/<str:file_format>", ExportView.as_view(), name="export"),
+    path("v1/compliance/uploads", create_compliance_document, name="create_compliance_document"),
+    path("v1/compliance/uploads/<uuid:upload_id>", upload_compliance_document, name="upload_compliance_document"),
+    path("v1/compliance/documents/<uuid:compliance_id>/file", download_compliance_document,
+         name="download_compliance_document"),
 ]
@@ -1,16 +1,110 @@
-from rest_framework.views import exception_handler
+import http
+import logging
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+
+def status_description(status_code: int) -> str:
+    try:
+        return http.HTTPStatus(status_code).phrase.upper()
+    except ValueError:
+        return str(status_code)
+
+
+def envelope(data=None, status_code: int = status.HTTP_200_OK, errors=None, description: str = None) -> dict:
+    """
+    The body every endpoint answers with
+    """
+    return {"status": status_code,
+            "status_description": description or status_description(status_code),
+            "errors": errors if errors is not None else {},
+            "data": data if data is not None else {}}
+
+
+def response_envelope(response: Response) -> dict:
+    """
+    The envelope a DRF response is rendered as, views return their plain data
+    and `esgrow_backend.renderers` wraps it
+    """
+    if getattr(response, "enveloped", False) or response.exception:
+        return response.data
+    return envelope(response.data, response.status_code)
+
+
+def enveloped_response(body: dict, status_code: int) -> Response:
+    """
+    A response whose data already is an envelope, e.g. a stored one
+    """
+    response = Response(body, status=status_code)
+    response.enveloped = True
+    return response
+
+
+class APIError(APIException):
+    """
+    An error response with `errors` keyed by field, and optionally `data`
+    """
+
+    def __init__(self, status_code: int, errors: dict, data=None, description: str = None):
+        super().__init__(detail=errors)
+        self.status_code = status_code
+        self.errors = errors
+        self.data = data
+        self.description = description
+
+
+def error_details(detail) -> dict:
+    """
+    DRF exception details as the errors of the envelope, always keyed by
+    field
+    """
+    if isinstance(detail, dict):
+        return detail
+    if isinstance(detail, list):
+        return {"non_field_errors": detail}
+    return {"detail": [detail]}
+
+
+def exception_envelope(exc: APIException) -> dict:
+    """
+    The envelope `custom_exception_handler` renders a DRF exception in
+    """
+    if isinstance(exc, APIError):
+        return envelope(exc.data, exc.status_code, exc.errors, exc.description)
+    detail = exc.detail if isinstance(exc.detail, (list, dict)) else {"detail": exc.detail}
+    return envelope(status_code=exc.status_code, errors=error_details(detail))
 
 
 def custom_exception_handler(exc, context):
+    """
+    Render every exception a view raises in the envelope, unexpected ones as
+    a 500 so clients always get the same shape
+    """
+    # rest_framework.views reads DEFAULT_RENDERER_CLASSES on import, whose
+    # renderer imports this module
+    from rest_framework.views import exception_handler, set_rollback
+
+    if isinstance(exc, APIError):
+        set_rollback()
+        response = Response(exception_envelope(exc), status=exc.status_code)
+        response.enveloped = True
+        return response
+
     # Call REST framework's default exception handler first,
     # to get the standard error response.
     response = exception_handler(exc, context)
-
-    # # Now add the HTTP status code to the response.
-    # if response is not None:
-    #     response.data['status'] = response.status_code
-    # response.data['errors'] = {exc.get_codes(): [str(exc)]}
-    # response.data["status_description"] = exc.get_codes()
-    # response.data.pop('detail', None)
-    # response.data["data"] = {}
+    if response is None:
+        set_rollback()
+        logger.exception("Unhandled exception in %s", context["view"].__class__.__name__, exc_info=exc)
+        message = str(exc) if settings.DEBUG else "Internal server error"
+        response = Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        response.data = envelope(status_code=response.status_code, errors={"exception": [message]})
+    else:
+        response.data = envelope(status_code=response.status_code, errors=error_details(response.data))
+    response.enveloped = True
     return response
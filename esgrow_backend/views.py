@@ -1,24 +1,39 @@
 import json
 import uuid
 import datetime
-from django.db.models import Q
+from django.db.transaction import atomic
+from django.db.models import Q, QuerySet
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.utils.dateparse import parse_datetime
 
 from django.contrib.auth.decorators import login_required
 from rest_framework import permissions, status
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
-from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, throttle_classes
 from rest_framework.exceptions import ValidationError
 from rest_framework.generics import CreateAPIView, RetrieveAPIView, UpdateAPIView
 from django.contrib.auth import get_user_model  # If used custom user model
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from esgrow_backend.app_serializers import EscrowTransactionSerializer, EscrowViewTransactionSerializer, \
-    LoggedInUserSerializer, UserSerializer, DisputeSerializer
-from esgrow_backend.models import User, EscrowTransactions, TransactionStage, Disputes, DisputeStage
+    LoggedInUserSerializer, UserSerializer, DisputeSerializer, EscrowTransactionBulkItemSerializer, \
+    ComplianceUploadSerializer, UserSummarySerializer, DisputeQueueSerializer, DisputeAssignSerializer, \
+    DisputeResolveSerializer
+from esgrow_backend.models import User, EscrowTransactions, TransactionStage, Disputes, DisputeStage, \
+    ComplianceDocuments, ComplianceUpload, EventKind
+from esgrow_backend.pagination import keyset_paginate, parse_page_size
+from esgrow_backend.querysets import optimise_queryset
+from esgrow_backend import disputes, exports, metrics, outbox, renderers, search, settlement, summaries, \
+    transitions, uploads, utils
+from esgrow_backend.authentication import CachedTokenAuthentication
+from esgrow_backend.idempotency import idempotent
+from esgrow_backend.throttling import LoginThrottle, RegisterThrottle, SearchThrottle
+from esgrow_backend.utils import APIError
 
 
 class CreateUserView(CreateAPIView):
@@ -26,74 +41,46 @@ class CreateUserView(CreateAPIView):
     permission_classes = [
         permissions.AllowAny  # Or anon users can't register
     ]
+    throttle_classes = [RegisterThrottle]
     serializer_class = LoggedInUserSerializer
 
     def create(self, request, *args, **kwargs):
-        try:
-            serializer = self.get_serializer(data=request.data)
-            serializer.is_valid(raise_exception=True)
-            self.perform_create(serializer)
-
-            headers = self.get_success_headers(serializer.data)
-            token, created = Token.objects.get_or_create(user=serializer.instance)
-            response_data = {"status": status.HTTP_201_CREATED,
-                             "status_description": "CREATED",
-                             "errors": {},
-                             "data": {'auth_token': token.key,
-                                      "id": serializer.data["id"],
-                                      'username': serializer.data["username"],
-                                      'email': serializer.data["email"],
-                                      'first_name': serializer.data["first_name"],
-                                      'last_name': serializer.data["last_name"],
-                                      'balance': serializer.data["balance"],
-                                      }}
-
-            return Response(response_data,
-                            status=status.HTTP_201_CREATED, headers=headers)
-        except ValidationError as e:
-            response_data = {"status": status.HTTP_400_BAD_REQUEST, "status_description": "Bad request",
-                             "errors": e.detail,
-                             "data": {}}
-            return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
-        except Exception as e:
-            response_data = {"status": status.HTTP_400_BAD_REQUEST, "status_description": "Bad request",
-                             "errors": {"exception": [f"${e}"]},
-                             "data": {}}
-            return Response(response_data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        self.perform_create(serializer)
+
+        headers = self.get_success_headers(serializer.data)
+        token, created = Token.objects.get_or_create(user=serializer.instance)
+        response_data = {'auth_token': token.key,
+                         "id": serializer.data["id"],
+                         'username': serializer.data["username"],
+                         'email': serializer.data["email"],
+                         'first_name': serializer.data["first_name"],
+                         'last_name': serializer.data["last_name"],
+                         'balance': serializer.data["balance"],
+                         }
+        return Response(response_data, status=status.HTTP_201_CREATED, headers=headers)
 
 
 class LoginUserView(ObtainAuthToken):
+    throttle_classes = [LoginThrottle]
 
     def post(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data,
                                            context={'request': request})
-        try:
-
-            serializer.is_valid(raise_exception=True)
-            user: User = serializer.validated_data['user']
-            token, created = Token.objects.get_or_create(user=user)
-            response_data = {"status": status.HTTP_200_OK,
-                             "status_description": "OK", "errors": {},
-                             "data": {
-                                 'auth_token': token.key,
-                                 'id': user.id,
-                                 'username': user.username,
-                                 "email": user.email,
-                                 "first_name": user.first_name,
-                                 "last_name": user.last_name,
-                                 "balance": user.balance
-                             }}
-            return Response(response_data, status=status.HTTP_200_OK, )
-        except ValidationError as e:
-            response_data = {"status": status.HTTP_400_BAD_REQUEST, "status_description": "Bad request",
-                             "errors": e.detail,
-                             "data": {}}
-            return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
-        except Exception as e:
-            response_data = {"status": status.HTTP_400_BAD_REQUEST, "status_description": "Bad request",
-                             "errors": {"exception": [f"${e}"]},
-                             "data": {}}
-            return Response(response_data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        serializer.is_valid(raise_exception=True)
+        user: User = serializer.validated_data['user']
+        token, created = Token.objects.get_or_create(user=user)
+        response_data = {
+            'auth_token': token.key,
+            'id': user.id,
+            'username': user.username,
+            "email": user.email,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "balance": user.balance
+        }
+        return Response(response_data, status=status.HTTP_200_OK)
 
 
 class EscrowTransactionsView(APIView):
@@ -102,23 +89,62 @@ class EscrowTransactionsView(APIView):
     serializer_class = EscrowViewTransactionSerializer
 
     def get(self, request):
-        user = User.objects.get(username=request.user.username)
-        transactions_from = EscrowTransactions.objects.filter(from_user=user).prefetch_related("from_user")
-        transactions_to = EscrowTransactions.objects.filter(to_user=user).prefetch_related("to_user")
-
-        transactions_from_serialized = self.serializer_class(transactions_from, many=True)
-        transactions_to_serialized = self.serializer_class(transactions_to, many=True)
-
-        response_data = {"status": status.HTTP_200_OK,
-                         "status description": "Ok",
-                         "errors": {},
-                         "data": {
-                             "from_user": transactions_from_serialized.data,
-                             "to_user": transactions_to_serialized.data
-                         }}
-        return Response(response_data, status=status.HTTP_200_OK)
-
-
+        transactions = self.filter_transactions(request.user, request.query_params)
+        limit = parse_page_size(request.query_params.get("limit"))
+        page, next_cursor = keyset_paginate(transactions, request.query_params.get("cursor"), limit,
+                                            key_field="transaction_id")
+
+        transactions_serialized = self.serializer_class(page, many=True)
+        return Response({"transactions": transactions_serialized.data, "next_cursor": next_cursor},
+                        status=status.HTTP_200_OK)
+
+    @staticmethod
+    def filter_transactions(user: User, params) -> list[QuerySet]:
+        """
+        Build the transactions querysets for `user` from the query parameters,
+        one per side of the escrows the user is on, so each is paged along
+        its own (user, created_date) index (see `keyset_paginate`)
+
+        Supported parameters are `direction` (from, to or both), `stage`,
+        `created_after`, `created_before` and `counterparty` (a user id)
+        """
+        direction = params.get("direction", "both")
+        if direction not in ("from", "to", "both"):
+            raise ValidationError({"direction": ["Expected one of from, to or both"]})
+        filters = {}
+
+        stage = params.get("stage")
+        if stage:
+            if stage not in TransactionStage.values:
+                raise ValidationError({"stage": [f"Expected one of {', '.join(TransactionStage.values)}"]})
+            filters["stage"] = stage
+
+        for param, lookup in (("created_after", "created_date__gte"), ("created_before", "created_date__lt")):
+            value = params.get(param)
+            if value:
+                parsed = parse_datetime(value)
+                if parsed is None:
+                    raise ValidationError({param: ["Expected an ISO 8601 datetime"]})
+                filters[lookup] = parsed
+
+        counterparty = params.get("counterparty")
+        if counterparty:
+            try:
+                counterparty = uuid.UUID(counterparty)
+            except ValueError:
+                raise ValidationError({"counterparty": ["Expected a user id"]})
+
+        transactions = []
+        for side, other in (("from", "to"), ("to", "from")):
+            if direction in (side, "both"):
+                queryset = EscrowTransactions.objects.filter(**{f"{side}_user": user}, **filters)
+                if counterparty:
+                    queryset = queryset.filter(**{f"{other}_user_id": counterparty})
+                transactions.append(optimise_queryset(queryset, EscrowViewTransactionSerializer))
+        return transactions
+
+
+@method_decorator(idempotent, name="post")
 class EscrowTransactionAddView(CreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = EscrowTransactionSerializer
@@ -126,37 +152,182 @@ class EscrowTransactionAddView(CreateAPIView):
     def create(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data,
                                            context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        if request.user not in (serializer.validated_data['from_user'], serializer.validated_data['to_user']):
+            raise ValidationError({"user_id": ["Logged in user is not part of the transaction"]})
+        self.perform_create(serializer)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class EscrowTransactionBulkAddView(APIView):
+    """
+    Create many escrows in one request.
+
+    All rows are validated up front, with a single lookup for the users they
+    reference, then inserted with `bulk_create` in chunks, all in one
+    transaction: either every escrow is created or none is, and a failure
+    is answered like any other by the exception handler
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = EscrowTransactionBulkItemSerializer
+
+    chunk_size = 1000
+    max_rows = 50000
+
+    def post(self, request):
+        rows = request.data.get("transactions") if isinstance(request.data, dict) else None
+        if not isinstance(rows, list) or not rows:
+            raise ValidationError({"transactions": ["Expected a non empty list of transactions"]})
+        if len(rows) > self.max_rows:
+            raise ValidationError({"transactions": [f"At most {self.max_rows} transactions per request"]})
+
+        serializer = self.serializer_class(data=rows, many=True)
+        serializer.is_valid(raise_exception=True)
+        self.check_users(request.user, serializer.validated_data)
+
+        transactions = [EscrowTransactions(from_user_id=row["from_user"], to_user_id=row["to_user"],
+                                           amount=row["amount"], stage=TransactionStage.Initiated)
+                        for row in serializer.validated_data]
+        with atomic():
+            transaction_ids = self.create_chunks(transactions)
+        return Response({"transaction_ids": transaction_ids}, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def check_users(user: User, rows: list[dict]):
+        """
+        Check every referenced user exists and the logged in user is part of
+        every transaction, with one query per 500 distinct users
+        """
+        user_ids = list({row["from_user"] for row in rows} | {row["to_user"] for row in rows})
+        existing = set()
+        for start in range(0, len(user_ids), 500):
+            existing.update(User.objects.filter(id__in=user_ids[start:start + 500]).values_list("id", flat=True))
+
+        errors = {}
+        for index, row in enumerate(rows):
+            row_errors = {}
+            for field in ("from_user", "to_user"):
+                if row[field] not in existing:
+                    row_errors[field] = [f"Invalid pk \"{row[field]}\" - object does not exist."]
+            if user.id not in (row["from_user"], row["to_user"]):
+                row_errors["user_id"] = ["Logged in user is not part of the transaction"]
+            if row_errors:
+                errors[str(index)] = row_errors
+        if errors:
+            raise ValidationError(errors)
+
+    def create_chunks(self, transactions: list[EscrowTransactions]) -> list[uuid.UUID]:
+        transaction_ids = []
+        for start in range(0, len(transactions), self.chunk_size):
+            chunk = EscrowTransactions.objects.bulk_create(transactions[start:start + self.chunk_size])
+            summaries.record(escrows=[(escrow.from_user_id, escrow.to_user_id, escrow.amount, None, escrow.stage)
+                                      for escrow in chunk])
+            outbox.publish(EventKind.Created, [(escrow.transaction_id, escrow.from_user_id, escrow.to_user_id,
+                                                escrow.amount) for escrow in chunk])
+            transaction_ids.extend(escrow.transaction_id for escrow in chunk)
+        return transaction_ids
+
+
+class ExportView(APIView):
+    """
+    Stream the escrows, monetary transactions or disputes of the logged in
+    user as CSV or newline delimited JSON.
+
+    Rows are read with a chunked iterator and written out as they arrive, so
+    memory use doesn't depend on the size of the history. Staff can export
+    every user's rows with `scope=all`
+    """
+    permission_classes = [permissions.IsAuthenticated]
 
-        try:
-            serializer.is_valid(raise_exception=True)
-            if serializer.data['from_user'] != request.user.id or serializer.data['to_user'] != request.user.id:
-                response_data = {"status": status.HTTP_400_BAD_REQUEST, "status_description": "Bad request",
-                                 "errors": [{"user_id": "Logged in user is not part of the transaction"}],
-                                 "data": {}}
-                return Response(status=status.HTTP_400_BAD_REQUEST, data=response_data)
-            self.perform_create(serializer)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        except ValidationError as e:
-            response_data = {"status": status.HTTP_400_BAD_REQUEST, "status_description": "Bad request",
-                             "errors": e.detail,
-                             "data": {}}
-            return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
+    def perform_content_negotiation(self, request, force=False):
+        # the export itself isn't rendered, don't reject clients asking for text/csv
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request, kind: str, file_format: str):
+        export = exports.EXPORTS.get(kind)
+        if export is None or file_format not in exports.FORMATS:
+            raise APIError(status.HTTP_404_NOT_FOUND,
+                           {"export": [f"Exports are one of {', '.join(exports.EXPORTS)} "
+                                       f"as {' or '.join(exports.FORMATS)}"]})
+
+        everyone = request.query_params.get("scope") == "all"
+        if everyone and not request.user.is_staff:
+            raise APIError(status.HTTP_403_FORBIDDEN, {"scope": ["Only staff can export every user"]})
+
+        filters = Q()
+        for param, lookup in (("created_after", "created_date__gte"), ("created_before", "created_date__lt")):
+            value = request.query_params.get(param)
+            if value:
+                parsed = parse_datetime(value)
+                if parsed is None:
+                    raise ValidationError({param: ["Expected an ISO 8601 datetime"]})
+                filters &= Q(**{lookup: parsed})
+
+        content_type, lines = exports.FORMATS[file_format]
+        rows = export.rows(request.user, everyone=everyone, filters=filters)
+        response = StreamingHttpResponse(lines(export.headers, rows), content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="esgrow-{kind}.{file_format}"'
+        return response
+
+
+def confirmation_fields(transaction: EscrowTransactions, user: User) -> dict | None:
+    """
+    The confirmation columns of the side of `user` in the escrow, None if
+    they aren't part of it
+    """
+    if user == transaction.from_user:
+        party = "from_user"
+    elif user == transaction.to_user:
+        party = "to_user"
+    else:
+        return None
+    now = timezone.now()
+    return {f"{party}_confirmed": True, f"{party}_confirmed_date": now, "modified_date": now}
+
+
+def record_confirmation(transaction: EscrowTransactions, user: User, fields: dict) -> bool | None:
+    """
+    Write the confirmation `fields` of `user` and publish the
+    escrow.confirmed event, in one transaction. Only the confirmation
+    columns are written, so concurrent confirmations by the two parties can't
+    overwrite each other, and only while the escrow is open, so a cancelled
+    escrow can't be confirmed into settlement.
+
+    Returns True if this call confirmed the escrow, False if the user had
+    already confirmed it (a retry, nothing is written or published again)
+    and None if it isn't open
+    """
+    confirmed = next(field for field in fields if field.endswith("_confirmed"))
+    with atomic():
+        escrows = EscrowTransactions.objects.filter(transaction_id=transaction.transaction_id,
+                                                    stage__in=transitions.OPEN_STAGES)
+        if not escrows.filter(**{confirmed: False}).update(**fields):
+            return False if escrows.exists() else None
+        outbox.publish(EventKind.Confirmed, [(transaction.transaction_id, transaction.from_user_id,
+                                              transaction.to_user_id, transaction.amount)], user_id=user.pk)
+    return True
+
+
+def closed_error(stage: str | None) -> APIError:
+    """
+    The error for confirming or disputing an escrow that moved to `stage`
+    """
+    if stage in settlement.ConfirmResult.values:
+        message = settlement.ConfirmResult(stage).label
+    else:
+        message = "Transaction changed stage, try again"
+    return APIError(status.HTTP_409_CONFLICT, {"transaction_id": [message]})
 
 
 @api_view(['POST', 'GET'])
-@authentication_classes([TokenAuthentication])
+@authentication_classes([CachedTokenAuthentication])
 @permission_classes([IsAuthenticated])
+@idempotent
 def confirm_transaction(request, transaction_id: uuid.UUID):
-    transaction = EscrowTransactions.objects.get(transaction_id=transaction_id)
+    transaction = optimise_queryset(EscrowTransactions.objects, EscrowViewTransactionSerializer) \
+        .filter(transaction_id=transaction_id).first()
     if transaction is None:
-        response_data = {"status": status.HTTP_404_NOT_FOUND,
-                         "status_description": "NOT FOUND",
-                         "errors": {
-                             "transaction_id": ["Transaction wasn't found"]
-                         },
-                         "data": {}}
-        return Response(response_data, status=status.HTTP_404_NOT_FOUND)
+        raise APIError(status.HTTP_404_NOT_FOUND, {"transaction_id": ["Transaction wasn't found"]})
 
     user: User = request.user
 
@@ -165,124 +336,283 @@ def confirm_transaction(request, transaction_id: uuid.UUID):
     if not request.user.is_authenticated:
         raise ValidationError("User is not authenticated")
 
-    if user == transaction.from_user:
-        transaction.from_user_confirmed = True
-        transaction.from_user_confirmed_date = datetime.datetime.now()
-        transaction.save()
-    elif user == transaction.to_user:
-        transaction.to_user_confirmed = True
-        transaction.to_user_confirmed_date = datetime.datetime.now()
-        transaction.save()
-    else:
-        response_data = {"status": status.HTTP_400_BAD_REQUEST,
-                         "status_description": "BAD REQUEST",
-                         "errors": {
-                             "user_id": ["Logged In user is not part of the transaction"]
-                         },
-                         "data": {}}
-        return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
+    fields = confirmation_fields(transaction, user)
+    if fields is None:
+        raise ValidationError({"user_id": ["Logged In user is not part of the transaction"]})
+    confirmed = record_confirmation(transaction, user, fields)
+    if confirmed is None:
+        raise closed_error(EscrowTransactions.objects.filter(transaction_id=transaction.transaction_id)
+                           .values_list("stage", flat=True).first())
+    if confirmed:
+        for field, value in fields.items():
+            setattr(transaction, field, value)
+
+    settled, _ = settlement.settle_or_queue([transaction.transaction_id])
+    if settled:
+        transaction.refresh_from_db(fields=["stage", "updated_on_users", "time_updated_on_users", "modified_date"])
 
     serializer = EscrowViewTransactionSerializer(transaction, many=False)
+    return Response(serializer.data, status=status.HTTP_200_OK)
+
 
-    response_data = {"status": status.HTTP_200_OK,
-                     "status_description": "OK",
-                     "errors": [],
-                     "data": serializer.data}
-    return Response(response_data, status=status.HTTP_200_OK)
+# confirmations are committed per chunk, so one huge batch doesn't hold
+# its locks for the whole request
+CONFIRM_BATCH_CHUNK_SIZE = 500
+CONFIRM_BATCH_MAX_SIZE = 10000
 
 
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication])
+@authentication_classes([CachedTokenAuthentication])
 @permission_classes([IsAuthenticated])
-def dispute_transaction(request, transaction_id: uuid.UUID):
-    try:
-        transaction = EscrowTransactions.objects.get(transaction_id=transaction_id)
-        if transaction is None:
-            response_data = {"status": status.HTTP_404_NOT_FOUND,
-                             "status_description": "NOT FOUND",
-                             "errors": {
-                                 "transaction_id": ["Transaction wasn't found"]
-                             },
-                             "data": {}}
-            return Response(response_data, status=status.HTTP_404_NOT_FOUND)
-
-        if transaction.stage == TransactionStage.Completed:
-            response_data = {"status": status.HTTP_406_NOT_ACCEPTABLE,
-                             "status_description": "NOT ACCEPTABLE",
-                             "errors": {
-                                 "transaction_id": ["Cannot refute transaction that was previously completed"]
-                             },
-                             "data": {}}
-            return Response(response_data, status=status.HTTP_404_NOT_FOUND)
-        user: User = request.user
-
-        if user is None:
-            raise ValidationError("User not found")
-        if not request.user.is_authenticated:
-            raise ValidationError("User is not authenticated")
-
-        if user == transaction.from_user:
-            transaction.from_user_confirmed = False
-            transaction.from_user_confirmed_date = None
-            transaction.stage = TransactionStage.Cancelled
-            transaction.save()
-        elif user == transaction.to_user:
-            transaction.to_user_confirmed = False
-            transaction.to_user_confirmed_date = None
-            transaction.stage = TransactionStage.Cancelled
-            transaction.save()
-        else:
-            response_data = {"status": status.HTTP_400_BAD_REQUEST,
-                             "status_description": "BAD REQUEST",
-                             "errors": {
-                                 "user_id": ["Logged In user is not part of the transaction"]
-                             },
-                             "data": {}}
-            return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
-
-        json_data = json.loads(request.body)
+@idempotent
+def confirm_transactions(request):
+    transaction_ids = request.data.get("transaction_ids") if isinstance(request.data, dict) else None
+    if not isinstance(transaction_ids, list) or not transaction_ids:
+        raise ValidationError({"transaction_ids": ["Expected a non empty list of transaction ids"]})
+    if len(transaction_ids) > CONFIRM_BATCH_MAX_SIZE:
+        raise ValidationError({"transaction_ids": [f"At most {CONFIRM_BATCH_MAX_SIZE} transactions per batch"]})
+
+    results = {}
+    valid_ids = []
+    for transaction_id in transaction_ids:
+        try:
+            valid_ids.append(uuid.UUID(str(transaction_id)))
+        except ValueError:
+            results[str(transaction_id)] = {"transaction_id": transaction_id, "result": "Invalid",
+                                            "description": "Not a valid transaction id"}
+    # keep the first occurrence of duplicates
+    valid_ids = list(dict.fromkeys(valid_ids))
+
+    for start in range(0, len(valid_ids), CONFIRM_BATCH_CHUNK_SIZE):
+        chunk = valid_ids[start:start + CONFIRM_BATCH_CHUNK_SIZE]
+        for transaction_id, result in settlement.confirm_transactions(request.user.id, chunk).items():
+            results[str(transaction_id)] = {"transaction_id": transaction_id, "result": result.value,
+                                            "description": result.label}
+
+    return Response({"results": list(results.values())}, status=status.HTTP_200_OK)
+
+
+def open_dispute(transaction: EscrowTransactions, user: User, reason: str) -> Disputes:
+    """
+    Cancel the escrow, withdrawing the confirmation of `user`, and open a
+    dispute on it, with the summaries of both parties updated and the
+    escrow.disputed event published in the same transaction.
+
+    Raises `transitions.IllegalTransition` if the escrow is completed or
+    cancelled, including by a request racing this one
+    """
+    party = "from_user" if user == transaction.from_user else "to_user"
+    fields = {f"{party}_confirmed": False, f"{party}_confirmed_date": None}
+    with atomic():
+        transitions.move([(transaction.transaction_id, transaction.from_user_id, transaction.to_user_id,
+                           transaction.amount, transaction.stage)],
+                         TransactionStage.Cancelled, user_id=user.pk,
+                         disputes=[(transaction.from_user_id, transaction.to_user_id, False, True)], **fields)
         dispute = Disputes.objects.create(
             user_initiated=user,
             transaction=transaction,
-            reason=json_data.get("reason", ""),
+            reason=reason,
             stage=DisputeStage.Pending
         )
+        outbox.publish(EventKind.Disputed, [(transaction.transaction_id, transaction.from_user_id,
+                                             transaction.to_user_id, transaction.amount)],
+                       user_id=user.pk, dispute_id=dispute.dispute_id, reason=reason)
+    for field, value in fields.items():
+        setattr(transaction, field, value)
+    transaction.stage = TransactionStage.Cancelled
+    return dispute
+
+
+@api_view(['POST'])
+@authentication_classes([CachedTokenAuthentication])
+@permission_classes([IsAuthenticated])
+@idempotent
+def dispute_transaction(request, transaction_id: uuid.UUID):
+    transaction = optimise_queryset(EscrowTransactions.objects, EscrowViewTransactionSerializer) \
+        .filter(transaction_id=transaction_id).first()
+    if transaction is None:
+        raise APIError(status.HTTP_404_NOT_FOUND, {"transaction_id": ["Transaction wasn't found"]})
+
+    if transaction.stage == TransactionStage.Completed:
+        raise APIError(status.HTTP_404_NOT_FOUND,
+                       {"transaction_id": ["Cannot refute transaction that was previously completed"]},
+                       description="NOT ACCEPTABLE")
+    user: User = request.user
+
+    if user is None:
+        raise ValidationError("User not found")
+    if not request.user.is_authenticated:
+        raise ValidationError("User is not authenticated")
+
+    if user not in (transaction.from_user, transaction.to_user):
+        raise ValidationError({"user_id": ["Logged In user is not part of the transaction"]})
+
+    try:
+        dispute = open_dispute(transaction, user, request.data.get("reason", ""))
+    except transitions.IllegalTransition as e:
+        raise closed_error(e.stage or EscrowTransactions.objects.filter(transaction_id=transaction.transaction_id)
+                           .values_list("stage", flat=True).first())
+    serializer = DisputeSerializer(dispute, many=False)
+    return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@authentication_classes([CachedTokenAuthentication])
+@permission_classes([IsAdminUser])
+def dispute_queue(request):
+    """
+    The disputes of `stage` (Pending by default) oldest first, for support
+    staff. `assigned_to` filters on the assigned staff member, "me" for the
+    logged in one and "none" for the unassigned disputes
+    """
+    stage = request.query_params.get("stage", DisputeStage.Pending)
+    if stage not in DisputeStage.values:
+        raise ValidationError({"stage": [f"Expected one of {', '.join(DisputeStage.values)}"]})
+    assigned_to, unassigned = request.query_params.get("assigned_to"), False
+    if assigned_to == "me":
+        assigned_to = request.user.id
+    elif assigned_to == "none":
+        assigned_to, unassigned = None, True
+    elif assigned_to is not None:
+        try:
+            assigned_to = uuid.UUID(assigned_to)
+        except ValueError:
+            raise ValidationError({"assigned_to": ["Expected a user id, me or none"]})
+    limit = parse_page_size(request.query_params.get("limit"))
+
+    page, next_cursor = disputes.queue(optimise_queryset(Disputes.objects, DisputeQueueSerializer), stage,
+                                       assigned_to=assigned_to, unassigned=unassigned,
+                                       cursor=request.query_params.get("cursor"), limit=limit)
+    serializer = DisputeQueueSerializer(page, many=True)
+    return Response({"disputes": serializer.data, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
 
-        serializer = DisputeSerializer(dispute, many=False)
-        response_data = {"status": status.HTTP_200_OK,
-                         "status_description": "OK",
-                         "errors": {
-                         },
-                         "data": serializer.data}
-        return Response(response_data, status=status.HTTP_200_OK)
-    except ValidationError as e:
-        response_data = {"status": status.HTTP_400_BAD_REQUEST, "status_description": "Bad request",
-                         "errors": e.detail,
-                         "data": {}}
-        return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
 
-    except Exception as e:
-        response_data = {"status": status.HTTP_400_BAD_REQUEST, "status_description": "Bad request",
-                         "errors": {"exception": [f"${e}"]},
-                         "data": {}}
-        return Response(response_data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+@api_view(['POST'])
+@authentication_classes([CachedTokenAuthentication])
+@permission_classes([IsAdminUser])
+def assign_disputes(request):
+    serializer = DisputeAssignSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    user = serializer.validated_data["user_id"]
+    dispute_ids = list(dict.fromkeys(serializer.validated_data["dispute_ids"]))
+
+    assigned = set(disputes.assign(dispute_ids, user.id if user is not None else None))
+    return Response({"assigned": [dispute_id for dispute_id in dispute_ids if dispute_id in assigned],
+                     "skipped": [dispute_id for dispute_id in dispute_ids if dispute_id not in assigned]},
+                    status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication])
+@authentication_classes([CachedTokenAuthentication])
+@permission_classes([IsAdminUser])
+@idempotent
+def resolve_disputes(request):
+    """
+    Resolve a batch of disputes, refunding (`Refunded`) or settling
+    (`Settled`) their escrows with the optional `outcome`. Disputes that
+    don't exist or are already resolved are skipped
+    """
+    serializer = DisputeResolveSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    dispute_ids = list(dict.fromkeys(serializer.validated_data["dispute_ids"]))
+
+    try:
+        resolved, settled = disputes.resolve(dispute_ids, request.user.id, serializer.validated_data["outcome"],
+                                             serializer.validated_data["resolution"])
+    except transitions.IllegalTransition as e:
+        raise APIError(status.HTTP_409_CONFLICT, {"transaction_ids": [str(e)]},
+                       data={"transaction_ids": e.transaction_ids})
+    resolved = set(resolved)
+    return Response({"resolved": [dispute_id for dispute_id in dispute_ids if dispute_id in resolved],
+                     "skipped": [dispute_id for dispute_id in dispute_ids if dispute_id not in resolved],
+                     "settled": sorted(settled)}, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@authentication_classes([CachedTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def create_compliance_document(request):
+    """
+    Start a resumable upload of a compliance document between the logged in
+    user (party A) and `party_b`. The file is then sent with PUT requests to
+    `upload_compliance_document`
+    """
+    serializer = ComplianceUploadSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    upload = serializer.save(party_a=request.user)
+    return Response(ComplianceUploadSerializer(upload).data, status=status.HTTP_201_CREATED)
+
+
+@api_view(['GET', 'PUT'])
+@authentication_classes([CachedTokenAuthentication])
 @permission_classes([IsAuthenticated])
-def create_compliance_document():
-    pass
+def upload_compliance_document(request, upload_id: uuid.UUID):
+    """
+    GET returns how many bytes were received so far, PUT appends the next
+    chunk given as the raw body with a `Content-Range: bytes start-end/size`
+    header. The body is streamed to disk, never loaded whole
+    """
+    upload = optimise_queryset(ComplianceUpload.objects, ComplianceUploadSerializer) \
+        .filter(upload_id=upload_id, party_a=request.user).first()
+    if upload is None:
+        raise APIError(status.HTTP_404_NOT_FOUND, {"upload_id": ["Upload wasn't found"]})
+
+    if request.method == "PUT":
+        if upload.document_id is not None:
+            raise APIError(status.HTTP_409_CONFLICT, {"upload_id": ["Upload is already complete"]},
+                           data=ComplianceUploadSerializer(upload).data)
+        try:
+            start, end = uploads.parse_content_range(request.headers.get("Content-Range"), upload.size)
+            upload = uploads.write_chunk(upload, request.stream, start, end)
+        except uploads.UploadConflict as e:
+            upload.received = e.received
+            raise APIError(status.HTTP_409_CONFLICT, {"Content-Range": [str(e)]},
+                           data=ComplianceUploadSerializer(upload).data)
+        except ValueError as e:
+            raise ValidationError({"Content-Range": [str(e)]})
+
+    return Response(ComplianceUploadSerializer(upload).data, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
+@authentication_classes([CachedTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def download_compliance_document(request, compliance_id: uuid.UUID):
+    document = ComplianceDocuments.objects.filter(
+        Q(party_a=request.user) | Q(party_b=request.user), compliance_id=compliance_id).first()
+    if document is None or not document.file:
+        raise APIError(status.HTTP_404_NOT_FOUND, {"compliance_id": ["Document wasn't found"]})
+    return uploads.file_response(document, request.headers.get("Range"))
+
+
+@api_view(['GET'])
+@authentication_classes([CachedTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def user_summary(request):
+    """
+    Dashboard totals of the logged in user, see `esgrow_backend.summaries`
+    """
+    return Response(UserSummarySerializer(summaries.get(request.user.id)).data)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.AllowAny])
+@throttle_classes([SearchThrottle])
 def search_users(request):
     name = request.GET.get("name", default="")
-    if name != "":
-        users = User.objects.filter(
-            Q(first_name__contains=name) | Q(last_name__contains=name) | Q(username__contains=name))
-        serializer = UserSerializer(users, many=True)
-        return Response(
-            {"status": status.HTTP_200_OK, "data": serializer.data, "status_description": "OK", "errors": []})
-    else:
-        return Response({"status": status.HTTP_200_OK, "data": [], "status_description": "OK"})
+    limit = parse_page_size(request.GET.get("limit"), default=search.DEFAULT_LIMIT, maximum=search.MAX_LIMIT)
+    users, next_cursor = search.search(name, limit=limit, cursor=request.GET.get("cursor"))
+
+    serializer = UserSerializer(users, many=True)
+    return Response({"users": serializer.data, "next_cursor": next_cursor})
+
+
+def prometheus_metrics(request):
+    """
+    The metrics of this worker process in the Prometheus text format
+    """
+    if not metrics.scrape_allowed(request):
+        return HttpResponse(renderers.dumps(utils.envelope(status_code=status.HTTP_403_FORBIDDEN, errors={
+            "detail": ["Metrics are only served to allowed addresses or with the metrics token"]})),
+                            status=status.HTTP_403_FORBIDDEN, content_type="application/json")
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,89 @@
+"""
+A local webhook receiver for tests and development, see the webhook_stub
+command.
+
+It verifies the signature of every request, answers 401 to bad ones and
+500 to the next `fail` good ones, and keeps the events it accepted
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from esgrow_backend import webhooks
+
+
+class StubReceiver:
+    def __init__(self, secret: str, host: str = "127.0.0.1", port: int = 0, fail: int = 0, delay: float = 0):
+        self.secret = secret
+        self.fail = fail
+        # seconds every request takes, to observe concurrent requests
+        self.delay = delay
+        self.events = []
+        self.requests = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/webhooks"
+
+    def handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, so the dispatcher's connections are reused
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(receiver.receive(body, self.headers.get(webhooks.SIGNATURE_HEADER, "")))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def receive(self, body: bytes, signature: str) -> int:
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            with self._lock:
+                if not webhooks.verify(self.secret, body, signature):
+                    self.rejected += 1
+                    return 401
+                if self.fail:
+                    self.fail -= 1
+                    return 500
+                self.events.extend(json.loads(body)["events"])
+                return 200
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def start(self) -> "StubReceiver":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
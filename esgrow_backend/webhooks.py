@@ -0,0 +1,264 @@
+"""
+Webhook delivery of the outbox events.
+
+`dispatch` (the dispatch_webhooks command) runs three steps per batch:
+1. `fan_out` turns new `OutboxEvent` rows into one `WebhookDelivery` per
+   active endpoint that wants the event
+2. `claim` leases the due deliveries for WEBHOOK_LEASE seconds, so
+   concurrent dispatchers skip them and a crashed one's are retried
+3. `deliver` POSTs them, up to WEBHOOK_EVENTS_PER_REQUEST events per
+   request, from a thread pool with at most `max_concurrency` requests to an
+   endpoint at once, over the keep-alive connections of a `ConnectionPool`,
+   and stores the outcomes with one bulk update
+
+A failed request is retried after an exponential backoff with jitter until
+WEBHOOK_MAX_ATTEMPTS attempts failed. Delivery is at least once, receivers
+should ignore events whose id they have seen.
+
+Requests carry an `Esgrow-Signature: t=<timestamp>,v1=<hex>` header, the
+HMAC-SHA256 of "<timestamp>.<body>" with the endpoint secret, see `verify`
+"""
+import datetime
+import hashlib
+import hmac
+import http.client
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from esgrow_backend import outbox, renderers
+from esgrow_backend.models import OutboxEvent, WebhookEndpoint, WebhookDelivery
+
+SIGNATURE_HEADER = "Esgrow-Signature"
+
+
+def sign(secret: str, body: bytes, timestamp: int) -> str:
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def verify(secret: str, body: bytes, header: str, tolerance: int = 300, now: float = None) -> bool:
+    """
+    Whether `header` is a signature of `body` with `secret` made less than
+    `tolerance` seconds ago, for receivers
+    """
+    try:
+        parts = dict(part.split("=", 1) for part in header.split(","))
+        timestamp = int(parts["t"])
+    except (KeyError, ValueError):
+        return False
+    now = time.time() if now is None else now
+    if abs(now - timestamp) > tolerance:
+        return False
+    return hmac.compare_digest(sign(secret, body, timestamp), f"t={timestamp},v1={parts.get('v1', '')}")
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections, up to `max_idle` idle ones per host, shared
+    by the delivery threads
+    """
+
+    def __init__(self, timeout: float = 10, max_idle: int = 16):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def post(self, url: str, body: bytes, headers: dict) -> int:
+        """
+        POST `body` to `url`, returns the response status
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        with self._lock:
+            connection = self._idle[key].pop() if self._idle[key] else None
+        # a reused connection may have been closed by the server while idle, retry once on a new one
+        for reused in (connection is not None, False):
+            if connection is None:
+                connection_class = http.client.HTTPSConnection if parts.scheme == "https" \
+                    else http.client.HTTPConnection
+                connection = connection_class(parts.hostname, parts.port, timeout=self.timeout)
+            try:
+                connection.request("POST", path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                connection = None
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                with self._lock:
+                    if len(self._idle[key]) < self.max_idle:
+                        self._idle[key].append(connection)
+                        connection = None
+                if connection is not None:
+                    connection.close()
+            return response.status
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+
+def wants(endpoint: WebhookEndpoint, event: OutboxEvent) -> bool:
+    payload = event.payload
+    return endpoint.user_id is None or str(endpoint.user_id) in (payload["from_user_id"], payload["to_user_id"])
+
+
+def fan_out(batch_size: int = 1000) -> int:
+    """
+    Create the deliveries of the oldest `batch_size` events not fanned out
+    yet, returns how many were created
+    """
+    with transaction.atomic():
+        events = list(OutboxEvent.objects.select_for_update(skip_locked=True).filter(fanned_out=False)
+                      .order_by("event_id")[:batch_size])
+        if not events:
+            return 0
+        endpoints = list(WebhookEndpoint.objects.filter(active=True))
+        now = timezone.now()
+        deliveries = WebhookDelivery.objects.bulk_create([
+            WebhookDelivery(event=event, endpoint=endpoint, next_attempt_date=now)
+            for event in events for endpoint in endpoints if wants(endpoint, event)
+        ])
+        OutboxEvent.objects.filter(event_id__in=[event.event_id for event in events]).update(fanned_out=True)
+    return len(deliveries)
+
+
+def claim(batch_size: int = 1000) -> list[WebhookDelivery]:
+    """
+    Lease the `batch_size` deliveries due the longest, oldest events first
+    within an endpoint
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        deliveries = list(WebhookDelivery.objects.select_for_update(skip_locked=True, of=("self",))
+                          .select_related("event", "endpoint")
+                          .filter(next_attempt_date__lte=now, endpoint__active=True)
+                          .order_by("next_attempt_date", "delivery_id")[:batch_size])
+        if deliveries:
+            WebhookDelivery.objects.filter(delivery_id__in=[delivery.delivery_id for delivery in deliveries]) \
+                .update(next_attempt_date=now + datetime.timedelta(seconds=getattr(settings, "WEBHOOK_LEASE", 60)))
+    deliveries.sort(key=lambda delivery: delivery.event_id)
+    return deliveries
+
+
+def backoff(attempts: int) -> float:
+    """
+    Seconds to wait before the attempt after `attempts` failed ones, doubling
+    up to WEBHOOK_RETRY_MAX and jittered so failed endpoints aren't retried
+    in lockstep
+    """
+    delay = min(getattr(settings, "WEBHOOK_RETRY_BASE", 5) * 2 ** (attempts - 1),
+                getattr(settings, "WEBHOOK_RETRY_MAX", 3600))
+    return delay * random.uniform(0.5, 1)
+
+
+def body(deliveries: list[WebhookDelivery]) -> bytes:
+    return renderers.dumps({"events": [outbox.serialize(delivery.event) for delivery in deliveries]})
+
+
+def send(pool: ConnectionPool, endpoint: WebhookEndpoint, requests: list[list[WebhookDelivery]]) -> list:
+    """
+    POST `requests` to `endpoint` one after the other, returns an
+    (deliveries, status, error) outcome per request
+    """
+    outcomes = []
+    for deliveries in requests:
+        content = body(deliveries)
+        headers = {"Content-Type": "application/json",
+                   SIGNATURE_HEADER: sign(endpoint.secret, content, int(time.time()))}
+        try:
+            outcomes.append((deliveries, pool.post(endpoint.url, content, headers), ""))
+        except (OSError, http.client.HTTPException) as e:
+            outcomes.append((deliveries, None, f"{type(e).__name__}: {e}"[:300]))
+    return outcomes
+
+
+def deliver(deliveries: list[WebhookDelivery], pool: ConnectionPool, workers: int = None) -> tuple[int, int]:
+    """
+    Send `deliveries` and store the outcomes, returns how many were
+    delivered and how many failed.
+
+    Each endpoint's requests are split into `max_concurrency` lanes sent one
+    request after the other, so an endpoint never has more requests in
+    flight and a slow one only holds its own lanes' threads
+    """
+    per_request = getattr(settings, "WEBHOOK_EVENTS_PER_REQUEST", 50)
+    by_endpoint = defaultdict(list)
+    for delivery in deliveries:
+        by_endpoint[delivery.endpoint_id].append(delivery)
+
+    lanes = []
+    for endpoint_deliveries in by_endpoint.values():
+        endpoint = endpoint_deliveries[0].endpoint
+        requests = [endpoint_deliveries[start:start + per_request]
+                    for start in range(0, len(endpoint_deliveries), per_request)]
+        concurrency = max(endpoint.max_concurrency, 1)
+        lanes.extend((endpoint, requests[lane::concurrency]) for lane in range(min(concurrency, len(requests))))
+    if not lanes:
+        return 0, 0
+
+    workers = workers or getattr(settings, "WEBHOOK_WORKERS", 16)
+    with ThreadPoolExecutor(max_workers=min(workers, len(lanes))) as executor:
+        outcomes = [outcome for lane_outcomes in executor.map(lambda lane: send(pool, *lane), lanes)
+                    for outcome in lane_outcomes]
+
+    now = timezone.now()
+    max_attempts = getattr(settings, "WEBHOOK_MAX_ATTEMPTS", 12)
+    delivered = failed = 0
+    for request_deliveries, status, error in outcomes:
+        succeeded = status is not None and 200 <= status < 300
+        for delivery in request_deliveries:
+            delivery.attempts += 1
+            delivery.last_status = status
+            delivery.last_error = error or ("" if succeeded else f"HTTP {status}")
+            if succeeded:
+                delivery.delivered_date = now
+                delivery.next_attempt_date = None
+                delivered += 1
+            else:
+                # given up on once out of attempts, setting next_attempt_date retries it
+                delivery.next_attempt_date = now + datetime.timedelta(seconds=backoff(delivery.attempts)) \
+                    if delivery.attempts < max_attempts else None
+                failed += 1
+    WebhookDelivery.objects.bulk_update(
+        deliveries, ["attempts", "last_status", "last_error", "delivered_date", "next_attempt_date"], batch_size=500)
+    return delivered, failed
+
+
+def dispatch(pool: ConnectionPool, batch_size: int = 1000) -> dict[str, int]:
+    """
+    Fan out and deliver one batch, returns counts of what was done
+    """
+    fanned_out = fan_out(batch_size)
+    delivered, failed = deliver(claim(batch_size), pool)
+    return {"fanned_out": fanned_out, "delivered": delivered, "failed": failed}
+
+
+def pending() -> int:
+    """
+    The deliveries still to be attempted, due or not
+    """
+    return WebhookDelivery.objects.filter(next_attempt_date__isnull=False).count()